@@ -7,19 +7,29 @@ class Network(enum.Enum):
     
 if __name__ == '__main__':
 
+    import os
     import typer
-    import server
 
-    def make_cli(logger):
+    def load_server(role: str | None = None):
+        '''
+        Import the server in the given role. Ref. server.Settings.role.
+        '''
+        # Settings are read when the server is imported, and worker processes inherit the environment.
+        if role: os.environ['ROLE'] = role
+
+        import server
+        return server
+
+    def make_cli():
 
 
         cli = typer.Typer()
 
-        @cli.command()
-        def run():
+        def serve_api(server):
 
             import uvicorn
 
+            logger = server.logger
             assert logger
             logger.info(f'debug: {server.app.debug}')
             uvicorn.run('server:app', 
@@ -27,12 +37,48 @@ if __name__ == '__main__':
                     port = 5000, 
                     debug = server.settings.debug,
                     log_level = 'debug' if server.settings.debug else 'info',
+                    workers = server.settings.workers,
                     reload = server.settings.debug,
                     reload_includes = ['spotbit.config']  # FIXME(nochiel) Does nothing? 
                     )
 
+        @cli.callback(invoke_without_command = True)
+        def main(context: typer.Context):
+            '''
+            Run Spotbit. Without a command, Spotbit requests exchanges and serves the API in one process.
+            '''
+            if context.invoked_subcommand is None: run()
+
+        @cli.command()
+        def run():
+            '''
+            Request exchanges and serve the API.
+            '''
+            serve_api(load_server())
+
+        @cli.command()
+        def collect():
+            '''
+            Request markets, latest prices and history from exchanges and save them in the data directory.
+            '''
+
+            import asyncio
+
+            server = load_server('collect')
+            try:
+                asyncio.run(server.collect())
+            except KeyboardInterrupt:
+                pass
+
+        @cli.command()
+        def serve():
+            '''
+            Serve the API from the data directory that the collect command saves to, without requesting exchanges.
+            '''
+            serve_api(load_server('serve'))
+
         return cli
 
-    cli = make_cli(server.logger)
+    cli = make_cli()
     assert cli
     cli()
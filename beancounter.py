@@ -78,7 +78,10 @@ class Spotbit:
 
     def get_candles_at_dates(self,
             currency: str,
-            dates: list[datetime]):
+            dates: list[datetime]) -> list[Candle | None]:
+        '''
+        Return the candle at each date, or None for a date that Spotbit has no candle for.
+        '''
 
         result = None
 
@@ -86,7 +89,7 @@ class Spotbit:
         body    = [dt.isoformat() for dt in dates]
         response = requests.post(request, json = body)
         if response.status_code == 200:
-            result = [Candle(**data) for data in response.json()]
+            result = [Candle(**data) if data else None for data in response.json()]
         else:
             raise HTTPException(detail = response.json() , status_code = response.status_code)
 
@@ -308,6 +311,10 @@ async def make_transaction_details(
     if candles:
         for i in range(len(transactions)):
             candle = candles[i]
+            if candle is None:
+                _logger.warning(f'Spotbit has no {currency} price at the time of {transactions[i].txid}. It is left out of the records.')
+                continue
+
             detail = TransactionDetails(
                     transaction = transactions[i],
                     twap = round(mean([candle.open, candle.high, candle.low, candle.close]), 2))
@@ -693,7 +700,8 @@ class DescriptorType(Enum):
     SEGWIT_MULTISIG = 'segwitmultisig'
     TAPROOT         = 'taproot'
 
-@dataclass(init = False)
+# Not compared by value, so that it can be the default account of ParsedDescriptor on Python 3.11.
+@dataclass(init = False, eq = False)
 class Account:
     # Ref. BIP44
     # m / purpose' / coin_type' / account' / change / address_index
@@ -0,0 +1,79 @@
+'''
+Compare the size and encoding time of the candle output formats.
+
+    python -m benchmarks.formats [--candles N] [--repeat R]
+
+Each format is encoded from the same CandleColumns, as the routes encode it.
+"json (Candle)" is the path that history responses used to take: a validated
+lib.Candle per row, serialised with its json_encoders.
+'''
+
+import argparse
+import time
+
+import numpy as np
+import orjson
+
+from lib import Candle, formats
+from lib.columnar import CandleColumns
+
+def make_candles(n: int) -> CandleColumns:
+    rng = np.random.default_rng(0)
+
+    timestamp = 1_600_000_000_000 + np.arange(n, dtype = np.int64) * 3_600_000
+    close = 20_000 + rng.normal(0, 50, n).cumsum()
+    open = np.roll(close, 1)
+    high = np.maximum(open, close) + rng.uniform(0, 20, n)
+    low = np.minimum(open, close) - rng.uniform(0, 20, n)
+    volume = rng.uniform(0, 100, n)
+
+    return CandleColumns(timestamp, open, high, low, close, volume)
+
+def encode_candle_models(candles: CandleColumns) -> bytes:
+    models = [Candle(**candle) for candle in candles.to_dicts()]
+    return ('[' + ','.join(model.json() for model in models) + ']').encode()
+
+def encode_json(candles: CandleColumns) -> bytes:
+    # The response that the JSON routes return.
+    return formats.TrustedJSONResponse(candles.to_dicts()).body
+
+def encode_ndjson(candles: CandleColumns) -> bytes:
+    # A page of the streamed history route.
+    return b''.join(orjson.dumps(candle) + b'\n' for candle in candles.to_dicts())
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--candles', type = int, default = 100_000)
+    parser.add_argument('--repeat', type = int, default = 5)
+    args = parser.parse_args()
+
+    candles = make_candles(args.candles)
+
+    encoders = {
+            'json (Candle)':    encode_candle_models,
+            'json':             encode_json,
+            'ndjson':           encode_ndjson,
+            'csv':              lambda c: formats.encode(c, formats.CSV),
+            'msgpack':          lambda c: formats.encode(c, formats.MSGPACK),
+            'arrow':            lambda c: formats.encode(c, formats.ARROW),
+            'arrow (file)':     lambda c: formats.encode(c, formats.ARROW_FILE),
+            }
+
+    print(f'{args.candles} candles, best of {args.repeat}')
+    print(f'{"format":<16}{"bytes":>14}{"bytes/candle":>14}{"ms":>10}')
+
+    for name, encode in encoders.items():
+        try:
+            times = []
+            for _ in range(args.repeat):
+                began = time.perf_counter()
+                content = encode(candles)
+                times.append(time.perf_counter() - began)
+        except formats.UnsupportedFormat as e:
+            print(f'{name:<16}{e}')
+            continue
+
+        print(f'{name:<16}{len(content):>14,}{len(content) / args.candles:>14.1f}{min(times) * 1e3:>10.1f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+'''
+Load test a running Spotbit server.
+
+    python -m benchmarks.load [--url URL] [--scenarios now,history,dates] [--concurrency C] [--requests N]
+
+Each scenario is run in turn. C clients request the scenario's endpoint
+until N requests have been made, then the throughput and latency
+percentiles are reported.
+
+    now:            GET /api/now/{currency}
+    now-exchange:   GET /api/now/{currency}/{exchange}
+    history:        GET /api/history/{currency}/{exchange} for a random week.
+    dates:          POST /api/history/{currency} with random dates.
+
+To measure without touching live exchanges, run Spotbit with replay
+exchanges (lib/replay.py) e.g.
+
+    EXCHANGES='["replay"]' REPLAY='{"replay": {"latency": 0.05}}' python app.py
+'''
+
+import argparse
+import asyncio
+from datetime import datetime, timedelta, timezone
+import random
+import time
+
+import aiohttp
+import numpy as np
+
+SCENARIOS = ['now', 'now-exchange', 'history', 'dates']
+
+def random_date(days: int) -> datetime:
+    now = datetime.now(timezone.utc).replace(minute = 0, second = 0, microsecond = 0)
+    return now - timedelta(hours = random.randrange(24 * 7, 24 * days))
+
+def make_request(scenario: str, args) -> tuple[str, str, dict]:
+    '''
+    Return the method, path and keyword arguments of a request for the scenario.
+    '''
+    result = None
+
+    match scenario:
+        case 'now':
+            result = ('GET', f'/api/now/{args.currency}', {})
+
+        case 'now-exchange':
+            result = ('GET', f'/api/now/{args.currency}/{args.exchange}', {})
+
+        case 'history':
+            start = random_date(args.days)
+            result = ('GET', f'/api/history/{args.currency}/{args.exchange}', {'params': {
+                'start':    start.isoformat(),
+                'end':      (start + timedelta(days = 7)).isoformat(),
+                }})
+
+        case 'dates':
+            dates = [random_date(args.days).replace(tzinfo = None).isoformat() for _ in range(args.dates)]
+            result = ('POST', f'/api/history/{args.currency}', {
+                'params':   {'exchange': args.exchange},
+                'json':     dates,
+                })
+
+    return result
+
+async def run(scenario: str, args) -> dict:
+    latencies = []
+    errors = 0
+    remaining = args.requests
+
+    async def client(session: aiohttp.ClientSession):
+        nonlocal errors, remaining
+
+        while remaining > 0:
+            remaining -= 1
+            method, path, kwargs = make_request(scenario, args)
+
+            began = time.perf_counter()
+            try:
+                async with session.request(method, args.url + path, **kwargs) as response:
+                    await response.read()
+                    if response.status != 200: errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - began)
+
+    timeout = aiohttp.ClientTimeout(total = args.timeout)
+    async with aiohttp.ClientSession(timeout = timeout, connector = aiohttp.TCPConnector(limit = args.concurrency)) as session:
+        began = time.perf_counter()
+        await asyncio.gather(*[client(session) for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - began
+
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1e3
+
+    return {
+            'scenario':     scenario,
+            'requests':     len(latencies),
+            'errors':       errors,
+            'rps':          len(latencies) / elapsed,
+            'p50':          p50,
+            'p90':          p90,
+            'p99':          p99,
+            'max':          max(latencies) * 1e3,
+            }
+
+async def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default = 'http://127.0.0.1:5000')
+    parser.add_argument('--scenarios', default = ','.join(SCENARIOS), help = 'Comma separated scenarios.')
+    parser.add_argument('--concurrency', type = int, default = 50)
+    parser.add_argument('--requests', type = int, default = 1000, help = 'Requests per scenario.')
+    parser.add_argument('--currency', default = 'USD')
+    parser.add_argument('--exchange', default = 'replay')
+    parser.add_argument('--days', type = int, default = 365, help = 'History scenarios pick periods from this many days ago until a week ago.')
+    parser.add_argument('--dates', type = int, default = 50, help = 'Dates per request in the dates scenario.')
+    parser.add_argument('--timeout', type = float, default = 60, help = 'Seconds before a request fails.')
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(',')
+    for scenario in scenarios:
+        if scenario not in SCENARIOS: parser.error(f'unknown scenario: {scenario}')
+
+    print(f'{args.concurrency} clients, {args.requests} requests per scenario against {args.url}')
+    print(f'{"scenario":<14}{"requests":>10}{"errors":>8}{"req/s":>10}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+
+    for scenario in scenarios:
+        r = await run(scenario, args)
+        print(f'{r["scenario"]:<14}{r["requests"]:>10}{r["errors"]:>8}{r["rps"]:>10.1f}'
+                f'{r["p50"]:>10.1f}{r["p90"]:>10.1f}{r["p99"]:>10.1f}{r["max"]:>10.1f}')
+
+if __name__ == '__main__':
+    asyncio.run(main())
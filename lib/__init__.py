@@ -6,7 +6,32 @@ class Network(enum.Enum):
     REGTEST = 'regtest'
     
 from pydantic import BaseModel, validator
-from datetime import datetime
+from datetime import datetime, timezone
+from typing import NamedTuple
+
+# Exchange data is sometimes returned as epoch milliseconds.
+# Epoch seconds don't reach 1e11 until the year 5138.
+def is_ms(timestamp) -> bool: return abs(timestamp) >= 1e11
+
+class RawCandle(NamedTuple):
+    '''
+    The candle that Spotbit passes around internally. It is built without validation from ccxt's OHLCV lists.
+    Candle is the public schema.
+    '''
+    timestamp   : int       # epoch milliseconds.
+    open        : float
+    high        : float
+    low         : float
+    close       : float
+    volume      : float
+
+    def to_dict(self) -> dict:
+        '''
+        Return the candle as a dict that serialises to the same JSON as Candle.
+        '''
+        result = self._asdict()
+        result['timestamp'] = datetime.fromtimestamp(self.timestamp // 1000, timezone.utc).isoformat()
+        return result
 
 class Candle(BaseModel):
     timestamp   : datetime
@@ -16,7 +41,7 @@ class Candle(BaseModel):
     close       : float
     volume      : float
 
-    @validator('timestamp')
+    @validator('timestamp', pre = True)
     def time_in_seconds(cls, v):
         result = v
 
@@ -0,0 +1,106 @@
+'''
+Aggregation of candles from several exchanges into one candle.
+
+The candles are packed into one array so that each aggregate is computed for
+every component at once.
+'''
+
+import enum
+
+import numpy as np
+
+from lib import RawCandle
+
+class Aggregation(str, enum.Enum):
+    MEAN    = 'mean'
+    MEDIAN  = 'median'
+    VWAP    = 'vwap'        # Prices weighted by each exchange's volume. Exchanges without volume are skipped unless none have any.
+    TRIMMED = 'trimmed'     # Mean without the highest and lowest TRIM of each component.
+    MAD     = 'mad'         # Mean of the exchanges whose close is within MAD_LIMIT median absolute deviations of the median close.
+
+TRIM        = 0.2
+MAD_LIMIT   = 3
+
+# Scales the median absolute deviation to estimate the standard deviation of normally distributed prices.
+_MAD_SCALE  = 1.4826
+
+def pack(candles: list[RawCandle]) -> np.ndarray:
+    '''
+    Return an (n, 5) array of the open, high, low, close and volume of the candles.
+    '''
+    return np.array([(c.open, c.high, c.low, c.close, c.volume) for c in candles], dtype = np.float64)
+
+def aggregate_grid(values: np.ndarray, aggregation: Aggregation) -> np.ndarray:
+    '''
+    Aggregate an (n, t, 5) array of open, high, low, close and volume from n
+    exchanges at t timestamps into a (t, 5) array. NaN marks a missing candle
+    and every timestamp must have at least one candle.
+    '''
+    assert values.shape[0]
+
+    result = None
+
+    present = ~np.isnan(values[..., 3])
+    count = present.sum(axis = 0)
+    assert count.all()
+
+    match aggregation:
+        case Aggregation.MEAN:
+            result = np.nanmean(values, axis = 0)
+
+        case Aggregation.MEDIAN:
+            result = np.nanmedian(values, axis = 0)
+
+        case Aggregation.VWAP:
+            # Candles that are made from a ticker have no volume, so they have no weight. 
+            # Where no exchange has volume, e.g. when every price is from a ticker, the prices are the mean.
+            volume = np.where(present, np.nan_to_num(values[..., 4]), 0)
+            total = volume.sum(axis = 0)
+            result = np.nanmean(values, axis = 0)
+
+            weighted = np.nansum(values[..., :4] * volume[..., np.newaxis], axis = 0)
+            weighted = weighted / np.where(total > 0, total, 1)[:, np.newaxis]
+            result[:, :4] = np.where((total > 0)[:, np.newaxis], weighted, result[:, :4])
+
+        case Aggregation.TRIMMED:
+            # NaN is sorted last so the candles at each timestamp are ranked 0 .. count - 1.
+            ranked = np.sort(values, axis = 0)
+            k = (count * TRIM).astype(int)
+            rank = np.arange(len(values))[:, np.newaxis]
+            kept = (rank >= k) & (rank < count - k)
+            result = np.nanmean(np.where(kept[..., np.newaxis], ranked, np.nan), axis = 0)
+
+        case Aggregation.MAD:
+            close = values[..., 3]
+            deviation = np.abs(close - np.nanmedian(close, axis = 0))
+            mad = np.nanmedian(deviation, axis = 0) * _MAD_SCALE
+
+            inliers = (mad == 0) | (deviation <= MAD_LIMIT * mad)
+            result = np.nanmean(np.where(inliers[..., np.newaxis], values, np.nan), axis = 0)
+
+    return result
+
+def aggregate_values(values: np.ndarray, aggregation: Aggregation) -> np.ndarray:
+    '''
+    Aggregate an (n, 5) array of open, high, low, close and volume into one row.
+    '''
+    assert len(values)
+
+    return aggregate_grid(values[:, np.newaxis], aggregation)[0]
+
+def aggregate(candles: list[RawCandle], aggregation: Aggregation = Aggregation.MEAN) -> RawCandle:
+
+    assert candles
+
+    open, high, low, close, volume = aggregate_values(pack(candles), aggregation).tolist()
+
+    result = RawCandle(
+            timestamp   = min(candle.timestamp for candle in candles),
+            open        = open,
+            high        = high,
+            low         = low,
+            close       = close,
+            volume      = volume,
+            )
+
+    return result
@@ -0,0 +1,88 @@
+'''
+Fan-out of live updates to subscribers.
+
+Messages are published to a topic once and appended to the queue of every
+subscriber of the topic. Each queue is bounded: when a subscriber is too slow
+to keep up, its oldest messages are dropped so that publishing never waits
+for any subscriber and one slow client can't hold up the others.
+'''
+
+import asyncio
+from collections import deque
+import logging
+from typing import Hashable
+
+logger = logging.getLogger(__name__)
+
+class Subscription:
+
+    def __init__(self, topic: Hashable, size: int):
+        assert size > 0
+
+        self.topic      = topic
+        self.queue      = deque(maxlen = size)
+        self.dropped    = 0         # Messages that were dropped because the subscriber was too slow.
+
+        self._ready = asyncio.Event()
+
+    def put(self, message):
+        if len(self.queue) == self.queue.maxlen: self.dropped += 1
+        self.queue.append(message)
+        self._ready.set()
+
+    async def get(self) -> list:
+        '''
+        Wait for messages then return every message that is queued.
+        '''
+        await self._ready.wait()
+        self._ready.clear()
+
+        result = list(self.queue)
+        self.queue.clear()
+
+        return result
+
+class Broadcaster:
+
+    def __init__(self, *, size: int):
+        '''
+        size: the number of messages that are queued for each subscriber.
+        '''
+        self.size = size
+        self.subscriptions: dict[Hashable, set[Subscription]] = {}
+
+        self.published = 0
+
+    def subscribe(self, topic: Hashable) -> Subscription:
+        result = Subscription(topic, self.size)
+        self.subscriptions.setdefault(topic, set()).add(result)
+
+        logger.debug(f'{len(self)} subscribers after subscribing to {topic}')
+        return result
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self.subscriptions.get(subscription.topic, set())
+        subscriptions.discard(subscription)
+        if not subscriptions: self.subscriptions.pop(subscription.topic, None)
+
+        if subscription.dropped:
+            logger.debug(f'a subscriber to {subscription.topic} was too slow for {subscription.dropped} messages')
+
+    def topics(self) -> list[Hashable]:
+        return list(self.subscriptions)
+
+    def publish(self, topic: Hashable, message):
+        for subscription in self.subscriptions.get(topic, ()):
+            subscription.put(message)
+        self.published += 1
+
+    def __len__(self) -> int:
+        return sum(len(subscriptions) for subscriptions in self.subscriptions.values())
+
+    def stats(self) -> dict[str, int]:
+        return {
+                'subscribers':  len(self),
+                'topics':       len(self.subscriptions),
+                'published':    self.published,
+                'dropped':      sum(s.dropped for subscriptions in self.subscriptions.values() for s in subscriptions),
+                }
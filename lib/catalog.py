@@ -0,0 +1,127 @@
+'''
+Exchange metadata for processes that don't request exchanges.
+
+The collect process saves a catalog of its exchanges: the metadata that the
+routes read from each exchange, and its pairs in the PairIndex. A serve-only
+process loads the catalog instead of creating ccxt exchanges and loading
+their markets, so it starts without importing ccxt.
+'''
+
+from dataclasses import asdict, dataclass, field
+import json
+import logging
+import os
+import pathlib
+
+from lib.markets import PairIndex, Resolution
+from lib.quirks import LatestPlan
+
+logger = logging.getLogger(__name__)
+
+# Seconds in each unit of a ccxt timeframe.
+_TIMEFRAME_UNITS = {
+        's': 1,
+        'm': 60,
+        'h': 60 * 60,
+        'd': 24 * 60 * 60,
+        'w': 7 * 24 * 60 * 60,
+        'M': 30 * 24 * 60 * 60,
+        'y': 365 * 24 * 60 * 60,
+        }
+
+@dataclass(eq = False)
+class ExchangeInfo:
+    '''
+    The attributes of a ccxt.Exchange that the routes read. Like an exchange, it is hashed by identity.
+    '''
+    id          : str
+    name        : str
+    urls        : dict
+    countries   : list[str]
+    currencies  : dict[str, dict]   = field(default_factory = dict)
+    timeframes  : dict[str, str]    = field(default_factory = dict)
+    has         : dict[str, bool]   = field(default_factory = dict)
+
+    def __str__(self) -> str:
+        return self.name
+
+    @staticmethod
+    def parse_timeframe(timeframe: str) -> int:
+        '''
+        Return the length of the timeframe in seconds, like ccxt.Exchange.parse_timeframe.
+        '''
+        return int(timeframe[:-1]) * _TIMEFRAME_UNITS[timeframe[-1]]
+
+def save(path: pathlib.Path, exchanges: dict, index: PairIndex):
+    '''
+    Save the catalog of the exchanges, which may be ccxt exchanges or ExchangeInfo.
+    '''
+    catalog = {}
+    for id, exchange in exchanges.items():
+        resolutions = {}
+        for currency in index.currencies:
+            resolution = index.resolve(id, currency)
+            if resolution:
+                resolutions[currency] = {
+                        'symbol':       resolution.symbol,
+                        'latest':       asdict(resolution.latest) if resolution.latest else None,
+                        'timeframes':   sorted(resolution.timeframes),
+                        }
+
+        catalog[id] = {
+                'name':         exchange.name,
+                'urls':         {'www': exchange.urls.get('www')},
+                'countries':    exchange.countries or [],
+                # Only the configured currencies are read.
+                'currencies':   {currency: {} for currency in index.currencies if currency in (exchange.currencies or {})},
+                'timeframes':   exchange.timeframes or {},
+                'has':          {name: bool(exchange.has.get(name)) for name in ('fetchOHLCV', 'fetchTicker')},
+                'resolutions':  resolutions,
+                }
+
+    temporary = path.with_suffix('.tmp')
+    temporary.write_text(json.dumps(catalog))
+    os.replace(temporary, path)
+
+def read(path: pathlib.Path) -> dict:
+    '''
+    Return the saved catalog, or an empty dict if there is none. 
+    Only the file is read, so this can be called from any thread.
+    '''
+    result = {}
+
+    try:
+        result = json.loads(path.read_text())
+    except FileNotFoundError:
+        pass
+
+    return result
+
+def load(path: pathlib.Path, index: PairIndex) -> dict[str, ExchangeInfo]:
+    '''
+    Return the exchanges in the catalog by id and set their pairs in the index.
+    Return an empty dict if there is no catalog.
+    '''
+    return build(read(path), index)
+
+def build(catalog: dict, index: PairIndex) -> dict[str, ExchangeInfo]:
+    '''
+    Return the exchanges in a catalog that was read with read() by id and set their pairs in the index.
+    '''
+    result = {}
+
+    for id, entry in catalog.items():
+        resolutions = entry.pop('resolutions')
+        result[id] = ExchangeInfo(id = id, **entry)
+
+        for currency in index.currencies:
+            resolution = resolutions.get(currency)
+            if resolution:
+                latest = resolution['latest']
+                resolution = Resolution(
+                        symbol      = resolution['symbol'],
+                        latest      = LatestPlan(**latest) if latest else None,
+                        timeframes  = frozenset(resolution['timeframes']))
+            index.set(id, currency, resolution)
+
+    return result
@@ -0,0 +1,150 @@
+'''
+Background price collection.
+
+The collector polls every (exchange, currency) pair on a schedule and keeps the
+most recent candles for each pair in a ring buffer so that the /api/now routes
+can be answered from memory instead of fanning out to every exchange.
+'''
+
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+import logging
+import time
+from typing import Awaitable, Callable
+
+from lib import RawCandle
+
+logger = logging.getLogger(__name__)
+
+Pair  = tuple[str, str]     # (exchange id, currency)
+Fetch = Callable[[str, str], Awaitable[RawCandle | None]]
+
+@dataclass
+class Sample:
+    candle      : RawCandle
+    fetched_at  : float     # Unix time at which Spotbit received the candle.
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+class PriceCollector:
+    '''
+    Keep a ring buffer of the latest candles for each (exchange, currency) pair.
+
+    Candles are added by the background task started with start() and by any
+    live request that the routes make when the buffered candle is too old.
+    '''
+
+    def __init__(self, *,
+            fetch:      Fetch,
+            pairs:      Callable[[], list[Pair]],
+            interval:   float,
+            size:       int):
+
+        '''
+        pairs: returns the pairs to poll. It is called every round so that pairs that are added later are polled.
+        '''
+        assert interval > 0
+        assert size > 0
+
+        self.fetch      = fetch
+        self.pairs      = pairs
+        self.interval   = interval
+        self.size       = size
+
+        self.buffers: dict[Pair, deque[Sample]] = {}
+        self._task: asyncio.Task | None = None
+
+        # Called after every pair has been polled, e.g. to publish the new candles.
+        self.on_collect: Callable[[], None] | None = None
+
+    def record(self, exchange: str, currency: str, candle: RawCandle) -> Sample:
+        sample = Sample(candle = candle, fetched_at = time.time())
+        self.add(exchange, currency, sample)
+
+        return sample
+
+    def add(self, exchange: str, currency: str, sample: Sample) -> bool:
+        '''
+        Add a sample that was fetched elsewhere, e.g. by another worker. Return False if it isn't newer than the latest sample.
+        '''
+        result = False
+
+        buffer = self.buffers.get((exchange, currency))
+        if buffer is None:
+            buffer = self.buffers[(exchange, currency)] = deque(maxlen = self.size)
+        if not buffer or sample.fetched_at > buffer[-1].fetched_at:
+            buffer.append(sample)
+            result = True
+
+        return result
+
+    def latest(self, exchange: str, currency: str) -> Sample | None:
+        result = None
+
+        buffer = self.buffers.get((exchange, currency))
+        if buffer: result = buffer[-1]
+
+        return result
+
+    def fresh(self, exchange: str, currency: str, limit: float) -> Sample | None:
+        '''
+        Return the latest sample for the pair if it is at most limit seconds old.
+        '''
+        result = self.latest(exchange, currency)
+        if result and result.age > limit: result = None
+
+        return result
+
+    async def collect(self) -> int:
+        '''
+        Poll every pair once. Return the number of pairs.
+        '''
+        pairs = self.pairs()
+
+        async def collect_pair(exchange: str, currency: str):
+            try:
+                candle = await self.fetch(exchange, currency)
+                if candle: self.record(exchange, currency, candle)
+            except Exception as e:
+                logger.error(f'error collecting {currency} from {exchange}: {e}')
+
+        await asyncio.gather(*[collect_pair(exchange, currency)
+            for exchange, currency in pairs])
+
+        if self.on_collect:
+            try:
+                self.on_collect()
+            except Exception as e:
+                logger.error(f'error after collecting: {e}')
+
+        return len(pairs)
+
+    async def run(self):
+        logger.info(f'collecting {len(self.pairs())} pairs every {self.interval} seconds.')
+        while True:
+            started = time.monotonic()
+            n_pairs = await self.collect()
+            elapsed = time.monotonic() - started
+            logger.debug(f'collected {n_pairs} pairs in {elapsed:.3f} seconds.')
+
+            await asyncio.sleep(max(0, self.interval - elapsed))
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self):
+        assert self._task is None
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
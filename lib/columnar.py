@@ -0,0 +1,101 @@
+'''
+Columnar candle data.
+
+Candles are handled as fixed-width columns: an int64 timestamp in epoch
+milliseconds and float64 open, high, low, close and volume. Columns can be
+views of a memory-mapped file of RECORD, so slicing them copies nothing.
+'''
+
+from dataclasses import dataclass
+
+import numpy as np
+
+RECORD = np.dtype([
+    ('timestamp',   '<i8'),
+    ('open',        '<f8'),
+    ('high',        '<f8'),
+    ('low',         '<f8'),
+    ('close',       '<f8'),
+    ('volume',      '<f8'),
+    ])
+
+@dataclass(frozen = True)
+class CandleColumns:
+    '''
+    OHLCV candles as one array per component.
+    '''
+    timestamp   : np.ndarray    # int64 epoch milliseconds.
+    open        : np.ndarray
+    high        : np.ndarray
+    low         : np.ndarray
+    close       : np.ndarray
+    volume      : np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.timestamp)
+
+    def __getitem__(self, index: slice) -> 'CandleColumns':
+        return CandleColumns(*(column[index] for column in self.columns()))
+
+    def columns(self) -> tuple[np.ndarray, ...]:
+        return (self.timestamp, self.open, self.high, self.low, self.close, self.volume)
+
+    def to_dicts(self) -> list[dict]:
+        '''
+        Return the candles as dicts that serialise to the same JSON as lib.Candle.
+        '''
+        timestamps = np.datetime_as_string(self.timestamp.astype('datetime64[ms]'), unit = 's')
+
+        columns = [[f'{t}+00:00' for t in timestamps.tolist()]]
+        for column in self.columns()[1:]:
+            values = column.tolist()
+            if np.isnan(column).any():
+                values = [None if v != v else v for v in values]
+            columns.append(values)
+
+        return [dict(zip(RECORD.names, row)) for row in zip(*columns)]
+
+    @classmethod
+    def from_records(cls, records: np.ndarray) -> 'CandleColumns':
+        '''
+        Make columns that are views of an array of RECORD.
+        '''
+        return cls(*(records[name] for name in RECORD.names))
+
+    @classmethod
+    def from_rows(cls, rows: list) -> 'CandleColumns':
+        '''
+        Make columns from (timestamp, open, high, low, close, volume) rows e.g. ccxt OHLCV candles.
+        '''
+        return cls.from_records(to_records(rows))
+
+def to_records(rows: list) -> np.ndarray:
+    values = np.empty((0, 6))
+    if len(rows):
+        values = np.asarray(rows, dtype = np.float64).reshape(len(rows), -1)[:, :6]
+
+    result = np.empty(len(values), dtype = RECORD)
+    result['timestamp'] = values[:, 0]
+    for i, name in enumerate(RECORD.names[1:], start = 1):
+        result[name] = values[:, i]
+
+    return result
+
+def align(candles: list[CandleColumns], grid: np.ndarray) -> np.ndarray:
+    '''
+    Join candles onto a sorted grid of timestamps.
+
+    Return an (len(candles), len(grid), 5) array of open, high, low, close and
+    volume, with NaN where a set of candles has no candle at a timestamp.
+    Candles whose timestamps are not on the grid are dropped.
+    '''
+    result = np.full((len(candles), len(grid), 5), np.nan)
+
+    for i, columns in enumerate(candles):
+        if not len(columns) or not len(grid): continue
+
+        index = np.minimum(np.searchsorted(grid, columns.timestamp), len(grid) - 1)
+        on_grid = grid[index] == columns.timestamp
+        result[i, index[on_grid]] = np.column_stack(columns.columns()[1:])[on_grid]
+
+    return result
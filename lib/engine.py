@@ -0,0 +1,368 @@
+'''
+Exchange engines.
+
+An engine makes the ccxt requests for the server. The server keeps one
+synchronous ccxt.Exchange per exchange for metadata (markets, currencies,
+timeframes etc.) and passes it to the engine to identify the exchange.
+
+    ThreadedEngine: Calls the synchronous ccxt library in the threads of the
+                    request's workload class. A ccxt.Exchange isn't 
+                    thread-safe, so each request checks out an instance of 
+                    the exchange from an InstancePool.
+    AsyncEngine:    Uses ccxt.async_support instances that share one aiohttp
+                    session, so that requests run as coroutines on the event
+                    loop and concurrency is bounded by sockets instead of threads.
+
+Every request is queued through the RateLimitScheduler, so ccxt's own
+per-instance rate limiting is turned off. A request takes its token just
+before ccxt is called, once it has an instance and a thread, so that the
+rate limit spaces out the calls that reach the exchange. Identical candle and ticker requests
+that are in flight at the same time are coalesced into one request. The
+outcome of every request is recorded in the HealthRegistry, and requests to
+an exchange whose circuit is open fail immediately with CircuitOpen.
+'''
+
+import asyncio
+from contextlib import asynccontextmanager
+import functools
+import logging
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+import ccxt
+import requests
+
+from lib import metrics
+from lib.health import HealthRegistry
+from lib.ratelimit import RateLimitScheduler
+from lib.singleflight import SingleFlight
+from lib.workloads import Workload
+
+logger = logging.getLogger(__name__)
+
+class CircuitOpen(ccxt.ExchangeNotAvailable):
+    '''
+    The exchange is skipped because its circuit is open. Ref. lib.health.
+    '''
+    pass
+
+class Engine:
+
+    def __init__(self, exchanges: dict[str, ccxt.Exchange], *, 
+            scheduler:  RateLimitScheduler,
+            health:     HealthRegistry,
+            workloads:  dict[str, Workload]):
+        self.exchanges = exchanges
+        self.scheduler = scheduler
+        self.health    = health
+        self.workloads = workloads
+        self.flights   = SingleFlight()
+
+        for exchange in exchanges.values():
+            exchange.enableRateLimit = False
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def set_markets(self, exchange: ccxt.Exchange):
+        '''
+        Called after the exchange's markets have been set without the engine, e.g. from the MarketCache.
+        '''
+        pass
+
+    async def request(self, exchange: ccxt.Exchange, make_request: Callable[[Callable[[], None]], Awaitable[Any]], method: str) -> Any:
+        '''
+        Make the request and record its outcome.
+        make_request is passed a function that it calls once it has taken its rate limit token, just before it calls ccxt.
+        The request is timed from then.
+        '''
+        if not self.health.allow(exchange.id):
+            raise CircuitOpen(f'{exchange.id} is failing and is skipped until its circuit is probed.')
+
+        began = None
+        def started():
+            nonlocal began
+            began = time.perf_counter()
+
+        def elapsed() -> float:
+            return time.perf_counter() - began if began else 0.0
+
+        try:
+            result = await make_request(started)
+        except (ccxt.errors.RateLimitExceeded, ccxt.errors.DDoSProtection):
+            metrics.EXCHANGE_ERRORS.labels(exchange.id, 'rate_limit').inc()
+            self.scheduler.rate_limited(exchange)
+            raise
+        except Exception as e:
+            metrics.EXCHANGE_ERRORS.labels(exchange.id, type(e).__name__).inc()
+            self.health.failed(exchange.id, e, elapsed())
+            raise
+        finally:
+            if began: metrics.EXCHANGE_REQUEST_SECONDS.labels(exchange.id, method).observe(elapsed())
+
+        self.scheduler.succeeded(exchange)
+        self.health.succeeded(exchange.id, elapsed())
+        return result
+
+    async def fetch_ohlcv(self, exchange: ccxt.Exchange, *,
+            symbol:     str,
+            timeframe:  str,
+            since:      int | None = None,
+            limit:      int | None = None,
+            params:     dict | None = None,
+            workload:   str = 'latest') -> list[list]:
+        '''
+        workload: the class of work that the request is made for. Ref. lib.workloads.
+        '''
+        params = params or {}
+        key = (exchange.id, 'ohlcv', symbol, timeframe, since, limit, repr(params))
+
+        return await self.flights.do(key, lambda: self._fetch_ohlcv(exchange,
+            symbol      = symbol,
+            timeframe   = timeframe,
+            since       = since,
+            limit       = limit,
+            params      = params,
+            workload    = workload))
+
+    async def fetch_ticker(self, exchange: ccxt.Exchange, symbol: str) -> dict:
+        key = (exchange.id, 'ticker', symbol)
+        return await self.flights.do(key, lambda: self._fetch_ticker(exchange, symbol))
+
+# The attributes that ccxt.Exchange.set_markets sets. Pooled instances share them with the exchange instead of copying them.
+MARKET_ATTRIBUTES = ['markets', 'markets_by_id', 'symbols', 'ids', 
+        'currencies', 'currencies_by_id', 'codes', 'baseCurrencies', 'quoteCurrencies']
+
+# Hosts that each pooled instance keeps connections to. An instance makes one request at a time, so one connection per host is enough.
+HOSTS_PER_INSTANCE = 4
+
+class InstancePool:
+    '''
+    Instances of one exchange for the threaded engine.
+
+    Instances are created as they are needed, up to size, and share the
+    exchange's loaded markets. Each instance has its own requests session, 
+    so it keeps its connections alive from one request to the next.
+
+    The exchange's markets are set attribute by attribute, possibly in a 
+    thread, so instances don't read them from the exchange. They are given
+    the snapshot that set_markets takes once the markets have been set.
+    '''
+
+    def __init__(self, exchange: ccxt.Exchange, size: int):
+        assert size > 0
+
+        self.exchange   = exchange
+        self.size       = size
+        self.instances: list[ccxt.Exchange] = []
+        self.idle: asyncio.Queue[ccxt.Exchange] = asyncio.Queue()
+
+        self.markets: dict[str, Any] = {}
+        self.version = 0                        # Incremented with each snapshot of the markets.
+        self.versions: dict[int, int] = {}      # The version of the markets that each instance has, by id(instance).
+        self.set_markets()
+
+    def set_markets(self):
+        '''
+        Take a snapshot of the exchange's markets for the instances. Call it after the markets have been set, not while they are being set.
+        '''
+        self.markets = {name: getattr(self.exchange, name) for name in MARKET_ATTRIBUTES}
+        self.version += 1
+
+    def _create(self) -> ccxt.Exchange:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+                pool_connections    = HOSTS_PER_INSTANCE,
+                pool_maxsize        = 1,
+                max_retries         = 0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        config = {
+                'session':          session,
+                'enableRateLimit':  False,
+                }
+        # Exchanges that aren't in ccxt, e.g. lib.replay, make their own instances.
+        if hasattr(self.exchange, 'sync_exchange'):
+            result = self.exchange.sync_exchange(config)
+        else:
+            result = type(self.exchange)(config)
+        session.trust_env = result.requests_trust_env
+
+        self.instances.append(result)
+        logger.debug(f'{len(self.instances)} instances of {self.exchange}')
+
+        return result
+
+    @asynccontextmanager
+    async def checkout(self) -> AsyncIterator[ccxt.Exchange]:
+        '''
+        Wait for an idle instance, or create one, for the duration of a request.
+        '''
+        if self.idle.empty() and len(self.instances) < self.size:
+            instance = self._create()
+        else:
+            instance = await self.idle.get()
+
+        if self.versions.get(id(instance)) != self.version:
+            for name, value in self.markets.items():
+                setattr(instance, name, value)
+            self.versions[id(instance)] = self.version
+
+        try:
+            yield instance
+        finally:
+            self.idle.put_nowait(instance)
+
+    def close(self):
+        for instance in self.instances:
+            instance.session.close()
+
+class ThreadedEngine(Engine):
+
+    def __init__(self, exchanges: dict[str, ccxt.Exchange], *, 
+            scheduler:      RateLimitScheduler, 
+            health:         HealthRegistry,
+            workloads:      dict[str, Workload],
+            pool_size:      int):
+        super().__init__(exchanges, scheduler = scheduler, health = health, workloads = workloads)
+        self.pools = {id: InstancePool(exchange, pool_size) for id, exchange in exchanges.items()}
+
+    async def close(self):
+        for pool in self.pools.values():
+            pool.close()
+
+    def set_markets(self, exchange: ccxt.Exchange):
+        self.pools[exchange.id].set_markets()
+
+    def _after_turn(self, exchange: ccxt.Exchange, started: Callable[[], None], function: Callable, *args) -> Callable[[], Any]:
+        '''
+        Return a call for a worker thread that waits for the exchange's rate limit then calls the function.
+        '''
+        loop = asyncio.get_running_loop()
+
+        def call():
+            asyncio.run_coroutine_threadsafe(self.scheduler.acquire(exchange), loop).result()
+            started()
+            return function(*args)
+
+        return call
+
+    async def _call(self, exchange: ccxt.Exchange, workload: str, method: str, *args, **kwargs) -> Any:
+
+        async def make_request(started: Callable[[], None]) -> Any:
+            async with self.pools[exchange.id].checkout() as instance:
+                call = functools.partial(getattr(instance, method), *args, **kwargs)
+                return await self.workloads[workload].run(self._after_turn(exchange, started, call))
+
+        return await self.request(exchange, make_request, method)
+
+    async def load_markets(self, exchange: ccxt.Exchange, reload: bool = False, timeout: float | None = None) -> dict:
+        # Markets are loaded into the exchange itself, which pooled instances share.
+        # The timeout starts when a thread picks the load up, so loads that are waiting for a thread don't time out.
+        # It includes the load's turn under the rate limit, which is taken in the thread.
+        metadata = self.workloads['metadata']
+
+        def make_request(started: Callable[[], None]) -> Awaitable[dict]:
+            call = self._after_turn(exchange, started, exchange.load_markets, reload)
+            return metadata.run(call) if timeout is None else metadata.run_with_timeout(timeout, call)
+
+        result = await self.request(exchange, make_request, 'load_markets')
+        self.set_markets(exchange)
+
+        return result
+
+    async def _fetch_ohlcv(self, exchange: ccxt.Exchange, *, workload: str, **kwargs) -> list[list]:
+        return await self._call(exchange, workload, 'fetch_ohlcv', **kwargs)
+
+    async def _fetch_ticker(self, exchange: ccxt.Exchange, symbol: str) -> dict:
+        return await self._call(exchange, 'latest', 'fetch_ticker', symbol)
+
+class AsyncEngine(Engine):
+
+    def __init__(self, exchanges: dict[str, ccxt.Exchange], *, 
+            scheduler:      RateLimitScheduler, 
+            health:         HealthRegistry,
+            workloads:      dict[str, Workload],
+            connections:    int):
+        super().__init__(exchanges, scheduler = scheduler, health = health, workloads = workloads)
+        self.connections = connections
+
+        self.session = None
+        self.instances: dict[str, 'ccxt.async_support.Exchange'] = {}
+
+    async def start(self):
+        '''
+        Create the async exchange instances. This must be done on the running event loop.
+        '''
+        import aiohttp
+        import ccxt.async_support
+
+        self.session = aiohttp.ClientSession(
+                connector = aiohttp.TCPConnector(
+                    limit                   = self.connections,
+                    ttl_dns_cache           = 300,
+                    enable_cleanup_closed   = True))
+
+        for id, exchange in self.exchanges.items():
+            config = {
+                'session':          self.session,
+                'enableRateLimit':  False,
+                }
+            # Exchanges that aren't in ccxt, e.g. lib.replay, make their own async instance.
+            if hasattr(exchange, 'async_exchange'):
+                instance = exchange.async_exchange(config)
+            else:
+                instance = getattr(ccxt.async_support, id)(config)
+            if exchange.markets:
+                instance.set_markets(exchange.markets, exchange.currencies)
+            self.instances[id] = instance
+
+        logger.info(f'async engine started with {len(self.instances)} exchanges and {self.connections} connections.')
+
+    async def close(self):
+        for instance in self.instances.values():
+            await instance.close()
+        self.instances = {}
+
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    def set_markets(self, exchange: ccxt.Exchange):
+        instance = self.instances.get(exchange.id)
+        if instance: instance.set_markets(exchange.markets, exchange.currencies)
+
+    async def _after_turn(self, exchange: ccxt.Exchange, started: Callable[[], None], make_call: Callable[[], Awaitable[Any]]) -> Any:
+        '''
+        Wait for the exchange's rate limit then make the call.
+        '''
+        await self.scheduler.acquire(exchange)
+        started()
+        return await make_call()
+
+    async def load_markets(self, exchange: ccxt.Exchange, reload: bool = False, timeout: float | None = None) -> dict:
+        instance = self.instances[exchange.id]
+        result = await self.request(exchange, 
+                lambda started: self._after_turn(exchange, started, lambda: asyncio.wait_for(instance.load_markets(reload), timeout)), 
+                'load_markets')
+
+        # Keep the metadata that the server reads in step with the async instance.
+        if reload or not exchange.markets:
+            exchange.set_markets(instance.markets, instance.currencies)
+
+        return result
+
+    async def _fetch_ohlcv(self, exchange: ccxt.Exchange, *, workload: str, **kwargs) -> list[list]:
+        # Requests are coroutines, so they don't take threads from any workload.
+        instance = self.instances[exchange.id]
+        return await self.request(exchange, 
+                lambda started: self._after_turn(exchange, started, lambda: instance.fetch_ohlcv(**kwargs)), 'fetch_ohlcv')
+
+    async def _fetch_ticker(self, exchange: ccxt.Exchange, symbol: str) -> dict:
+        instance = self.instances[exchange.id]
+        return await self.request(exchange, 
+                lambda started: self._after_turn(exchange, started, lambda: instance.fetch_ticker(symbol)), 'fetch_ticker')
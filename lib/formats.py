@@ -0,0 +1,146 @@
+'''
+Output formats for candles.
+
+Candle responses are encoded straight from CandleColumns, without building a
+lib.Candle for each row. The format is chosen from the request's Accept header:
+
+    application/json                        The default. Made by the routes themselves.
+    application/x-ndjson                    Newline-delimited JSON. Streamed by the history routes.
+    text/csv                                A header row then one row per candle with ISO 8601 timestamps.
+    application/msgpack                     A map of column name to array. Timestamps are epoch milliseconds.
+    application/vnd.apache.arrow.stream     An Arrow IPC stream of one record batch. Timestamps are UTC timestamp[ms].
+    application/vnd.apache.arrow.file       The same record batch in the Arrow IPC file format, which can be read at random.
+
+JSON is serialised with orjson by TrustedJSONResponse.
+MessagePack and Arrow need the optional msgpack and pyarrow packages.
+UnsupportedFormat is raised when the package for a requested format isn't installed.
+'''
+
+import csv
+import io
+
+from fastapi.responses import Response
+import numpy as np
+import orjson
+
+from lib import metrics
+from lib.columnar import RECORD, CandleColumns
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+JSON       = 'application/json'
+NDJSON     = 'application/x-ndjson'
+CSV        = 'text/csv'
+MSGPACK    = 'application/msgpack'
+ARROW      = 'application/vnd.apache.arrow.stream'
+ARROW_FILE = 'application/vnd.apache.arrow.file'
+
+MEDIA_TYPES = [JSON, NDJSON, CSV, MSGPACK, ARROW, ARROW_FILE]
+
+# Other names that clients use for the same formats.
+_ALIASES = {
+        'application/x-msgpack':                MSGPACK,
+        'application/vnd.msgpack':              MSGPACK,
+        }
+
+class UnsupportedFormat(Exception):
+    pass
+
+class TrustedJSONResponse(Response):
+    '''
+    JSON made by orjson from data that Spotbit built itself, e.g. RawCandle.to_dict() or CandleColumns.to_dicts().
+    Returning a response skips FastAPI's validation of the content against the route's response_model.
+    '''
+    media_type = JSON
+
+    def render(self, content) -> bytes:
+        with metrics.timer('serialize'):
+            return orjson.dumps(content, option = orjson.OPT_SERIALIZE_NUMPY)
+
+def negotiate(accept: str | None, media_types: list[str] = MEDIA_TYPES) -> str:
+    '''
+    Return the media type in media_types that the Accept header prefers. JSON is the default.
+    '''
+    result = JSON
+
+    preferences = []
+    for i, part in enumerate((accept or '').split(',')):
+        media_type, *parameters = [p.strip() for p in part.split(';')]
+        media_type = _ALIASES.get(media_type.lower(), media_type.lower())
+
+        q = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition('=')
+            if name.strip() == 'q':
+                try: q = float(value)
+                except ValueError: q = 0.0
+
+        if q > 0 and media_type in media_types:
+            preferences.append((-q, i, media_type))
+
+    if preferences: result = min(preferences)[2]
+
+    return result
+
+def _values(column: np.ndarray) -> list:
+    '''
+    Return the column as a list with None for NaN.
+    '''
+    result = column.tolist()
+    if column.dtype.kind == 'f' and np.isnan(column).any():
+        result = [None if v != v else v for v in result]
+
+    return result
+
+def encode(candles: CandleColumns, media_type: str, extra: dict[str, np.ndarray] | None = None) -> bytes:
+    '''
+    Encode the candles in a binary or CSV format. extra columns, e.g. coverage, are added after volume.
+    '''
+    result = None
+    extra = extra or {}
+
+    names = list(RECORD.names) + list(extra)
+    columns = list(candles.columns()) + list(extra.values())
+
+    match media_type:
+        case 'text/csv':
+            timestamps = np.datetime_as_string(candles.timestamp.astype('datetime64[ms]'), unit = 's')
+            rows = zip([f'{t}+00:00' for t in timestamps.tolist()], *(_values(c) for c in columns[1:]))
+
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator = '\n')
+            writer.writerow(names)
+            writer.writerows(rows)
+            result = buffer.getvalue().encode()
+
+        case 'application/msgpack':
+            if msgpack is None: raise UnsupportedFormat(f'{media_type} needs the msgpack package')
+
+            result = msgpack.packb({name: _values(column) for name, column in zip(names, columns)})
+
+        case 'application/vnd.apache.arrow.stream' | 'application/vnd.apache.arrow.file':
+            if pyarrow is None: raise UnsupportedFormat(f'{media_type} needs the pyarrow package')
+
+            arrays = [pyarrow.array(candles.timestamp, type = pyarrow.timestamp('ms', tz = 'UTC'))]
+            arrays += [pyarrow.array(column, from_pandas = True) for column in columns[1:]]
+            batch = pyarrow.record_batch(arrays, names = names)
+
+            sink = pyarrow.BufferOutputStream()
+            new_writer = pyarrow.ipc.new_stream if media_type == ARROW else pyarrow.ipc.new_file
+            with new_writer(sink, batch.schema) as writer:
+                writer.write_batch(batch)
+            result = sink.getvalue().to_pybytes()
+
+        case _:
+            raise UnsupportedFormat(f'Spotbit can not encode candles as {media_type}')
+
+    return result
@@ -0,0 +1,138 @@
+'''
+Exchange health and circuit breakers.
+
+The engine records the outcome of every exchange request in the health
+registry: successes, failures, an exponentially weighted moving average of
+latency and the last error. Rate-limit errors are handled by the
+RateLimitScheduler and don't count against an exchange's health.
+
+Each exchange has a circuit breaker:
+
+    closed:     Requests are made. After failures consecutive failures the circuit opens.
+    open:       Requests fail immediately until the cooldown has passed. Ref. lib.engine.CircuitOpen.
+    half_open:  One probe request is let through every cooldown. A success closes the
+                circuit. A failure opens it again with the cooldown doubled, up to max_cooldown.
+'''
+
+from dataclasses import dataclass
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class ExchangeHealth:
+    state                   : str   = 'closed'
+    successes               : int   = 0
+    failures                : int   = 0
+    consecutive_failures    : int   = 0
+    latency                 : float | None = None      # EWMA of request latency in seconds.
+    last_error              : str | None = None
+    last_error_at           : float | None = None      # Unix time.
+
+    # Monotonic times for the circuit breaker.
+    cooldown                : float = 0.0
+    retry_at                : float = 0.0
+
+    @property
+    def success_rate(self) -> float | None:
+        total = self.successes + self.failures
+        return self.successes / total if total else None
+
+class HealthRegistry:
+
+    def __init__(self, *,
+            failures:       int   = 5,
+            cooldown:       float = 60,
+            max_cooldown:   float = 600,
+            alpha:          float = 0.2):
+        '''
+        failures:   consecutive failures that open an exchange's circuit.
+        cooldown:   seconds before the first probe of an open circuit.
+        alpha:      weight of the latest request in the latency EWMA.
+        '''
+        assert failures >= 1
+        assert 0 < alpha <= 1
+
+        self.failures       = failures
+        self.cooldown       = cooldown
+        self.max_cooldown   = max_cooldown
+        self.alpha          = alpha
+
+        self.exchanges: dict[str, ExchangeHealth] = {}
+
+    def health(self, id: str) -> ExchangeHealth:
+        result = self.exchanges.get(id)
+        if result is None:
+            result = self.exchanges[id] = ExchangeHealth()
+
+        return result
+
+    def available(self, id: str) -> bool:
+        '''
+        Return True if a request to the exchange would be made.
+        '''
+        health = self.health(id)
+        return health.state == 'closed' or time.monotonic() >= health.retry_at
+
+    def allow(self, id: str) -> bool:
+        '''
+        Return True if a request to the exchange should be made now. An allowed request to an open circuit is a probe.
+        '''
+        result = True
+
+        health = self.health(id)
+        if health.state != 'closed':
+            now = time.monotonic()
+            result = now >= health.retry_at
+            if result:
+                # Let one probe through then wait for its outcome, or another cooldown if it never comes.
+                health.state = 'half_open'
+                health.retry_at = now + health.cooldown
+                logger.info(f'probing {id}')
+
+        return result
+
+    def succeeded(self, id: str, latency: float):
+        health = self.health(id)
+        health.successes += 1
+        health.consecutive_failures = 0
+        health.latency = latency if health.latency is None else (
+                self.alpha * latency + (1 - self.alpha) * health.latency)
+
+        if health.state != 'closed':
+            logger.info(f'{id} has recovered. Closing its circuit.')
+            health.state = 'closed'
+            health.cooldown = 0.0
+
+    def failed(self, id: str, error: Exception, latency: float):
+        health = self.health(id)
+        health.failures += 1
+        health.consecutive_failures += 1
+        health.last_error = f'{type(error).__name__}: {error}'
+        health.last_error_at = time.time()
+        health.latency = latency if health.latency is None else (
+                self.alpha * latency + (1 - self.alpha) * health.latency)
+
+        if health.state == 'half_open' or (
+                health.state == 'closed' and health.consecutive_failures >= self.failures):
+            health.cooldown = min(max(health.cooldown * 2, self.cooldown), self.max_cooldown)
+            health.retry_at = time.monotonic() + health.cooldown
+            health.state = 'open'
+            logger.error(f'{id} has failed {health.consecutive_failures} times in a row. '
+                    f'Skipping it for {health.cooldown:.0f} seconds. Last error: {health.last_error}')
+
+    def snapshot(self) -> dict[str, dict]:
+        now = time.monotonic()
+
+        return {id: {
+            'state':                health.state,
+            'successes':            health.successes,
+            'failures':             health.failures,
+            'success_rate':         health.success_rate,
+            'consecutive_failures': health.consecutive_failures,
+            'latency':              health.latency,
+            'last_error':           health.last_error,
+            'last_error_at':        health.last_error_at,
+            'retry_in':             max(0.0, health.retry_at - now) if health.state != 'closed' else None,
+            } for id, health in self.exchanges.items()}
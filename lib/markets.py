@@ -0,0 +1,280 @@
+'''
+Exchange market loading.
+
+Markets are loaded for all exchanges concurrently, each with a timeout, and
+saved to an on-disk cache. When the server restarts it warms every exchange
+from the cache immediately and refreshes the markets that are older than the
+cache's time-to-live in the background.
+
+Whenever an exchange's markets are loaded, the PairIndex is updated with the
+BTC pair that Spotbit uses for each configured currency on that exchange.
+'''
+
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+import json
+import logging
+import os
+import pathlib
+import time
+from typing import TYPE_CHECKING
+
+# Exchanges only appear in annotations. Serve-only processes fill the PairIndex from the catalog, without ccxt. Ref. lib.catalog.
+if TYPE_CHECKING:
+    import ccxt
+
+from lib import metrics
+from lib.quirks import LatestPlan, plan_latest
+
+logger = logging.getLogger(__name__)
+
+class MarketCache:
+
+    def __init__(self, directory: pathlib.Path, ttl: float):
+        self.directory = directory
+        self.directory.mkdir(parents = True, exist_ok = True)
+        self.ttl = ttl
+
+    def _path(self, exchange: ccxt.Exchange) -> pathlib.Path:
+        return self.directory / f'{exchange.id}.json'
+
+    def modified(self, exchange: ccxt.Exchange) -> float | None:
+        '''
+        Return the Unix time at which the exchange's markets were saved, or None if they are not cached.
+        '''
+        result = None
+
+        try:
+            result = self._path(exchange).stat().st_mtime
+        except FileNotFoundError:
+            pass
+
+        return result
+
+    def age(self, exchange: ccxt.Exchange) -> float | None:
+        '''
+        Return the number of seconds since the exchange's markets were saved, or None if they are not cached.
+        '''
+        result = None
+
+        modified = self.modified(exchange)
+        if modified is not None: result = time.time() - modified
+
+        return result
+
+    def read(self, exchange: ccxt.Exchange) -> dict | None:
+        '''
+        Return the exchange's cached markets, or None if they are not cached. 
+        Only the cache is read, so this can be called from any thread.
+        '''
+        result = None
+
+        try:
+            result = json.loads(self._path(exchange).read_text())
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f'error reading cached markets for {exchange}: {e}')
+
+        return result
+
+    def set(self, exchange: ccxt.Exchange, cached: dict) -> bool:
+        '''
+        Set the exchange's markets and currencies from markets that were read from the cache. Return False if they are invalid.
+        '''
+        result = False
+
+        try:
+            exchange.set_markets(cached['markets'], cached['currencies'])
+            result = True
+        except Exception as e:
+            logger.error(f'error setting cached markets for {exchange}: {e}')
+
+        return result
+
+    def load(self, exchange: ccxt.Exchange) -> bool:
+        '''
+        Set the exchange's markets and currencies from the cache. Return False if they are not cached.
+        '''
+        cached = self.read(exchange)
+        result = cached is not None and self.set(exchange, cached)
+
+        metrics.cache('markets', result)
+        return result
+
+    def save(self, exchange: ccxt.Exchange):
+        assert exchange.markets
+
+        path = self._path(exchange)
+        temporary = path.with_suffix('.tmp')
+        temporary.write_text(json.dumps({
+            'markets':      list(exchange.markets.values()),
+            'currencies':   exchange.currencies,
+            }, default = str))
+        os.replace(temporary, path)
+
+@dataclass(frozen = True)
+class Resolution:
+    '''
+    How Spotbit requests a currency from an exchange.
+    '''
+    symbol      : str
+    latest      : LatestPlan | None     # How to request the latest price.
+    timeframes  : frozenset[str]
+
+def find_symbol(exchange: ccxt.Exchange, currency: str) -> str:
+    '''
+    Return the symbol of the exchange's BTC market for the currency, or '' if it doesn't have one.
+    '''
+    result = ''
+
+    candidates = [
+            f'BTC{currency}', 
+            f'BTC/{currency}',
+            f'XBT{currency}', 
+            f'XBT/{currency}', 
+            f'BTC{currency}'.lower(), 
+            f'XBT{currency}'.lower()]
+
+    for candidate in candidates:
+        if candidate in exchange.markets_by_id:
+            market = exchange.markets_by_id[candidate]
+            # Newer versions of ccxt map each id to a list of markets.
+            if isinstance(market, list): market = market[0]
+            result = market['symbol']
+            break
+
+        if candidate in exchange.markets:
+            result = exchange.markets[candidate]['symbol']
+            break
+
+    return result
+
+class PairIndex:
+    '''
+    Map (exchange id, currency) to the Resolution for that pair.
+    '''
+
+    def __init__(self, currencies: list[str]):
+        self.currencies = currencies
+        self.resolutions: dict[tuple[str, str], Resolution] = {}
+        self.exchanges: dict[str, list[str]] = {currency: [] for currency in currencies}
+
+        self.version = 0    # Incremented whenever the index changes.
+
+    def build(self, exchange: ccxt.Exchange):
+        '''
+        Update the index from the exchange's loaded markets.
+        '''
+        for currency in self.currencies:
+            resolution = None
+
+            if exchange.markets and currency in (exchange.currencies or {}):
+                symbol = find_symbol(exchange, currency)
+                if symbol:
+                    resolution = Resolution(
+                            symbol      = symbol,
+                            latest      = plan_latest(exchange),
+                            timeframes  = frozenset(exchange.timeframes or ()))
+
+            self.set(exchange.id, currency, resolution)
+
+        logger.debug(f'{exchange} supports {[c for c in self.currencies if (exchange.id, c) in self.resolutions]}')
+
+    def set(self, exchange_id: str, currency: str, resolution: Resolution | None):
+        key = (exchange_id, currency)
+        if resolution:
+            self.resolutions[key] = resolution
+        else:
+            self.resolutions.pop(key, None)
+
+        exchanges = [id for id in self.exchanges[currency] if id != exchange_id]
+        if resolution: exchanges.append(exchange_id)
+        self.exchanges[currency] = exchanges
+
+        self.version += 1
+
+    def resolve(self, exchange_id: str, currency: str) -> Resolution | None:
+        return self.resolutions.get((exchange_id, currency))
+
+    def exchanges_for(self, currency: str) -> list[str]:
+        '''
+        Return the ids of the exchanges that have a BTC market for the currency.
+        '''
+        return self.exchanges.get(currency, [])
+
+    def pairs(self) -> list[tuple[str, str]]:
+        return list(self.resolutions)
+
+# Seconds before the markets of an exchange that failed to load are requested again, doubling up to MAX_RETRY_BACKOFF.
+RETRY_BACKOFF       = 30
+MAX_RETRY_BACKOFF   = 30 * 60
+
+async def load_markets(exchanges: list[ccxt.Exchange], *,
+        engine,
+        cache: MarketCache,
+        index: PairIndex,
+        timeout: float,
+        reload: bool = False) -> list[ccxt.Exchange]:
+    '''
+    Load the markets of the exchanges concurrently and save them in the cache.
+    Return the exchanges whose markets could not be loaded within the timeout.
+    The timeout is for the request to each exchange, not the time that it waits for a thread.
+    '''
+
+    async def load(exchange: ccxt.Exchange) -> bool:
+        result = False
+        try:
+            await engine.load_markets(exchange, reload = reload, timeout = timeout)
+            await engine.workloads['metadata'].run(cache.save, exchange)
+            index.build(exchange)
+            result = True
+        except asyncio.TimeoutError:
+            logger.error(f'timed out loading markets for {exchange} after {timeout} seconds.')
+        except Exception as e:
+            logger.error(f'error loading markets for {exchange}: {e}')
+
+        return result
+
+    loaded = await asyncio.gather(*[load(exchange) for exchange in exchanges])
+    result = [exchange for exchange, ok in zip(exchanges, loaded) if not ok]
+
+    return result
+
+async def refresh_markets(exchanges: list[ccxt.Exchange], *,
+        engine,
+        cache: MarketCache,
+        index: PairIndex,
+        timeout: float):
+    '''
+    Reload the markets of each exchange when its cached markets expire.
+    Exchanges whose markets failed to load are retried after RETRY_BACKOFF seconds, doubling while they keep failing.
+    '''
+    backoff = RETRY_BACKOFF
+    while True:
+        ages = [cache.age(exchange) for exchange in exchanges]
+        expired = [exchange for exchange, age in zip(exchanges, ages)
+                if age is None or age >= cache.ttl]
+
+        failed = []
+        if expired:
+            logger.info(f'refreshing markets for {len(expired)} exchanges.')
+            failed = await load_markets(expired, 
+                    engine  = engine, 
+                    cache   = cache, 
+                    index   = index, 
+                    timeout = timeout, 
+                    reload  = True)
+
+        ages = [cache.age(exchange) for exchange in exchanges if exchange not in failed]
+        next_expiry = min((cache.ttl - age for age in ages if age is not None), default = cache.ttl)
+        if failed:
+            logger.info(f'retrying markets for {len(failed)} exchanges in {backoff} seconds.')
+            next_expiry = min(next_expiry, backoff)
+            backoff = min(backoff * 2, MAX_RETRY_BACKOFF)
+        else:
+            backoff = RETRY_BACKOFF
+
+        await asyncio.sleep(max(next_expiry, 1))
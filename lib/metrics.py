@@ -0,0 +1,111 @@
+'''
+Prometheus metrics.
+
+Every metric is a no-op until enable() is called, so the instrumentation in
+the request path costs a method call when metrics are turned off. Metrics
+are read through the module, e.g. metrics.EXCHANGE_ERRORS, because enable()
+replaces them.
+
+    spotbit_exchange_request_seconds{exchange, method}  Latency of each exchange request.
+    spotbit_exchange_errors_total{exchange, error}      Failed exchange requests. error is rate_limit or the exception's name.
+    spotbit_history_retries_total{exchange}             History requests that are retried after the exchange rate limited Spotbit.
+    spotbit_thread_queue_depth{workload}                Calls waiting for a thread of each workload class. Ref. lib.workloads.
+    spotbit_cache_requests_total{cache, result}         Hits and misses of the collector, candle store, market cache and request coalescing.
+    spotbit_stage_seconds{stage}                        Time spent in aggregation and serialization.
+    spotbit_route_seconds{method, route, status}        Time to answer each route.
+
+prometheus_client is optional. Metrics stay turned off if it isn't installed.
+'''
+
+from contextlib import contextmanager, nullcontext
+import logging
+import time
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+class _Noop:
+
+    def labels(self, *args, **kwargs) -> '_Noop':
+        return self
+
+    def inc(self, amount: float = 1): pass
+    def dec(self, amount: float = 1): pass
+    def set(self, value: float): pass
+    def observe(self, value: float): pass
+
+_NOOP = _Noop()
+
+enabled = False
+
+EXCHANGE_REQUEST_SECONDS    = _NOOP
+EXCHANGE_ERRORS             = _NOOP
+HISTORY_RETRIES             = _NOOP
+THREAD_QUEUE_DEPTH          = _NOOP
+CACHE_REQUESTS              = _NOOP
+STAGE_SECONDS               = _NOOP
+ROUTE_SECONDS               = _NOOP
+
+def enable() -> bool:
+    '''
+    Create the metrics. Return False if prometheus_client isn't installed.
+    '''
+    global enabled
+    global EXCHANGE_REQUEST_SECONDS, EXCHANGE_ERRORS, HISTORY_RETRIES, THREAD_QUEUE_DEPTH
+    global CACHE_REQUESTS, STAGE_SECONDS, ROUTE_SECONDS
+
+    if enabled: return True
+
+    if prometheus_client is None:
+        logger.error('metrics are turned off because prometheus_client is not installed. /metrics will answer 501 Not Implemented.')
+        return False
+
+    from prometheus_client import Counter, Gauge, Histogram
+
+    EXCHANGE_REQUEST_SECONDS = Histogram('spotbit_exchange_request_seconds',
+            'Latency of exchange requests.', ['exchange', 'method'],
+            buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+    EXCHANGE_ERRORS = Counter('spotbit_exchange_errors_total',
+            'Failed exchange requests.', ['exchange', 'error'])
+    HISTORY_RETRIES = Counter('spotbit_history_retries_total',
+            'History requests retried after the exchange rate limited Spotbit.', ['exchange'])
+    THREAD_QUEUE_DEPTH = Gauge('spotbit_thread_queue_depth',
+            'Calls waiting for a worker thread.', ['workload'])
+    CACHE_REQUESTS = Counter('spotbit_cache_requests_total',
+            'Cache lookups by cache and result (hit or miss).', ['cache', 'result'])
+    STAGE_SECONDS = Histogram('spotbit_stage_seconds',
+            'Time spent in each stage of answering a request.', ['stage'],
+            buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+    ROUTE_SECONDS = Histogram('spotbit_route_seconds',
+            'Time to answer each route.', ['method', 'route', 'status'])
+
+    enabled = True
+    return True
+
+def cache(name: str, hit: bool):
+    CACHE_REQUESTS.labels(name, 'hit' if hit else 'miss').inc()
+
+@contextmanager
+def _timer(stage: str):
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - began)
+
+def timer(stage: str):
+    '''
+    Time the body of a with statement as a stage.
+    '''
+    return _timer(stage) if enabled else nullcontext()
+
+def render() -> tuple[bytes, str]:
+    '''
+    Return the metrics in the Prometheus text format and its content type.
+    '''
+    assert enabled
+    return prometheus_client.generate_latest(), prometheus_client.CONTENT_TYPE_LATEST
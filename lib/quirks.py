@@ -0,0 +1,93 @@
+'''
+Per-exchange quirks and the planner for latest-price requests.
+
+Everything that Spotbit needs to know about a particular exchange's API lives
+in QUIRKS so that request code doesn't need to match on exchange ids.
+
+    timeframe:  The smallest timeframe to use for the latest candle.
+    page_size:  The maximum number of candles the exchange returns per request. Only set where
+                the limit is known; other exchanges are requested DEFAULT_PAGE_SIZE candles at a time.
+    latest:     Override the strategy that plan_latest would choose.
+    end_param:  The name of a parameter that must be set to the end of the requested window.
+'''
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Literal
+
+# LatestPlan is read back from the catalog by serve-only processes, which don't have ccxt, so it's only imported for type checking.
+if TYPE_CHECKING:
+    import ccxt
+
+DEFAULT_TIMEFRAME   = '1m'
+DEFAULT_PAGE_SIZE   = 100     # Small enough for any exchange.
+
+QUIRKS: dict[str, dict] = {
+        'binance':  {'latest': 'limit'},
+        'bitfinex': {'end_param': 'end'},
+        'bitstamp': {'page_size': 1000},
+        'btcalpha': {'timeframe': '1h', 'page_size': 720},
+        'bybit':    {'page_size': 200},
+        'coinbasepro': {'page_size': 300},
+        'eterbase': {'page_size': 1000000},
+        'exmo':     {'page_size': 3000},
+        'hollaex':  {'timeframe': '1h'},
+        'kraken':   {'page_size': 720},
+        'poloniex': {'timeframe': '5m'},
+        }
+
+# Number of candles requested by the window strategy: enough to include the last closed candle.
+WINDOW = 2
+
+Strategy = Literal[
+        'limit',    # fetch_ohlcv with limit = 1 and no since. The exchange returns its most recent candle.
+        'window',   # fetch_ohlcv since the start of the previous candle.
+        'ticker',   # fetch_ticker.
+        ]
+
+@dataclass(frozen = True)
+class LatestPlan:
+    strategy    : Strategy
+    timeframe   : str
+    end_param   : str | None = None
+
+def quirk(exchange: ccxt.Exchange, name: str, default = None):
+    return QUIRKS.get(exchange.id, {}).get(name, default)
+
+def page_size(exchange: ccxt.Exchange) -> int:
+    return quirk(exchange, 'page_size', DEFAULT_PAGE_SIZE)
+
+def plan_latest(exchange: ccxt.Exchange) -> LatestPlan | None:
+    '''
+    Choose the cheapest request for the latest price that the exchange supports.
+
+    A candle is preferred to a ticker because a ticker's open, high, low and
+    volume cover the last 24 hours rather than the last candle. A ticker is
+    preferred to candles that ccxt emulates by requesting the exchange's trades.
+    '''
+    result = None
+
+    has_ohlcv   = exchange.has.get('fetchOHLCV')
+    has_ticker  = exchange.has.get('fetchTicker')
+
+    timeframe = quirk(exchange, 'timeframe', DEFAULT_TIMEFRAME)
+    if exchange.timeframes and timeframe not in exchange.timeframes:
+        timeframe = min(exchange.timeframes, key = exchange.parse_timeframe)
+
+    strategy = None
+    if has_ohlcv is True:
+        strategy = 'window'
+    elif has_ticker:
+        strategy = 'ticker'
+    elif has_ohlcv:
+        strategy = 'window'
+
+    strategy = quirk(exchange, 'latest', strategy)
+    if strategy:
+        result = LatestPlan(
+                strategy    = strategy,
+                timeframe   = timeframe,
+                end_param   = quirk(exchange, 'end_param'))
+
+    return result
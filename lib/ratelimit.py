@@ -0,0 +1,103 @@
+'''
+Per-exchange rate limiting shared by every request that Spotbit makes.
+
+Each exchange has one token bucket. Its rate is taken from the exchange's
+ccxt rateLimit (the minimum number of milliseconds between requests) unless it
+is overridden in the configuration. Every request waits for a token from its
+exchange's bucket, so concurrent requests, including the pages of a single
+history request, are spread out instead of hitting the exchange at once.
+
+When an exchange rate limits Spotbit anyway, its bucket is paused for
+everyone, with the pause doubling for each consecutive rate-limit error.
+'''
+
+import asyncio
+import logging
+import time
+
+import ccxt
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float = 1):
+        assert rate > 0
+        assert capacity >= 1
+
+        self.rate       = rate          # tokens per second.
+        self.capacity   = capacity
+        self.tokens     = capacity
+        self.updated    = time.monotonic()
+
+        self.paused_until   = 0.0
+        self.backoff        = 0.0       # seconds of the last pause.
+
+        # Waiters are served in the order that they arrive.
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens  = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, cost: float = 1):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self._refill(now)
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    break
+
+                await asyncio.sleep((cost - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens = 0
+        self.paused_until = max(self.paused_until, now + seconds)
+
+class RateLimitScheduler:
+
+    def __init__(self, *,
+            overrides:      dict[str, float],
+            burst:          float = 1,
+            max_backoff:    float = 120):
+        '''
+        overrides: requests per second for exchanges whose ccxt rateLimit is wrong for Spotbit.
+        '''
+        self.overrides      = overrides
+        self.burst          = burst
+        self.max_backoff    = max_backoff
+
+        self.buckets: dict[str, TokenBucket] = {}
+
+    def bucket(self, exchange: ccxt.Exchange) -> TokenBucket:
+        result = self.buckets.get(exchange.id)
+        if result is None:
+            rate = self.overrides.get(exchange.id) or 1e3 / max(exchange.rateLimit, 1)
+            result = self.buckets[exchange.id] = TokenBucket(rate, self.burst)
+            logger.debug(f'{exchange} is limited to {rate:.2f} requests per second.')
+
+        return result
+
+    async def acquire(self, exchange: ccxt.Exchange):
+        await self.bucket(exchange).acquire()
+
+    def rate_limited(self, exchange: ccxt.Exchange) -> float:
+        '''
+        Pause all requests to the exchange after it has rate limited Spotbit. Return the length of the pause.
+        '''
+        bucket = self.bucket(exchange)
+        bucket.backoff = min(max(bucket.backoff * 2, 1 / bucket.rate), self.max_backoff)
+        bucket.pause(bucket.backoff)
+
+        logger.error(f'{exchange} has rate limited spotbit. Pausing requests for {bucket.backoff:.1f} seconds.')
+        return bucket.backoff
+
+    def succeeded(self, exchange: ccxt.Exchange):
+        self.bucket(exchange).backoff = 0
@@ -0,0 +1,248 @@
+'''
+An offline exchange for benchmarks and tests.
+
+ReplayExchange is a ccxt exchange that answers from a recorded fixture
+instead of the network. AsyncReplayExchange is the same exchange for
+ccxt.async_support. Both can be configured to behave like a real exchange
+under load:
+
+    latency:            Seconds that each request takes.
+    jitter:             Up to this many seconds are added to the latency at random.
+    error_rate:         Fraction of requests that fail with ccxt.NetworkError.
+    rate_limit_rate:    Fraction of requests that fail with ccxt.RateLimitExceeded.
+    page_limit:         The most candles that fetch_ohlcv returns, however many are requested.
+    fixture:            Path of a JSON fixture made by record().
+
+A fixture looks like this:
+
+    {
+        "markets":  ["BTC/USD", ...],
+        "ohlcv":    {"BTC/USD": {"1h": [[timestamp, open, high, low, close, volume], ...]}},
+        "tickers":  {"BTC/USD": {"last": ..., ...}}
+    }
+
+The recorded candles of a timeframe are replayed in a loop. The candle for
+any timestamp is the recorded candle at the same position in the loop, so
+any period can be requested. A pair or timeframe with no recording gets
+deterministic synthetic candles. Without a ticker recording, the ticker is
+made from the latest 1m candle.
+
+Replay exchanges are registered with the replay setting. Ref. server.Settings.
+'''
+
+import asyncio
+import json
+import random
+import time
+
+import ccxt
+import ccxt.async_support
+
+OPTIONS = ['fixture', 'latency', 'jitter', 'error_rate', 'rate_limit_rate', 'page_limit']
+
+DEFAULT_MARKETS = ['BTC/USD', 'BTC/EUR', 'BTC/GBP', 'BTC/JPY', 'BTC/USDT']
+TIMEFRAMES      = ['1m', '5m', '15m', '30m', '1h', '4h', '1d']
+
+def record(exchange: ccxt.Exchange, symbols: list[str], *, timeframe: str, since: int, limit: int) -> dict:
+    '''
+    Make a fixture from a live exchange.
+    '''
+    result = {
+            'markets':  symbols,
+            'ohlcv':    {},
+            'tickers':  {},
+            }
+
+    exchange.load_markets()
+    for symbol in symbols:
+        result['ohlcv'][symbol] = {timeframe: exchange.fetch_ohlcv(symbol, timeframe, since, limit)}
+        if exchange.has.get('fetchTicker'):
+            result['tickers'][symbol] = exchange.fetch_ticker(symbol)
+
+    return result
+
+class _Replay:
+    '''
+    The behaviour that is shared by the sync and async replay exchanges.
+    '''
+
+    def describe(self):
+        return self.deep_extend(super().describe(), {
+            'id':           'replay',
+            'name':         'Replay',
+            'countries':    [],
+            'urls':         {'www': 'https://github.com/BlockchainCommons/spotbit'},
+            'rateLimit':    10,
+            'has': {
+                'fetchOHLCV':   True,
+                'fetchTicker':  True,
+                },
+            'timeframes':   {timeframe: timeframe for timeframe in TIMEFRAMES},
+            'fixture':          None,
+            'latency':          0.0,
+            'jitter':           0.0,
+            'error_rate':       0.0,
+            'rate_limit_rate':  0.0,
+            'page_limit':       None,
+            })
+
+    def _recording(self) -> dict:
+        if getattr(self, '_fixture_data', None) is None:
+            self._fixture_data = {}
+            if self.fixture:
+                with open(self.fixture) as f:
+                    self._fixture_data = json.load(f)
+
+        return self._fixture_data
+
+    def replay_options(self) -> dict:
+        result = {name: getattr(self, name) for name in OPTIONS}
+        result['id'] = self.id
+        result['name'] = self.name
+        result['_fixture_data'] = self._recording()
+
+        return result
+
+    def _delay(self) -> float:
+        return self.latency + random.uniform(0, self.jitter)
+
+    def _fault(self) -> Exception | None:
+        '''
+        Return the error that the request should fail with, if any.
+        '''
+        result = None
+
+        r = random.random()
+        if r < self.rate_limit_rate:
+            result = ccxt.RateLimitExceeded(f'{self.id} 429 Too Many Requests (replay)')
+        elif r < self.rate_limit_rate + self.error_rate:
+            result = ccxt.NetworkError(f'{self.id} request failed (replay)')
+
+        return result
+
+    def _markets(self) -> list[dict]:
+        result = []
+        for symbol in self._recording().get('markets', DEFAULT_MARKETS):
+            base, quote = symbol.split('/')
+            result.append({
+                'id':       base + quote,
+                'symbol':   symbol,
+                'base':     base,
+                'quote':    quote,
+                'baseId':   base,
+                'quoteId':  quote,
+                'active':   True,
+                'type':     'spot',
+                'spot':     True,
+                'info':     {},
+                })
+
+        return result
+
+    def _candles(self, symbol: str, timeframe: str, since: int | None, limit: int | None) -> list[list]:
+        dt = self.parse_timeframe(timeframe) * 1000
+        now = self.milliseconds() // dt * dt
+        limit = limit or 500
+        if self.page_limit: limit = min(limit, self.page_limit)
+
+        if since is None:
+            start = now - (limit - 1) * dt
+        else:
+            start = -(-since // dt) * dt
+        timestamps = range(start, min(start + limit * dt, now + dt), dt)
+
+        recorded = self._recording().get('ohlcv', {}).get(symbol, {}).get(timeframe)
+
+        result = []
+        for timestamp in timestamps:
+            if recorded:
+                first = recorded[0][0]
+                row = recorded[(timestamp - first) // dt % len(recorded)]
+                result.append([timestamp, *row[1:6]])
+            else:
+                result.append(_synthetic_candle(symbol, timestamp, dt))
+
+        return result
+
+    def _ticker(self, symbol: str) -> dict:
+        result = self._recording().get('tickers', {}).get(symbol)
+        if result is None:
+            timestamp, open, high, low, close, volume = self._candles(symbol, '1m', None, 1)[-1]
+            result = {
+                    'symbol':       symbol,
+                    'timestamp':    timestamp,
+                    'datetime':     self.iso8601(timestamp),
+                    'open':         open,
+                    'high':         high,
+                    'low':          low,
+                    'close':        close,
+                    'last':         close,
+                    'baseVolume':   volume,
+                    'info':         {},
+                    }
+
+        return result
+
+def _synthetic_candle(symbol: str, timestamp: int, dt: int) -> list:
+    '''
+    Return a candle that depends only on its symbol, timestamp and length.
+    '''
+    rng = random.Random(f'{symbol}{timestamp}{dt}')
+    price = 20_000 + 5_000 * ((timestamp // 86_400_000) % 365) / 365
+
+    open = price * (1 + rng.uniform(-0.01, 0.01))
+    close = price * (1 + rng.uniform(-0.01, 0.01))
+    high = max(open, close) * (1 + rng.uniform(0, 0.005))
+    low = min(open, close) * (1 - rng.uniform(0, 0.005))
+
+    return [timestamp, open, high, low, close, rng.uniform(0, 10) * dt / 60_000]
+
+class ReplayExchange(_Replay, ccxt.Exchange):
+
+    def _request(self):
+        time.sleep(self._delay())
+        fault = self._fault()
+        if fault: raise fault
+
+    def fetch_markets(self, params = {}):
+        self._request()
+        return self._markets()
+
+    def fetch_ohlcv(self, symbol, timeframe = '1m', since = None, limit = None, params = {}):
+        self._request()
+        return self._candles(symbol, timeframe, since, limit)
+
+    def fetch_ticker(self, symbol, params = {}):
+        self._request()
+        return self._ticker(symbol)
+
+    def sync_exchange(self, config: dict) -> 'ReplayExchange':
+        '''
+        Return another instance of the same exchange.
+        '''
+        return ReplayExchange({**self.replay_options(), **config})
+
+    def async_exchange(self, config: dict) -> 'AsyncReplayExchange':
+        '''
+        Return the same exchange for ccxt.async_support.
+        '''
+        return AsyncReplayExchange({**self.replay_options(), **config})
+
+class AsyncReplayExchange(_Replay, ccxt.async_support.Exchange):
+
+    async def _request(self):
+        await asyncio.sleep(self._delay())
+        fault = self._fault()
+        if fault: raise fault
+
+    async def fetch_markets(self, params = {}):
+        await self._request()
+        return self._markets()
+
+    async def fetch_ohlcv(self, symbol, timeframe = '1m', since = None, limit = None, params = {}):
+        await self._request()
+        return self._candles(symbol, timeframe, since, limit)
+
+    async def fetch_ticker(self, symbol, params = {}):
+        await self._request()
+        return self._ticker(symbol)
@@ -0,0 +1,84 @@
+'''
+Resampling of stored candles into coarser timeframes.
+
+A timeframe is a ccxt timeframe with a whole number of minutes, hours, days
+or weeks, e.g. 4h, 1d, 1w or a custom bucket such as 90m or 3d. Buckets are
+aligned to the Unix epoch except for weeks, which start on Monday 00:00 UTC.
+Months and years are not supported because their length varies.
+
+Each bucket's candle is rolled up from the finer candles whose timestamps
+fall in it: the first open, the highest high, the lowest low, the last close
+and the total volume. The rollup is vectorized with numpy's reduceat over
+the runs of candles that share a bucket. The first and last buckets of a
+range are partial unless the range is aligned to the bucket.
+'''
+
+import re
+
+import numpy as np
+
+from lib.columnar import CandleColumns
+
+TIMEFRAME_PATTERN = r'^[1-9][0-9]*[mhdw]$'
+
+_UNITS = {
+        'm': 60_000,
+        'h': 3_600_000,
+        'd': 86_400_000,
+        'w': 604_800_000,
+        }
+
+# 1970-01-01 was a Thursday. The first Monday was 1970-01-05.
+_MONDAY = 4 * _UNITS['d']
+
+class InvalidTimeframe(ValueError):
+    pass
+
+def bucket_size(timeframe: str) -> int:
+    '''
+    Return the length of the timeframe in milliseconds.
+    '''
+    if not re.match(TIMEFRAME_PATTERN, timeframe):
+        raise InvalidTimeframe(f'{timeframe} is not a timeframe of minutes, hours, days or weeks e.g. 4h, 1d, 1w')
+
+    return int(timeframe[:-1]) * _UNITS[timeframe[-1]]
+
+def _origin(timeframe: str) -> int:
+    return _MONDAY if timeframe.endswith('w') else 0
+
+def floor(timestamp: int, timeframe: str) -> int:
+    '''
+    Return the start of the bucket that contains the timestamp.
+    '''
+    size, origin = bucket_size(timeframe), _origin(timeframe)
+    return (timestamp - origin) // size * size + origin
+
+def ceil(timestamp: int, timeframe: str) -> int:
+    '''
+    Return the start of the first bucket that starts at or after the timestamp.
+    '''
+    size, origin = bucket_size(timeframe), _origin(timeframe)
+    return -(-(timestamp - origin) // size) * size + origin
+
+def resample(candles: CandleColumns, timeframe: str) -> CandleColumns:
+    '''
+    Roll candles, sorted by timestamp, up into buckets of the timeframe.
+    '''
+    size, origin = bucket_size(timeframe), _origin(timeframe)
+
+    if not len(candles):
+        return candles
+
+    buckets = (candles.timestamp - origin) // size * size + origin
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(buckets)] - 1
+
+    result = CandleColumns(
+            timestamp   = buckets[starts],
+            open        = candles.open[starts],
+            high        = np.fmax.reduceat(candles.high, starts),
+            low         = np.fmin.reduceat(candles.low, starts),
+            close       = candles.close[ends],
+            volume      = np.add.reduceat(np.nan_to_num(candles.volume), starts))
+
+    return result
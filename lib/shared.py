@@ -0,0 +1,134 @@
+'''
+State that is shared by the worker processes of one server.
+
+When the server runs more than one worker process, one of them is elected
+leader by holding an exclusive lock on a file in the data directory. Only
+the leader loads markets from exchanges and runs the price collector. It
+writes markets to the MarketCache and collected candles to the LatestStore.
+The other workers, followers, read markets from the MarketCache and the
+latest candles from the LatestStore, so the exchange traffic of the server
+doesn't grow with the number of workers. Candle history is shared through
+the SQLite CandleStore.
+
+A lock is released when the process that holds it exits, so a follower
+takes over as leader the next time it tries to acquire the lock.
+'''
+
+import fcntl
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+
+from lib import RawCandle
+from lib.collector import Sample
+
+logger = logging.getLogger(__name__)
+
+class Leadership:
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        self._fd: int | None = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._fd is not None
+
+    def acquire(self) -> bool:
+        '''
+        Try to become the leader without waiting. Return True if this process is the leader.
+        '''
+        if self._fd is None:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.ftruncate(fd, 0)
+                os.write(fd, str(os.getpid()).encode())
+                self._fd = fd
+                logger.info(f'worker {os.getpid()} is the leader.')
+            except BlockingIOError:
+                os.close(fd)
+
+        return self.is_leader
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+_SCHEMA = '''
+create table if not exists latest(
+    exchange    text    not null,
+    currency    text    not null,
+    timestamp   integer not null,
+    open        real,
+    high        real,
+    low         real,
+    close       real,
+    volume      real,
+    fetched_at  real    not null,
+    primary key (exchange, currency)
+) without rowid;
+'''
+
+class LatestStore:
+    '''
+    The latest candle of each (exchange, currency) pair, in SQLite.
+
+    A candle only replaces the stored candle of its pair if it was fetched later.
+    '''
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        self._local = threading.local()
+
+        with self.connection as connection:
+            connection.executescript(_SCHEMA)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout = 30)
+            connection.execute('pragma journal_mode = wal')
+            connection.execute('pragma synchronous = normal')
+            self._local.connection = connection
+
+        return connection
+
+    def write(self, samples: dict[tuple[str, str], Sample]):
+        '''
+        Save samples by (exchange id, currency).
+        '''
+        with self.connection as connection:
+            connection.executemany('''
+                insert into latest values (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                on conflict (exchange, currency) do update set
+                    timestamp   = excluded.timestamp,
+                    open        = excluded.open,
+                    high        = excluded.high,
+                    low         = excluded.low,
+                    close       = excluded.close,
+                    volume      = excluded.volume,
+                    fetched_at  = excluded.fetched_at
+                where excluded.fetched_at > latest.fetched_at
+                ''',
+                [(exchange, currency, *sample.candle, sample.fetched_at)
+                    for (exchange, currency), sample in samples.items()])
+
+    def read(self, since: float = 0) -> dict[tuple[str, str], Sample]:
+        '''
+        Return the samples that were fetched after since, a Unix time, by (exchange id, currency).
+        '''
+        rows = self.connection.execute(
+                'select * from latest where fetched_at > ?', (since,)).fetchall()
+
+        result = {(exchange, currency): Sample(candle = RawCandle(*candle), fetched_at = fetched_at)
+                for exchange, currency, *candle, fetched_at in rows}
+
+        return result
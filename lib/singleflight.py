@@ -0,0 +1,51 @@
+'''
+Request coalescing.
+
+Concurrent calls with the same key share one in-flight call: the first caller
+starts it and every caller that arrives before it finishes awaits the same
+result. Callers must treat the shared result as read-only.
+'''
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Hashable
+
+from lib import metrics
+
+logger = logging.getLogger(__name__)
+
+class SingleFlight:
+
+    def __init__(self):
+        self.in_flight: dict[Hashable, asyncio.Future] = {}
+
+        self.calls      = 0     # Calls made through do().
+        self.coalesced  = 0     # Calls that were answered by another caller's call.
+
+    async def do(self, key: Hashable, make_call: Callable[[], Awaitable[Any]]) -> Any:
+        self.calls += 1
+
+        future = self.in_flight.get(key)
+        metrics.cache('coalescing', future is not None)
+        if future:
+            self.coalesced += 1
+        else:
+            future = asyncio.ensure_future(make_call())
+            self.in_flight[key] = future
+
+            def done(f: asyncio.Future):
+                if self.in_flight.get(key) is f: del self.in_flight[key]
+                # Retrieve the exception in case every caller has given up waiting.
+                if not f.cancelled(): f.exception()
+
+            future.add_done_callback(done)
+
+        # Shielded so that a caller that is cancelled doesn't cancel the call for the others.
+        return await asyncio.shield(future)
+
+    def stats(self) -> dict[str, int]:
+        return {
+                'calls':        self.calls,
+                'coalesced':    self.coalesced,
+                'in_flight':    len(self.in_flight),
+                }
@@ -0,0 +1,317 @@
+'''
+Durable local storage for candle history.
+
+Candles are keyed by exchange, pair and timeframe. Alongside the candles each
+store records which ranges of time have already been requested from each
+exchange, so that a range that has been fetched once, including the parts of
+it for which the exchange has no data, is never requested again.
+
+There are two stores with the same interface:
+    CandleStore:    SQLite, in WAL mode so that readers don't block the writer.
+    ColumnarStore:  One memory-mapped file of fixed-width records per
+                    (exchange, pair, timeframe), kept sorted by timestamp so
+                    that a range query is a binary search and a slice of the
+                    mapped file.
+
+Timestamps are epoch milliseconds throughout, as returned by ccxt.
+'''
+
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+
+import numpy as np
+
+from lib.columnar import RECORD, CandleColumns, to_records
+
+logger = logging.getLogger(__name__)
+
+Interval = tuple[int, int]      # [start, end) in epoch milliseconds.
+
+def merge_intervals(intervals: list[Interval]) -> list[Interval]:
+    '''
+    Merge overlapping and adjacent intervals.
+    '''
+    result: list[Interval] = []
+    for start, end in sorted(intervals):
+        if result and start <= result[-1][1]:
+            result[-1] = (result[-1][0], max(result[-1][1], end))
+        else:
+            result.append((start, end))
+
+    return result
+
+def subtract_intervals(start: int, end: int, intervals: list[Interval]) -> list[Interval]:
+    '''
+    Return the parts of [start, end) that are not in the given intervals.
+    '''
+    result: list[Interval] = []
+    for s, e in merge_intervals(intervals):
+        if e <= start: continue
+        if s >= end: break
+        if s > start: result.append((start, s))
+        start = max(start, e)
+
+    if start < end: result.append((start, end))
+
+    return result
+
+def cluster_intervals(timestamps: list[int], width: int, span: int) -> list[Interval]:
+    '''
+    Cover [t, t + width) for each timestamp with as few intervals as possible, none longer than span.
+    '''
+    assert width <= span
+
+    result: list[Interval] = []
+    for t in sorted(timestamps):
+        if result and t + width <= result[-1][0] + span:
+            result[-1] = (result[-1][0], max(result[-1][1], t + width))
+        else:
+            result.append((t, t + width))
+
+    return result
+
+def received_until(start: int, end: int, dt: int, timestamps: list[int]) -> int:
+    '''
+    Return the end of the part of [start, end) that a page of candles of length dt, requested from start, has received.
+
+    An exchange may return fewer candles than were requested, e.g. when it caps the size of a page, so a page that is 
+    short of [start, end) has only received up to its last candle in the range. An empty page has received the whole 
+    range because the exchange has no candles for it.
+    '''
+    result = end
+
+    if timestamps:
+        received = [t for t in timestamps if start <= t < end]
+        if len(received) < -(-(end - start) // dt):
+            result = max(received) + dt if received else start
+
+    return result
+
+_SCHEMA = '''
+create table if not exists candles(
+    exchange    text    not null,
+    pair        text    not null,
+    timeframe   text    not null,
+    timestamp   integer not null,
+    open        real,
+    high        real,
+    low         real,
+    close       real,
+    volume      real,
+    primary key (exchange, pair, timeframe, timestamp)
+) without rowid;
+
+create table if not exists coverage(
+    exchange    text    not null,
+    pair        text    not null,
+    timeframe   text    not null,
+    start       integer not null,
+    end         integer not null,
+    primary key (exchange, pair, timeframe, start)
+) without rowid;
+'''
+
+class CandleStore:
+    '''
+    SQLite candle store.
+
+    Each thread gets its own connection so the store can be used from the
+    worker threads that make exchange requests.
+    '''
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        self._local = threading.local()
+
+        with self.connection as connection:
+            connection.executescript(_SCHEMA)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout = 30)
+            connection.execute('pragma journal_mode = wal')
+            connection.execute('pragma synchronous = normal')
+            self._local.connection = connection
+
+        return connection
+
+    def insert(self, exchange: str, pair: str, timeframe: str, candles: list[list]):
+        '''
+        Insert or update ccxt OHLCV candles.
+        '''
+        with self.connection as connection:
+            connection.executemany(
+                    'insert or replace into candles values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(exchange, pair, timeframe, *candle[:6]) for candle in candles])
+
+    def cover(self, exchange: str, pair: str, timeframe: str, start: int, end: int):
+        '''
+        Record that every candle with a timestamp in [start, end) has been received.
+        '''
+        if start >= end: return
+
+        key = (exchange, pair, timeframe)
+        with self.connection as connection:
+            overlapping = connection.execute(
+                    '''select start, end from coverage
+                    where exchange = ? and pair = ? and timeframe = ? and start <= ? and end >= ?''',
+                    (*key, end, start)).fetchall()
+            (start, end), = merge_intervals([(start, end), *overlapping])
+
+            connection.executemany(
+                    'delete from coverage where exchange = ? and pair = ? and timeframe = ? and start = ?',
+                    [(*key, s) for s, _ in overlapping])
+            connection.execute('insert into coverage values (?, ?, ?, ?, ?)', (*key, start, end))
+
+    def missing(self, exchange: str, pair: str, timeframe: str, start: int, end: int) -> list[Interval]:
+        '''
+        Return the parts of [start, end) that have not been received.
+        '''
+        covered = self.connection.execute(
+                '''select start, end from coverage
+                where exchange = ? and pair = ? and timeframe = ? and start < ? and end > ?''',
+                (exchange, pair, timeframe, end, start)).fetchall()
+
+        return subtract_intervals(start, end, covered)
+
+    def select(self, exchange: str, pair: str, timeframe: str, start: int, end: int) -> CandleColumns:
+        '''
+        Return the candles with timestamps in [start, end).
+        '''
+        rows = self.connection.execute(
+                '''select timestamp, open, high, low, close, volume from candles
+                where exchange = ? and pair = ? and timeframe = ? and timestamp >= ? and timestamp < ?
+                order by timestamp''',
+                (exchange, pair, timeframe, start, end)).fetchall()
+
+        return CandleColumns.from_rows(rows)
+
+class ColumnarStore:
+    '''
+    Memory-mapped candle store with the same interface as lib.store.CandleStore.
+
+    New candles are appended to the end of a file. If that leaves the file out
+    of order, it is sorted and deduplicated the next time it is read.
+    '''
+
+    def __init__(self, directory: pathlib.Path):
+        self.directory = directory
+        self.directory.mkdir(parents = True, exist_ok = True)
+
+        self._lock  = threading.Lock()
+        self._locks: dict[tuple[str, str, str], threading.Lock] = {}
+        self._maps:  dict[tuple[str, str, str], tuple[tuple, np.ndarray]] = {}
+
+    def _key_lock(self, key: tuple[str, str, str]) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _path(self, key: tuple[str, str, str], suffix: str) -> pathlib.Path:
+        exchange, pair, timeframe = key
+        return self.directory / f'{exchange}_{pair.replace("/", "-")}_{timeframe}{suffix}'
+
+    def _records(self, key: tuple[str, str, str]) -> np.ndarray:
+        '''
+        Return the sorted records for the key, mapping the file again if it has changed.
+        '''
+        path = self._path(key, '.ohlcv')
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return np.empty(0, dtype = RECORD)
+
+        version = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        cached = self._maps.get(key)
+        if cached and cached[0] == version: return cached[1]
+
+        # Only whole records are mapped: insert may be part way through appending a page.
+        records = np.empty(0, dtype = RECORD)
+        n_records = stat.st_size // RECORD.itemsize
+        if n_records:
+            records = np.memmap(path, dtype = RECORD, mode = 'r', shape = (n_records,))
+
+        timestamps = records['timestamp']
+        if len(records) > 1 and not np.all(timestamps[1:] > timestamps[:-1]):
+            self._compact(key)
+            return self._records(key)
+
+        self._maps[key] = (version, records)
+        return records
+
+    def _compact(self, key: tuple[str, str, str]):
+        '''
+        Sort the records by timestamp, keeping the most recently received candle for each timestamp.
+        '''
+        path = self._path(key, '.ohlcv')
+        with self._key_lock(key):
+            records = np.fromfile(path, dtype = RECORD)
+
+            # Reversed so that np.unique keeps the candle that was appended last.
+            reversed_records = records[::-1]
+            _, indices = np.unique(reversed_records['timestamp'], return_index = True)
+            result = reversed_records[indices]
+
+            temporary = self._path(key, '.ohlcv.tmp')
+            with open(temporary, 'wb') as f:
+                f.write(result.tobytes())
+            os.replace(temporary, path)
+
+        logger.debug(f'compacted {key}: {len(records)} -> {len(result)} candles')
+
+    def _coverage(self, key: tuple[str, str, str]) -> list[Interval]:
+        result = []
+
+        path = self._path(key, '.coverage.json')
+        if path.exists():
+            result = [tuple(interval) for interval in json.loads(path.read_text())]
+
+        return result
+
+    def insert(self, exchange: str, pair: str, timeframe: str, candles: list[list]):
+        '''
+        Insert or update ccxt OHLCV candles.
+        '''
+        if not candles: return
+
+        key = (exchange, pair, timeframe)
+        with self._key_lock(key):
+            with open(self._path(key, '.ohlcv'), 'ab') as f:
+                f.write(to_records(candles).tobytes())
+
+    def cover(self, exchange: str, pair: str, timeframe: str, start: int, end: int):
+        '''
+        Record that every candle with a timestamp in [start, end) has been received.
+        '''
+        if start >= end: return
+
+        key = (exchange, pair, timeframe)
+        with self._key_lock(key):
+            coverage = merge_intervals([*self._coverage(key), (start, end)])
+
+            path = self._path(key, '.coverage.json')
+            temporary = self._path(key, '.coverage.json.tmp')
+            temporary.write_text(json.dumps(coverage))
+            os.replace(temporary, path)
+
+    def missing(self, exchange: str, pair: str, timeframe: str, start: int, end: int) -> list[Interval]:
+        '''
+        Return the parts of [start, end) that have not been received.
+        '''
+        return subtract_intervals(start, end, self._coverage((exchange, pair, timeframe)))
+
+    def select(self, exchange: str, pair: str, timeframe: str, start: int, end: int) -> CandleColumns:
+        '''
+        Return the candles with timestamps in [start, end) as views of the mapped file.
+        '''
+        records = self._records((exchange, pair, timeframe))
+        timestamps = records['timestamp']
+        i, j = np.searchsorted(timestamps, [start, end])
+
+        return CandleColumns.from_records(records[i:j])
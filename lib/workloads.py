@@ -0,0 +1,133 @@
+'''
+Bounded executors for each class of blocking work.
+
+    latest:     Latest-price requests for /api/now, /api/feed and the collector.
+    history:    History pages and candle store reads.
+    metadata:   Market loads, /api/exchanges and the state that is shared between processes.
+
+Each class runs in its own thread pool so that e.g. a large history request
+can't hold up /api/now. Routes that will need a thread check their class 
+before they start: while more than queue calls of the class are waiting for 
+a thread, the route is answered with 503 Service Unavailable instead of 
+adding to the wait. A route that is answered from memory, e.g. from the 
+collector, is never checked. Calls that are made for a request that has been 
+admitted are never turned away, so a response is never missing part of its data.
+'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
+import threading
+from typing import Any, Callable
+
+from lib import metrics
+
+WORKLOADS = ['latest', 'history', 'metadata']
+
+# Market loads wait on the network and all start together on startup, so metadata has the most threads.
+# Threads are only started when they are needed.
+DEFAULT_THREADS = {'latest': 16, 'history': 8, 'metadata': 32}
+DEFAULT_QUEUES  = {'latest': 64, 'history': 32, 'metadata': 16}
+
+class Saturated(Exception):
+    pass
+
+class Workload:
+
+    def __init__(self, name: str, *, threads: int, queue: int):
+        '''
+        threads:    the size of the thread pool.
+        queue:      the number of calls waiting for a thread before routes of this class are turned away.
+        '''
+        assert threads > 0
+        assert queue >= 0
+
+        self.name       = name
+        self.threads    = threads
+        self.queue      = queue
+        self.waiting    = 0     # Calls waiting for a thread.
+
+        self.executor = ThreadPoolExecutor(max_workers = threads, thread_name_prefix = f'spotbit-{name}')
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def check(self):
+        '''
+        Raise Saturated if too many calls are waiting for a thread.
+        '''
+        if self.waiting > self.queue:
+            self.rejected += 1
+            raise Saturated(f'Spotbit is too busy with {self.name} requests. Try again shortly.')
+
+    def _dequeue(self, queued: list[bool]):
+        with self._lock:
+            if queued[0]:
+                queued[0] = False
+                self.waiting -= 1
+                metrics.THREAD_QUEUE_DEPTH.labels(self.name).dec()
+
+    async def run(self, function: Callable, *args, **kwargs) -> Any:
+        '''
+        Call the function in a thread of this class, like asyncio.to_thread.
+        '''
+        return await self._run(function, args, kwargs)
+
+    async def run_with_timeout(self, timeout: float, function: Callable, *args, **kwargs) -> Any:
+        '''
+        Like run, but raise asyncio.TimeoutError if the call takes longer than timeout seconds once it has a thread.
+        The time that the call waits for a thread isn't counted. A call that times out isn't interrupted but its result is ignored.
+        '''
+        return await self._run(function, args, kwargs, timeout = timeout)
+
+    async def _run(self, function: Callable, args: tuple, kwargs: dict, *, timeout: float | None = None) -> Any:
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, function, *args, **kwargs)
+
+        started = loop.create_future()
+        def start():
+            if not started.done(): started.set_result(None)
+
+        queued = [True]
+        def run():
+            self._dequeue(queued)
+            if timeout is not None: loop.call_soon_threadsafe(start)
+            return call()
+
+        with self._lock:
+            self.waiting += 1
+            metrics.THREAD_QUEUE_DEPTH.labels(self.name).inc()
+        future = loop.run_in_executor(self.executor, run)
+        try:
+            if timeout is None:
+                return await future
+
+            await asyncio.wait([started, future], return_when = asyncio.FIRST_COMPLETED)
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        finally:
+            # The call is cancelled before it started.
+            self._dequeue(queued)
+
+    def stats(self) -> dict[str, int]:
+        return {
+                'threads':  self.threads,
+                'queue':    self.queue,
+                'waiting':  self.waiting,
+                'rejected': self.rejected,
+                }
+
+    def shutdown(self):
+        self.executor.shutdown(wait = False, cancel_futures = True)
+
+def make_workloads(threads: dict[str, int], queues: dict[str, int]) -> dict[str, Workload]:
+    '''
+    Return a Workload for each class, sized by threads and queues or the defaults.
+    '''
+    threads = {**DEFAULT_THREADS, **threads}
+    queues  = {**DEFAULT_QUEUES, **queues}
+
+    return {name: Workload(name, threads = threads[name], queue = queues[name]) for name in WORKLOADS}
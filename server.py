@@ -2,19 +2,32 @@
 # TODO(nochiel) - Standard error page/response for non-existent routes?
 
 import asyncio
+import bisect
+from collections import deque
 from datetime import datetime, timedelta
 from http import HTTPStatus
 import os
 import pathlib 
 import sys
 import time
+from typing import Literal
 
-import ccxt
+import numpy as np
+import orjson
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
 from pydantic import BaseModel, BaseSettings, validator
 
-from lib import Candle
+from lib import Candle, RawCandle, catalog, formats, metrics, quirks, resample
+from lib.aggregate import Aggregation, aggregate, aggregate_grid
+from lib.broadcast import Broadcaster
+from lib.collector import PriceCollector, Sample
+from lib.health import HealthRegistry
+from lib.markets import MarketCache, PairIndex, load_markets, refresh_markets
+from lib.shared import Leadership, LatestStore
+from lib.columnar import CandleColumns, align
+from lib.store import CandleStore, ColumnarStore, cluster_intervals, received_until
+from lib.workloads import Saturated, make_workloads
 
 class ServerErrors:     # TODO(nochiel) Replace these with HTTPException
     NO_DATA = 'Spotbit did not find any data.'
@@ -35,6 +48,43 @@ class Settings(BaseSettings):
     onion:                  str | None = None
     debug:                  bool  = False
 
+    # Background price collection for /api/now.
+    collector:              bool  = True
+    collector_interval:     float = 30      # seconds between polls of each pair.
+    collector_history:      int   = 60      # candles kept in memory per pair.
+    freshness_limit:        float = 90      # seconds before a collected candle is too old to serve.
+    feed_queue_size:        int   = 100     # messages queued for each /api/feed client before the oldest are dropped.
+
+    data_directory:         str   = 'data'  # Local candle store.
+    workers:                int   = 1       # Worker processes that share markets, latest candles and history. Ref. lib.shared.
+    history_store:          Literal['sqlite', 'columnar'] = 'sqlite'
+
+    # all: request exchanges and serve the API. collect: request exchanges and save to the data directory.
+    # serve: serve the API from the data directory without requesting exchanges. Ref. app.py.
+    role:                   Literal['all', 'collect', 'serve'] = 'all'
+    collect_history:        float = 7       # days of candle history that the collect process keeps for each pair.
+
+    exchange_engine:        Literal['threaded', 'async'] = 'threaded'
+    engine_connections:     int   = 100     # Connections shared by all exchanges with the async engine.
+    exchange_pool_size:     int   = 4       # Instances of each exchange that make requests concurrently with the threaded engine.
+
+    rate_limits:            dict[str, float] = {}   # requests per second for each exchange id, overriding ccxt's rateLimit.
+
+    # Threads, and calls waiting for a thread before routes are answered with 503, by workload class. Ref. lib.workloads.
+    workload_threads:       dict[str, int] = {}
+    workload_queues:        dict[str, int] = {}
+
+    # Circuit breakers. Ref. lib.health.
+    circuit_failures:       int   = 5       # consecutive failed requests before an exchange is skipped.
+    circuit_cooldown:       float = 60      # seconds before a skipped exchange is probed. Doubles while probes fail.
+
+    market_cache_ttl:       float = 24 * 60 * 60    # seconds before cached markets are reloaded.
+    market_load_timeout:    float = 30      # seconds to wait for each exchange's markets.
+
+    metrics:                bool  = False   # Serve Prometheus metrics at /metrics.
+
+    replay:                 dict[str, dict] = {}    # Offline exchanges by id, with their options. Ref. lib.replay.
+
     @validator('currencies')
     def uppercase_currency_names(cls, v):
         assert v and len(v), 'no currencies'
@@ -47,33 +97,48 @@ class Settings(BaseSettings):
 # we can determine which ones shouldn't be supported i.e. populate
 # this list with exchanges that fail tests.
 _unsupported_exchanges = []     
-supported_exchanges: dict[str, ccxt.Exchange] =  {} 
+supported_exchanges: dict[str, 'Exchange'] =  {} 
 
 def get_logger():
 
     import logging
+    import logging.handlers
     logger = logging.getLogger(__name__)
-    if settings.debug: logger.setLevel(logging.DEBUG)      
 
     formatter = logging.Formatter(
         '[%(asctime)s] %(levelname)s (thread %(thread)d):\t%(module)s.%(funcName)s: %(message)s')
 
-    handler  = logging.StreamHandler()
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    stream_handler  = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
 
-    import logging.handlers
-    handler = logging.handlers.RotatingFileHandler(
+    file_handler = logging.handlers.RotatingFileHandler(
             filename    = 'spotbit.log',
             maxBytes    = 1 << 20,
             backupCount = 2,
             )
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    file_handler.setFormatter(formatter)
+
+    # Modules in lib log through the same handlers as the server.
+    for l in (logger, logging.getLogger('lib')):
+        l.setLevel(logging.DEBUG if settings.debug else logging.INFO)
+        l.addHandler(stream_handler)
+        l.addHandler(file_handler)
 
     return logger
 
 settings = Settings()
+startup_began = time.monotonic()
+
+if settings.role == 'serve':
+    # A serve-only process reads its exchanges from the catalog that the collect process saves. Ref. lib.catalog.
+    from lib.catalog import ExchangeInfo as Exchange
+else:
+    import ccxt
+    from ccxt import Exchange
+
+    from lib.engine import AsyncEngine, ThreadedEngine
+    from lib.ratelimit import RateLimitScheduler
+    from lib.replay import ReplayExchange
 
 from enum import Enum
 CurrencyName = Enum('CurrencyName', [(currency, currency) for currency in settings.currencies])  
@@ -81,147 +146,475 @@ CurrencyName = Enum('CurrencyName', [(currency, currency) for currency in settin
 logger = get_logger()
 assert logger
 
+# Enabled once the logger is set up so that a missing prometheus_client is logged on startup.
+if settings.metrics: metrics.enable()
+
 app = FastAPI(debug = settings.debug)
 
 logger.debug(f'{settings.currencies = }')
-if not settings.exchanges:
-    logger.info('using all exchanges.')
-    settings.exchanges = list(ccxt.exchanges)
 
-assert settings.exchanges
+market_cache = MarketCache(pathlib.Path(settings.data_directory) / 'markets', settings.market_cache_ttl)
+pair_index   = PairIndex(settings.currencies)
+markets_modified: dict[str, float] = {}     # When the cached markets that each exchange was set from were saved.
+
+catalog_path     = pathlib.Path(settings.data_directory) / 'exchanges.json'
+catalog_modified = None     # When the catalog that a serve-only process loaded was saved.
+
+def modified_at(path: pathlib.Path) -> float | None:
+    return path.stat().st_mtime if path.exists() else None
+
+if settings.role == 'serve':
+    logger.info('Loading the exchange catalog.')
+    catalog_modified = modified_at(catalog_path)
+    supported_exchanges.update(catalog.load(catalog_path, pair_index))
+    if not supported_exchanges:
+        logger.error(f'there are no exchanges in {catalog_path}. Run "python app.py collect" first.')
+        sys.exit(1)
+
+else:
+    if not settings.exchanges:
+        logger.info('using all exchanges.')
+        settings.exchanges = list(ccxt.exchanges)
+
+    assert settings.exchanges
+
+    # Markets are loaded from the cache here. Exchanges that aren't cached are loaded concurrently on startup.
+    logger.info('Initialising supported exchanges.')
+    for e in settings.exchanges + [id for id in settings.replay if id not in settings.exchanges]:
+        if e in settings.replay:
+            # The routes list exchanges by name, so each replay exchange is named after its id.
+            supported_exchanges[e] = ReplayExchange({'name': e, **settings.replay[e], 'id': e})
+        elif e in ccxt.exchanges and e not in _unsupported_exchanges:
+            supported_exchanges[e] = ccxt.__dict__[e]() 
+        else:
+            continue
 
-logger.info('Initialising supported exchanges.')
-for e in settings.exchanges:
-    if e in ccxt.exchanges and e not in _unsupported_exchanges:
-        supported_exchanges[e] = ccxt.__dict__[e]() 
-        try:
-            if app.debug is False: supported_exchanges[e].load_markets()
-        except Exception as e:
-            logger.debug(f'Error loading markets for {e}.')
+        modified = market_cache.modified(supported_exchanges[e])
+        if market_cache.load(supported_exchanges[e]): 
+            pair_index.build(supported_exchanges[e])
+            markets_modified[e] = modified
 
 assert supported_exchanges
 
 ExchangeName = Enum('ExchangeName', [(id.upper(), id) for id in supported_exchanges]) 
 
-# Exchange data is sometimes returned as epoch milliseconds.
-def is_ms(timestamp): return timestamp % 1e3 == 0
-
-def get_supported_pair_for(currency: CurrencyName, exchange: ccxt.Exchange) -> str:
+health = HealthRegistry(
+        failures    = settings.circuit_failures,
+        cooldown    = settings.circuit_cooldown)
+
+workloads = make_workloads(settings.workload_threads, settings.workload_queues)
+
+# A serve-only process doesn't request exchanges so it has no engine.
+engine = None
+if settings.role != 'serve':
+    scheduler = RateLimitScheduler(overrides = settings.rate_limits)
+
+    match settings.exchange_engine:
+        case 'threaded':
+            engine = ThreadedEngine(supported_exchanges, 
+                    scheduler   = scheduler,
+                    health      = health,
+                    workloads   = workloads,
+                    pool_size   = settings.exchange_pool_size)
+        case 'async':
+            engine = AsyncEngine(supported_exchanges, 
+                    scheduler   = scheduler,
+                    health      = health,
+                    workloads   = workloads,
+                    connections = settings.engine_connections)
+
+# Tasks that run for the lifetime of the server.
+background_tasks: list[asyncio.Task] = []
+
+@app.on_event('startup')
+async def start_engine():
+    if engine: await engine.start()
+
+# With more than one worker, only the leader requests markets and runs the collector. Ref. lib.shared.
+# The collect and serve processes share latest candles in the same way.
+leadership   = None
+latest_store = None
+if settings.workers > 1 and settings.role == 'all':
+    leadership   = Leadership(pathlib.Path(settings.data_directory) / 'leader.lock')
+if settings.workers > 1 or settings.role != 'all':
+    latest_store = LatestStore(pathlib.Path(settings.data_directory) / 'latest.sqlite3')
+
+def is_leader() -> bool:
+    '''
+    Return True if this process requests exchanges.
+    '''
+    return settings.role != 'serve' and (leadership is None or leadership.is_leader)
+
+@app.on_event('startup')
+async def start_markets():
+    if settings.role == 'serve':
+        logger.info(f'Spotbit started in {time.monotonic() - startup_began:.2f} seconds. '
+                f'{len(supported_exchanges)} exchanges were loaded from the catalog.')
+        return
+
+    if leadership and not leadership.acquire():
+        logger.info(f'Worker started in {time.monotonic() - startup_began:.2f} seconds. '
+                f'Markets for {len(markets_modified)} exchanges were loaded from the cache.')
+        return
+
+    exchanges = list(supported_exchanges.values())
+    uncached  = [exchange for exchange in exchanges if not exchange.markets]
+
+    failed = await load_markets(uncached,
+            engine  = engine,
+            cache   = market_cache,
+            index   = pair_index,
+            timeout = settings.market_load_timeout)
+
+    background_tasks.append(asyncio.create_task(refresh_markets(exchanges,
+            engine  = engine,
+            cache   = market_cache,
+            index   = pair_index,
+            timeout = settings.market_load_timeout)))
+
+    logger.info(f'Spotbit started in {time.monotonic() - startup_began:.2f} seconds. '
+            f'Markets for {len(exchanges) - len(uncached)} exchanges were loaded from the cache, '
+            f'{len(uncached) - len(failed)} from exchanges and {len(failed)} failed to load.')
+
+if (settings.workers > 1 or settings.role != 'all') and settings.history_store == 'columnar':
+    logger.warning('the columnar history store can only be used by one process. Using sqlite instead.')
+    settings.history_store = 'sqlite'
+
+match settings.history_store:
+    case 'sqlite':
+        store = CandleStore(pathlib.Path(settings.data_directory) / 'candles.sqlite3')
+    case 'columnar':
+        store = ColumnarStore(pathlib.Path(settings.data_directory) / 'candles')
+
+def get_supported_pair_for(currency: CurrencyName, exchange: Exchange) -> str:
 
     result = ''
 
-    exchange.load_markets()
-    market_ids = {
-            f'BTC{currency.value}', 
-            f'BTC/{currency.value}',
-            f'XBT{currency.value}', 
-            f'XBT/{currency.value}', 
-            f'BTC{currency.value}'.lower(), 
-            f'XBT{currency.value}'.lower()}
-    market_ids_found = list(market_ids & exchange.markets_by_id.keys())
-    if not market_ids_found:
-        market_ids_found = list(market_ids & set([market['symbol'] for market in exchange.markets_by_id.values()]))
-    if market_ids_found:
-        logger.debug(f'market_ids_found: {market_ids_found}')
-        market_id = market_ids_found[0]
-        market = exchange.markets_by_id[exchange.market_id(market_id)] 
-        if market:  
-            result = market['symbol']
-            logger.debug(f'Found market {market}, with symbol {result}')
+    resolution = pair_index.resolve(exchange.id, currency.value)
+    if resolution: result = resolution.symbol
 
     return result
 
 
 # FIXME(nochiel) Redundancy: Merge this with get_history.
-# TODO(nochiel) TEST Do we really need to check if fetchOHLCV exists in the exchange api? 
-# TEST ccxt abstracts internally using fetch_trades so we don't have to use fetch_ticker ourselves.
-def request_single(exchange: ccxt.Exchange, currency: CurrencyName) -> Candle | None:
+async def request_single(exchange: Exchange, currency: CurrencyName) -> RawCandle | None:
     '''
     Make a single request, without having to loop through all exchanges and currency pairs.
+    The request is planned when the exchange's markets are indexed. Ref. lib.quirks.plan_latest.
     '''
-    assert exchange and isinstance(exchange, ccxt.Exchange)
+    assert exchange and isinstance(exchange, Exchange)
     assert currency
 
-    exchange.load_markets()
-    pair = get_supported_pair_for(currency, exchange)
-    if not pair: return None
+    resolution = pair_index.resolve(exchange.id, currency.value)
+    if not resolution or not resolution.latest: return None
+    pair = resolution.symbol
+    plan = resolution.latest
 
     result = None
     latest_candle = None
-    dt = None
-
-    if exchange.has['fetchOHLCV']:
-        logger.debug('fetchOHLCV')
-
-        timeframe = '1m'
-        match exchange.id:
-            case 'btcalpha' | 'hollaex':
-                timeframe = '1h'
-            case 'poloniex':
-                timeframe = '5m'
-
-        # Some exchanges have explicit limits on how many candles you can get at once
-        # TODO(nochiel) Simplify this by checking for 2 canonical limits to use.
-        limit = 1000
-        match exchange.id:
-            case 'bitstamp':
-                limit = 1000
-            case 'bybit':
-                limit = 200
-            case 'eterbase':
-                limit = 1000000
-            case 'exmo':
-                limit = 3000
-            case 'btcalpha':
-                limit = 720
-
-        since = round((datetime.now() - timedelta(hours=1)).timestamp() * 1e3)
-
-        # TODO(nochiel) TEST other exchanges requiring special conditions: bitstamp, bitmart?
-        params = []
-        if exchange.id == 'bitfinex': 
-            params = {
-                    'limit':100,
-                    'start': since,
-                    'end':  round(datetime.now().timestamp() * 1e3)
-                    }
 
-        try:
-            candles = exchange.fetchOHLCV(
-                    symbol      = pair, 
-                    timeframe   = timeframe, 
-                    limit       = limit, 
-                    since       = since, 
-                    params      = params)
+    try:
+        match plan.strategy:
+            case 'limit':
+                logger.debug(f'fetch_ohlcv limit 1: {pair}')
+                candles = await engine.fetch_ohlcv(exchange,
+                        symbol      = pair,
+                        timeframe   = plan.timeframe,
+                        limit       = 1)
+                if candles: latest_candle = candles[-1]
+
+            case 'window':
+                logger.debug(f'fetch_ohlcv window: {pair}')
+
+                # Aligned to the timeframe so that concurrent requests for the same pair are identical and can be coalesced.
+                dt = exchange.parse_timeframe(plan.timeframe) * 1000
+                since = int(time.time() * 1000) // dt * dt - (quirks.WINDOW - 1) * dt
+
+                params = {}
+                if plan.end_param:
+                    params[plan.end_param] = since + quirks.WINDOW * dt
+
+                candles = await engine.fetch_ohlcv(exchange,
+                        symbol      = pair,
+                        timeframe   = plan.timeframe,
+                        limit       = quirks.WINDOW,
+                        since       = since,
+                        params      = params)
+                if candles: latest_candle = candles[-1]
+
+            case 'ticker':
+                logger.debug(f'fetch_ticker: {pair}')
+                ticker = await engine.fetch_ticker(exchange, pair)
+
+                # A ticker's open, high, low and volume are for the last 24 hours so only its last price is used.
+                price = ticker.get('last') or ticker.get('close')
+                if price:
+                    timestamp = ticker.get('timestamp') or int(time.time() * 1000)
+                    latest_candle = [timestamp, price, price, price, price, 0.0]
+
+    except Exception as e:
+        logger.error(f'error requesting latest price from {exchange.name}: {e}')
 
-            latest_candle = candles[-1]   
+    if latest_candle:
+        result = RawCandle(
+                timestamp   = int(latest_candle[OHLCV.timestamp]),
+                open        = float(latest_candle[OHLCV.open]),
+                high        = float(latest_candle[OHLCV.high]),
+                low         = float(latest_candle[OHLCV.low]),
+                close       = float(latest_candle[OHLCV.close]),
+                volume      = float(latest_candle[OHLCV.volume] or 0.0)
+                )
 
-        except Exception as e:
-            logger.error(f'error requesting candle from {exchange.name}: {e}')
+    return result
 
-    else:       # TODO(nochiel) TEST 
-        logger.debug(f'fetch_ticker: {pair}')
+async def get_candle(exchange: Exchange, currency: CurrencyName) -> RawCandle | None:
+    '''
+    Request the latest candle for the currency if the exchange supports it.
+    '''
+    assert exchange
+    assert currency
 
-        candle = None
+    result = None
+    # An exchange whose circuit is open isn't requested until it is due to be probed.
+    if engine and pair_index.resolve(exchange.id, currency.value) and health.available(exchange.id):
         try:
-            candle = exchange.fetch_ticker(pair)
+            result = await request_single(exchange, currency)
         except Exception as e:
-            logger.error(f'error on {exchange} fetch_ticker: {e}')
+            logger.error(f'error requesting data from exchange: {e}')
 
-        latest_candle = candle
+    return result
 
-    if latest_candle:
-        result = Candle(
-                timestamp   = latest_candle[OHLCV.timestamp],
-                open        = latest_candle[OHLCV.open],
-                high        = latest_candle[OHLCV.high],
-                low         = latest_candle[OHLCV.low],
-                close       = latest_candle[OHLCV.close],
-                volume      = latest_candle[OHLCV.volume]
-                )
+async def collect_candle(exchange_id: str, currency: str) -> RawCandle | None:
+    return await get_candle(supported_exchanges[exchange_id], CurrencyName(currency))
+
+collector = PriceCollector(
+        fetch       = collect_candle,
+        pairs       = pair_index.pairs,
+        interval    = settings.collector_interval,
+        size        = settings.collector_history)
+
+async def get_latest_sample(exchange: Exchange, currency: CurrencyName) -> Sample | None:
+    '''
+    Return the collected candle for the pair if it is fresh enough, otherwise request it from the exchange.
+    '''
+
+    result = collector.fresh(exchange.id, currency.value, settings.freshness_limit)
+    metrics.cache('collector', result is not None)
+    if result is None:
+        candle = await get_candle(exchange, currency)
+        if candle: result = collector.record(exchange.id, currency.value, candle)
+
+    return result
+
+def check_latest(exchanges: list[Exchange], currency: CurrencyName):
+    '''
+    Raise Saturated if a latest candle must be requested from one of the exchanges and too many requests are waiting. 
+    Candles that are answered from the collector don't wait for a thread so they are never turned away.
+    '''
+    if engine and any(collector.fresh(exchange.id, currency.value, settings.freshness_limit) is None 
+            for exchange in exchanges):
+        workloads['latest'].check()
+
+# Live prices for /api/feed. A topic is a (currency, aggregation) pair. 
+# Updates are published once per collection round however many clients there are.
+feed = Broadcaster(size = settings.feed_queue_size)
+feed_published: dict[tuple[str, str], float] = {}   # When the last published candle of each (exchange, currency) was fetched.
+
+def sse(event: str, data: dict) -> bytes:
+    return b'event: ' + event.encode() + b'\ndata: ' + orjson.dumps(data) + b'\n\n'
+
+def fresh_samples(currency: str) -> dict[str, Sample]:
+    '''
+    Return the fresh collected sample of each exchange by exchange name.
+    '''
+    result = {}
+    for id in pair_index.exchanges_for(currency):
+        sample = collector.fresh(id, currency, settings.freshness_limit)
+        if sample: result[supported_exchanges[id].name] = sample
+
+    return result
+
+def price_events(currency: str, aggregation: Aggregation, published: dict | None = None) -> list[bytes]:
+    '''
+    Return server-sent events for the fresh candle of each exchange and their aggregate.
+    Exchange candles that are in published have already been sent and are skipped.
+    '''
+
+    result = []
+
+    samples = fresh_samples(currency)
+    for name, sample in samples.items():
+        if published and published.get((name, currency)) == sample.fetched_at: continue
+
+        result.append(sse('exchange', {
+            'exchange':     name,
+            'candle':       sample.candle.to_dict(),
+            'age':          sample.age,
+            }))
+
+    if samples:
+        candle = calculate_average_price([sample.candle for sample in samples.values()], aggregation)
+        result.append(sse('aggregate', {
+            'candle':           candle.to_dict(),
+            'exchanges_used':   list(samples),
+            'ages':             {name: sample.age for name, sample in samples.items()},
+            }))
+
+    return result
+
+def publish_prices():
+    topics = feed.topics()
+    for topic in topics:
+        currency, aggregation = topic
+        for event in price_events(currency, aggregation, feed_published): 
+            feed.publish(topic, event)
+
+    for currency in {currency for currency, _ in topics}:
+        for name, sample in fresh_samples(currency).items():
+            feed_published[(name, currency)] = sample.fetched_at
+
+collector.on_collect = publish_prices
+
+# How often workers share their latest candles and followers check the market cache.
+SYNC_INTERVAL = 1
+
+def read_markets() -> dict[str, tuple[float, dict]]:
+    '''
+    Return the markets that the leader has saved since they were last set, and when they were saved, by exchange id.
+    '''
+    result = {}
+
+    for id, exchange in supported_exchanges.items():
+        modified = market_cache.modified(exchange)
+        if modified is None or modified == markets_modified.get(id): continue
+
+        cached = market_cache.read(exchange)
+        if cached: result[id] = (modified, cached)
+
+    return result
+
+async def sync_markets() -> bool:
+    '''
+    Set the markets of each exchange whose markets the leader has saved since they were last set. Return True if any were.
+    The cache is read in a thread, and the markets are set on the event loop because the routes read the pair index.
+    '''
+    result = False
+
+    for id, (modified, cached) in (await workloads['metadata'].run(read_markets)).items():
+        exchange = supported_exchanges[id]
+        if market_cache.set(exchange, cached):
+            pair_index.build(exchange)
+            engine.set_markets(exchange)
+            markets_modified[id] = modified
+            result = True
+
+    return result
+
+async def sync_latest(shared: dict[tuple[str, str], float]) -> bool:
+    '''
+    Save the samples that this worker has fetched since the last sync and add the samples that other workers have saved.
+    shared is the fetched_at of the last sample of each pair that was saved or added.
+    Return True if any samples were added.
+    The store is used in a thread, and the collector's buffers are read and added to on the event loop, which also adds to them.
+    '''
+    result = False
+
+    fetched = {pair: buffer[-1] for pair, buffer in collector.buffers.items()
+            if buffer and buffer[-1].fetched_at > shared.get(pair, 0)}
+
+    def share() -> dict[tuple[str, str], Sample]:
+        if fetched: latest_store.write(fetched)
+        return latest_store.read()
+
+    saved = await workloads['metadata'].run(share)
+    for pair, sample in fetched.items(): shared[pair] = sample.fetched_at
+
+    for pair, sample in saved.items():
+        if sample.fetched_at > shared.get(pair, 0) and collector.add(*pair, sample):
+            shared[pair] = sample.fetched_at
+            result = True
 
     return result
 
+async def sync_catalog() -> bool:
+    '''
+    Update the pairs of a serve-only process from the catalog if the collect process has saved it since it was loaded.
+    Return True if it was updated. Exchanges that were added to the catalog are only served after a restart.
+    '''
+    global catalog_modified
+
+    result = False
+
+    modified = modified_at(catalog_path)
+    if modified is not None and modified != catalog_modified:
+        entries = await workloads['metadata'].run(catalog.read, catalog_path)
+
+        # The routes look up every exchange in the pair index in supported_exchanges, so new exchanges aren't indexed.
+        added = [id for id in entries if id not in supported_exchanges]
+        if added: logger.info(f'exchanges {added} were added to the catalog and will be served after a restart.')
+
+        entries = {id: entry for id, entry in entries.items() if id in supported_exchanges}
+        supported_exchanges.update(catalog.build(entries, pair_index))
+        catalog_modified = modified
+        result = True
+
+    return result
+
+async def sync_workers():
+    '''
+    Share latest candles with the other processes. 
+    Followers also take markets from the leader's cache, and take over if the leader exits.
+    The collect process saves the exchange catalog whenever its markets change, and serve-only processes reload it.
+    '''
+    shared = {}
+    catalog_version = None
+    while True:
+        await asyncio.sleep(SYNC_INTERVAL)
+
+        try:
+            match settings.role:
+                case 'serve':
+                    await sync_catalog()
+
+                case 'collect':
+                    if catalog_version != pair_index.version:
+                        catalog_version = pair_index.version
+                        await workloads['metadata'].run(catalog.save, catalog_path, supported_exchanges, pair_index)
+
+                case 'all' if not is_leader():
+                    if leadership.acquire():
+                        await start_markets()
+                        await start_collector()
+                    else:
+                        await sync_markets()
+
+            if await sync_latest(shared) and not collector.running: 
+                publish_prices()
+
+        except Exception as e:
+            logger.error(f'error sharing state with the other processes: {e}')
+
+@app.on_event('startup')
+async def start_collector():
+    if (settings.collector or settings.role == 'collect') and is_leader(): collector.start()
+
+@app.on_event('startup')
+async def start_sync():
+    if latest_store: 
+        background_tasks.append(asyncio.create_task(sync_workers()))
+
+@app.on_event('shutdown')
+async def stop_collector():
+    await collector.stop()
+
+    for task in background_tasks: task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions = True)
+
+    if engine: await engine.close()
+    for workload in workloads.values(): workload.shutdown()
+
+    if leadership: leadership.release()
+
 
 # Routes
 # TODO(nochiel) Add tests for routes.
@@ -229,8 +622,8 @@ def request_single(exchange: ccxt.Exchange, currency: CurrencyName) -> Candle |
 # TODO(nochiel) Put the api behind an /api/v1 path.
 
 # TODO(nochiel) Make this the Spotbit frontend.
-from fastapi import Request
-from fastapi.responses import HTMLResponse
+from fastapi import Request, Response
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
@@ -252,6 +645,70 @@ async def about(request: Request):
 @app.get('/api/status')
 def status(): return 'The server is running.'
 
+@app.get('/metrics', include_in_schema = False)
+def get_metrics():
+    '''
+    Prometheus metrics. Ref. lib.metrics.
+    '''
+    if not settings.metrics:
+        raise HTTPException(
+                detail      = 'Metrics are turned off. Set metrics = True in the configuration.',
+                status_code = HTTPStatus.NOT_FOUND)
+
+    if not metrics.enabled:
+        raise HTTPException(
+                detail      = 'Metrics are turned on but the prometheus_client package is not installed.',
+                status_code = HTTPStatus.NOT_IMPLEMENTED)
+
+    content, media_type = metrics.render()
+    # Set as a header because Response would add a second charset to a text media type.
+    return Response(content, headers = {'Content-Type': media_type})
+
+async def time_route(request: Request, call_next):
+    '''
+    Record the time to answer each route. For streamed responses this is the time until the response starts.
+    '''
+    began = time.perf_counter()
+    response = await call_next(request)
+
+    route = request.scope.get('route')
+    metrics.ROUTE_SECONDS.labels(request.method, route.path if route else 'unmatched', response.status_code).observe(
+            time.perf_counter() - began)
+
+    return response
+
+if metrics.enabled: app.middleware('http')(time_route)
+
+# Seconds that a client is asked to wait before retrying a request that was turned away.
+SATURATED_RETRY_AFTER = 1
+
+@app.exception_handler(Saturated)
+async def saturated(request: Request, e: Saturated):
+    '''
+    Answer a route whose workload class has too many calls waiting for a thread. Ref. lib.workloads.
+    '''
+    return JSONResponse(
+            {'detail': str(e)},
+            status_code = HTTPStatus.SERVICE_UNAVAILABLE,
+            headers     = {'Retry-After': str(SATURATED_RETRY_AFTER)})
+
+@app.get('/api/stats')
+def get_stats():
+    '''
+    Counters for the exchange requests that Spotbit has made.
+    coalescing: requests that were answered by an identical request that was already in flight.
+    feed: clients of /api/feed and the updates that were dropped because a client was too slow.
+    worker: the process that answered and whether it is the leader, which requests markets and collects prices.
+    workloads: the threads of each workload class, the calls waiting for a thread 
+    and the requests that were answered with 503 because too many were waiting.
+    '''
+    return {
+            'coalescing': engine.flights.stats() if engine else {},
+            'feed':       feed.stats(),
+            'worker':     {'pid': os.getpid(), 'leader': is_leader()},
+            'workloads':  {name: workload.stats() for name, workload in workloads.items()},
+            }
+
 # TODO(nochiel) FINDOUT Do we need to enable clients to change configuration? 
 # If clients should be able to change configuration, use sessions.
 @app.get('/api/configure')
@@ -261,25 +718,12 @@ def get_configuration():
             'exchanges':  settings.exchanges,
             }
 
-def calculate_average_price(candles: list[Candle]) -> Candle:
+def calculate_average_price(candles: list[RawCandle], aggregation: Aggregation = Aggregation.MEAN) -> RawCandle:
 
     assert candles
 
-    from statistics import mean 
-    average_open     = mean(candle.open for candle in candles) 
-    average_high     = mean(candle.high for candle in candles) 
-    average_low      = mean(candle.low for candle in candles) 
-    average_close    = mean(candle.close for candle in candles)
-    average_volume   = mean(candle.volume for candle in candles)
-
-    candle = Candle(
-            timestamp = min(candle.timestamp for candle in candles),
-            open    = average_open,
-            high    = average_high,
-            low     = average_low,
-            close   = average_close,
-            volume  = average_volume,
-            )
+    with metrics.timer('aggregate'):
+        candle = aggregate(candles, aggregation)
     return candle
 
 class ExchangeDetails(BaseModel):
@@ -296,10 +740,10 @@ async def get_exchanges():
     Get a list of exchanges that this instance of Spotbit has been configured to use.
     '''
 
-    def get_supported_currencies(exchange: ccxt.Exchange) -> list[str] :
+    def get_supported_currencies(exchange: Exchange) -> list[str] :
 
         required = set(settings.currencies)
-        given    = set(exchange.currencies.keys())
+        given    = set((exchange.currencies or {}).keys())
 
         return list(required & given)
 
@@ -307,17 +751,11 @@ async def get_exchanges():
 
     assert supported_exchanges
 
-    def get_exchange_details(exchange: ccxt.Exchange) -> ExchangeDetails:
+    def get_exchange_details(exchange: Exchange) -> ExchangeDetails:
 
         result = None
 
         assert exchange
-        exchange.load_markets()
-
-        currencies = []
-        if exchange.currencies: 
-            currencies = [c for c in settings.currencies 
-                    if c in exchange.currencies]
 
         details = ExchangeDetails(
                 id      = exchange.id,
@@ -329,85 +767,148 @@ async def get_exchanges():
         result = details
         return result
 
-    tasks = [asyncio.to_thread(get_exchange_details, exchange) 
+    result = [get_exchange_details(exchange) 
             for exchange in supported_exchanges.values()]
-    details = await asyncio.gather(*tasks)
-
-    result = list(details)
 
     return result
 
+@app.get('/api/exchanges/health')
+def get_exchanges_health():
+    '''
+    The health of each exchange that Spotbit has requested by exchange id, and the state of its circuit breaker.
+    state: closed when the exchange is requested, open when it is skipped because it keeps failing 
+    and half_open while it is being probed.
+    latency: moving average of the exchange's request latency in seconds.
+    retry_in: seconds until a skipped exchange is probed.
+    '''
+    return health.snapshot()
+
+# A latest price is one candle so it isn't streamed.
+NOW_MEDIA_TYPES = [formats.JSON, formats.CSV, formats.MSGPACK, formats.ARROW, formats.ARROW_FILE]
+
+def get_media_type(request: Request, media_types: list[str] = formats.MEDIA_TYPES) -> str:
+    '''
+    Return the format of the response that the request accepts. Ref. lib.formats.
+    '''
+    return formats.negotiate(request.headers.get('accept'), media_types)
+
+def encoded_response(candles: CandleColumns, media_type: str, *, 
+        extra:      dict[str, np.ndarray] | None = None, 
+        headers:    dict[str, str] | None = None) -> Response:
+
+    try:
+        with metrics.timer('serialize'):
+            content = formats.encode(candles, media_type, extra)
+    except formats.UnsupportedFormat as e:
+        raise HTTPException(
+                detail      = str(e),
+                status_code = HTTPStatus.NOT_ACCEPTABLE)
+
+    return Response(content, media_type = media_type, headers = headers)
+
+def to_columns(candles: list[RawCandle]) -> CandleColumns:
+    return CandleColumns.from_rows(candles)
+
 class PriceResponse(BaseModel):
     candle           : Candle
     exchanges_used   : list[str]
     failed_exchanges : list[str]
+    timed_out_exchanges : list[str] = []  # Exchanges that had not answered by the deadline or when the quorum was met.
+    ages             : dict[str, float]     # Seconds since each exchange's candle was received.
 
 @app.get('/api/now/{currency}', response_model = PriceResponse)
-async def now_average(currency: CurrencyName):
+async def now_average(currency: CurrencyName,
+        request:    Request,
+        deadline:   float | None = Query(None, gt = 0, description = 'Seconds to wait for exchanges before answering with the candles received so far.'),
+        quorum:     int | None   = Query(None, ge = 1, description = 'Answer as soon as this many exchanges have returned a candle.'),
+        aggregation: Aggregation = Query(Aggregation.MEAN, description = 'How the candles from each exchange are combined.'),
+        ):
     '''
     Return an average price from the exchanges configured for the given currency.
+    Exchanges that have not answered when the deadline passes or the quorum is met are abandoned and listed in timed_out_exchanges.
+    Exchanges that are skipped because they keep failing are listed in failed_exchanges. Ref. /api/exchanges/health.
+    When the candle is requested as CSV, MessagePack or Arrow, only the candle is returned. Ref. lib.formats.
     '''
 
     result = None
 
     logger.debug(f'currency: {currency}')
 
-    def get_candle(exchange: ccxt.Exchange, currency: CurrencyName = currency) -> tuple[ccxt.Exchange, Candle | None]:
-        assert exchange
-        assert currency
-
-        result = (exchange, None)
-        exchange.load_markets()
-        if currency.value in exchange.currencies:
-            try:
-                candle = None
-                candle = request_single(exchange, currency)
-                if candle:
-                    result = exchange, candle 
-            except Exception as e:
-                logger.error(f'error requesting data from exchange: {e}')
-
-        return result
-
-    tasks = [asyncio.to_thread(get_candle, exchange)
-            for exchange in supported_exchanges.values()]
-    task_results = await asyncio.gather(*tasks)
-    logger.debug(f'task results: {task_results}')
+    # Only exchanges that have a market for the currency, and whose circuit isn't open, are requested.
+    exchanges = [supported_exchanges[id] for id in pair_index.exchanges_for(currency.value)
+            if health.available(id)]
+    check_latest(exchanges, currency)
+    tasks = {asyncio.create_task(get_latest_sample(exchange, currency)): exchange 
+            for exchange in exchanges}
 
     candles = []
-    failed_exchanges = []
-    for exchange, candle in task_results:
-        if candle: 
-            candles.append(candle)
-        else:
-            failed_exchanges.append(exchange.name)
+    ages = {}
+    failed_exchanges = [exchange.name for exchange in supported_exchanges.values()
+            if exchange not in exchanges]
+
+    expires = time.monotonic() + deadline if deadline else None
+    pending = set(tasks)
+    while pending:
+        timeout = max(0, expires - time.monotonic()) if expires else None
+        done, pending = await asyncio.wait(pending, 
+                timeout     = timeout, 
+                return_when = asyncio.FIRST_COMPLETED)
+        if not done: break
+
+        for task in done:
+            exchange = tasks[task]
+            sample = None if task.exception() else task.result()
+            if sample: 
+                candles.append(sample.candle)
+                ages[exchange.name] = sample.age
+            else:
+                failed_exchanges.append(exchange.name)
+
+        if quorum and len(candles) >= quorum: break
+
+    timed_out_exchanges = []
+    for task in pending:
+        task.cancel()
+        timed_out_exchanges.append(tasks[task].name)
+    if timed_out_exchanges: 
+        logger.debug(f'abandoned {timed_out_exchanges}')
 
     logger.debug(f'candles: {candles}')
     average_price_candle = None
     if len(candles):
-        average_price_candle = calculate_average_price(candles)
+        average_price_candle = calculate_average_price(candles, aggregation)
     else:
         raise HTTPException(
                 status_code = HTTPStatus.INTERNAL_SERVER_ERROR,
                 detail      =  'Spotbit could not get any candle data from the configured exchanges.')
 
     exchanges_used = [exchange.name for exchange in supported_exchanges.values()
-            if exchange.name not in failed_exchanges]
-
-    result = PriceResponse(
-            candle           = average_price_candle,
-            exchanges_used   = exchanges_used,
-            failed_exchanges = failed_exchanges,
-            )
+            if exchange.name in ages]
+
+    media_type = get_media_type(request, NOW_MEDIA_TYPES)
+    if media_type == formats.JSON:
+        # The fields of PriceResponse.
+        result = formats.TrustedJSONResponse({
+            'candle':               average_price_candle.to_dict(),
+            'exchanges_used':       exchanges_used,
+            'failed_exchanges':     failed_exchanges,
+            'timed_out_exchanges':  timed_out_exchanges,
+            'ages':                 ages,
+            })
+    else:
+        result = encoded_response(to_columns([average_price_candle]), media_type)
 
     return result
 
 @app.get('/api/now/{currency}/{exchange}', response_model = Candle)
-def now(currency: CurrencyName, exchange: ExchangeName):
+async def now(currency: CurrencyName, exchange: ExchangeName, request: Request):
     '''
     parameters:
         exchange: an exchange to use.
         currency: the symbol for the base currency to use e.g. USD, GBP, UST.
+
+    The Age header of the response is the number of seconds since Spotbit received the candle.
+    The candle can also be requested as CSV, MessagePack or Arrow. Ref. lib.formats.
     '''
 
     if exchange.value not in supported_exchanges:
@@ -419,22 +920,70 @@ def now(currency: CurrencyName, exchange: ExchangeName):
 
     ccxt_exchange    = supported_exchanges[exchange.value]
     assert ccxt_exchange
-    ccxt_exchange.load_markets()
 
-    if currency.value not in ccxt_exchange.currencies:
+    if not pair_index.resolve(ccxt_exchange.id, currency.value):
        raise HTTPException(
                status_code = HTTPStatus.INTERNAL_SERVER_ERROR,
                detail      = f'Spotbit does not support {currency.value} on {ccxt_exchange}.' ) 
 
-    result = request_single(ccxt_exchange, currency)
-    if not result:
+    check_latest([ccxt_exchange], currency)
+    sample = await get_latest_sample(ccxt_exchange, currency)
+    if not sample:
         raise HTTPException(
                 status_code = HTTPStatus.INTERNAL_SERVER_ERROR,
                 detail = ServerErrors.NO_DATA
                 )
 
+    headers = {'Age': str(int(sample.age))}
+
+    media_type = get_media_type(request, NOW_MEDIA_TYPES)
+    if media_type == formats.JSON:
+        result = formats.TrustedJSONResponse(sample.candle.to_dict(), headers = headers)
+    else:
+        result = encoded_response(to_columns([sample.candle]), media_type, headers = headers)
+
     return result
 
+# Seconds between comments that keep an idle feed connection open.
+FEED_KEEPALIVE = 15
+
+@app.get('/api/feed/{currency}')
+async def feed_prices(currency: CurrencyName,
+        aggregation: Aggregation = Query(Aggregation.MEAN, description = 'How the candles from each exchange are combined.')):
+    '''
+    Stream live prices for the currency as server-sent events (text/event-stream).
+
+    exchange:   {"exchange", "candle", "age"} when an exchange's candle is collected.
+    aggregate:  {"candle", "exchanges_used", "ages"} after each collection round, as from /api/now/{currency}.
+
+    Every client is fed from the same collection loop, which runs while there are clients even if the collector is turned off.
+    A client that reads too slowly misses its oldest updates instead of holding up the others.
+    '''
+
+    # With more than one worker, followers are fed from the leader's collector when it is turned on.
+    # Serve-only processes are fed from the collect process.
+    if not collector.running and (is_leader() or (engine is not None and not settings.collector)): collector.start()
+    subscription = feed.subscribe((currency.value, aggregation))
+
+    async def events():
+        try:
+            for event in price_events(currency.value, aggregation): yield event
+
+            while True:
+                try:
+                    messages = await asyncio.wait_for(subscription.get(), FEED_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    messages = [b': keepalive\n\n']
+                yield b''.join(messages)
+
+        finally:
+            feed.unsubscribe(subscription)
+            if not settings.collector and not len(feed): await collector.stop()
+
+    return StreamingResponse(events(), 
+            media_type  = 'text/event-stream', 
+            headers     = {'Cache-Control': 'no-cache'})
+
 from enum import IntEnum
 class OHLCV(IntEnum):
     '''
@@ -447,12 +996,15 @@ class OHLCV(IntEnum):
     close       = 4
     volume      = 5
 
-def get_history(*, 
-        exchange: ccxt.Exchange, 
+async def get_history(*, 
+        exchange: Exchange, 
         since: datetime,
         limit: int,
         timeframe: str,
-        pair: str) -> list[Candle] | None:
+        pair: str) -> list[RawCandle] | None:
+    '''
+    Request candles from the exchange and save them in the candle store.
+    '''
 
     assert exchange
     logger.debug(f'{exchange} {pair} {since}')
@@ -471,61 +1023,294 @@ def get_history(*,
     # @nochiel: Re. Bitmex. Rate-limiting is very aggressive on authenticated API calls.
     # For a large number of requests this throttling doesn't help and Bitmex will increase
     # its rate limit to 3600 seconds!
-    # Serializing requests won't help either
-    wait            = exchange.rateLimit * 1e-3
-    while wait:
+    # Requests are spread out by the scheduler, which also pauses every request 
+    # to the exchange when it rate limits us, so we only need to retry here.
+    while True:
         try:
-            candles = exchange.fetchOHLCV(
+            candles = await engine.fetch_ohlcv(exchange,
                     symbol      = pair, 
                     limit       = limit, 
                     timeframe   = timeframe, 
                     since       = _since, 
-                    params      = params)
-
-            wait = 0
+                    params      = params,
+                    workload    = 'history')
+            break
 
         except (ccxt.errors.RateLimitExceeded, ccxt.errors.DDoSProtection) as e:
             logger.error(f'rate-limited on {exchange}: {e}')
-            logger.error(f'waiting {wait} seconds on {exchange} before making another request')
-            time.sleep(wait)
-            wait *= 2
-            if wait > 120: 
+            metrics.HISTORY_RETRIES.labels(exchange.id).inc()
+            if scheduler.bucket(exchange).backoff >= scheduler.max_backoff: 
                 raise Exception(f'{exchange} has rate limited spotbit') from e
 
         except Exception as e:
             logger.error(f'{exchange} candle request error: {e}')
+            break
+
+    if candles is not None:
+        # The exchange has now given us everything it has for the requested period up to its last candle, 
+        # except for the candle that is still open.
+        dt = exchange.parse_timeframe(timeframe) * 1000
+        closed = int(time.time() * 1e3) // dt * dt
+        end = min(_since + limit * dt, closed)
+        await workloads['history'].run(save_history, 
+                exchange    = exchange, 
+                pair        = pair, 
+                timeframe   = timeframe, 
+                candles     = candles, 
+                start       = _since, 
+                end         = received_until(_since, end, dt, [candle[OHLCV.timestamp] for candle in candles]))
 
     if candles:
-        result = [Candle(
-            timestamp   = candle[OHLCV.timestamp],
-            open        = candle[OHLCV.open],
-            high        = candle[OHLCV.high],
-            low         = candle[OHLCV.low],
-            close       = candle[OHLCV.close],
-            volume      = candle[OHLCV.volume]
-            )
+        result = [RawCandle._make(candle[:len(OHLCV)]) for candle in candles]
 
-            for candle in candles]
+    return result
+
+def get_history_timeframe(exchange: Exchange) -> tuple[str, timedelta]:
+    '''
+    Return the timeframe that Spotbit uses for the history of the exchange.
+    '''
+
+    result = ('1h', timedelta(hours = 1))
+
+    if exchange.timeframes:
+        if '1h' in exchange.timeframes:
+            result = ('1h', timedelta(hours = 1))
+
+        elif '30m' in exchange.timeframes:
+            result = ('30m', timedelta(minutes = 30))
 
     return result
 
+def save_history(*,
+        exchange: Exchange,
+        pair: str,
+        timeframe: str,
+        candles: list[list],
+        start: int,
+        end: int):
+    '''
+    Save the candles in the candle store and record that [start, end) has been received.
+    '''
+    store.insert(exchange.id, pair, timeframe, candles)
+    store.cover(exchange.id, pair, timeframe, start, end)
+
+def get_stored_candles(*,
+        exchange: Exchange,
+        pair: str,
+        timeframe: str,
+        start: int,
+        end: int) -> CandleColumns:
+
+    with metrics.timer('select'):
+        return store.select(exchange.id, pair, timeframe, start, end)
+
+# Times that fill_history requests the parts of a period that the exchange's pages fell short of.
+FILL_ROUNDS = 4
+
+async def fill_history(*,
+        exchange: Exchange,
+        pair: str,
+        timeframe: str,
+        start: int,
+        end: int,
+        limit: int = 100):
+    '''
+    Request the parts of [start, end) that are not yet in the candle store from the exchange.
+    A serve-only process only has the candles that the collect process has stored.
+    '''
+
+    dt = exchange.parse_timeframe(timeframe) * 1000
+
+    history = workloads['history']
+    gaps = await history.run(store.missing, exchange.id, pair, timeframe, start, end)
+    metrics.cache('history', not gaps)
+    if engine is None: return
+
+    # A page that the exchange cut short only covers the candles it returned, 
+    # so the rest of its gap is requested again while that makes progress.
+    for _ in range(FILL_ROUNDS):
+        if not gaps: break
+
+        tasks = []
+        for gap_start, gap_end in gaps:
+            for since in range(gap_start, gap_end, dt * limit):
+                n_candles = min(limit, -(-(gap_end - since) // dt))
+                task = get_history(
+                        exchange    = exchange,
+                        since       = datetime.fromtimestamp(since * 1e-3),
+                        limit       = n_candles,
+                        timeframe   = timeframe,
+                        pair        = pair)
+                tasks.append(task)
+
+        logger.debug(f'requesting {len(tasks)} pages of {pair} {timeframe} candles from {exchange}')
+        await asyncio.gather(*tasks)
+
+        remaining = await history.run(store.missing, exchange.id, pair, timeframe, start, end)
+        if remaining == gaps: break
+        gaps = remaining
+
+# Seconds between the collect process's checks for new history.
+COLLECT_HISTORY_INTERVAL = 15 * 60
+
+async def collect_history():
+    '''
+    Keep the last collect_history days of candles of every pair in the candle store, for serve-only processes.
+    Only the candles that aren't stored yet are requested.
+    '''
+    while True:
+        now = int(time.time() * 1e3)
+        for exchange_id, currency in pair_index.pairs():
+            exchange = supported_exchanges[exchange_id]
+            timeframe, dt = get_history_timeframe(exchange)
+            dt = round(dt.total_seconds() * 1e3)
+
+            try:
+                await fill_history(
+                        exchange    = exchange,
+                        pair        = pair_index.resolve(exchange_id, currency).symbol,
+                        timeframe   = timeframe,
+                        start       = (now - round(settings.collect_history * 24 * 60 * 60 * 1e3)) // dt * dt,
+                        end         = now)
+            except Exception as e:
+                logger.error(f'error collecting {currency} history from {exchange}: {e}')
+
+        logger.debug(f'collected history in {time.time() - now * 1e-3:.1f} seconds.')
+        await asyncio.sleep(COLLECT_HISTORY_INTERVAL)
+
+async def collect():
+    '''
+    Run the collect process: request markets, latest candles and history from exchanges and save them 
+    in the data directory for serve-only processes. Ref. app.py.
+    '''
+    assert settings.role == 'collect'
+
+    for startup in app.router.on_startup: await startup()
+    background_tasks.append(asyncio.create_task(collect_history()))
+
+    try:
+        await asyncio.gather(*background_tasks)
+    finally:
+        for shutdown in app.router.on_shutdown: await shutdown()
+
+# Number of pages that a streamed history response requests ahead of the page that it is sending.
+STREAM_PAGES_IN_FLIGHT = 4
+
+async def stream_history(*,
+        exchange: Exchange,
+        pair: str,
+        timeframe: str,
+        start: int,
+        end: int,
+        limit: int = 100,
+        resample_to: str | None = None):
+    '''
+    Yield the candles in [start, end) as newline-delimited JSON, one page of candles at a time in timestamp order.
+
+    Each page is filled then read back from the candle store, so a response never holds more than
+    STREAM_PAGES_IN_FLIGHT pages whatever the length of the period.
+
+    If resample_to is given, start must be aligned to it. Pages are then whole buckets of resample_to, 
+    and each page is resampled before it is sent.
+    '''
+
+    dt = exchange.parse_timeframe(timeframe) * 1000
+    span = dt * limit
+    if resample_to:
+        bucket = resample.bucket_size(resample_to)
+        span = -(-span // bucket) * bucket
+
+    pages = iter(range(start, end, span))
+    in_flight: deque[tuple[int, asyncio.Task]] = deque()
+
+    def request_pages():
+        while len(in_flight) < STREAM_PAGES_IN_FLIGHT:
+            since = next(pages, None)
+            if since is None: break
+
+            task = asyncio.create_task(fill_history(
+                    exchange    = exchange,
+                    pair        = pair,
+                    timeframe   = timeframe,
+                    start       = since,
+                    end         = min(since + span, end),
+                    limit       = limit))
+            in_flight.append((since, task))
+
+    try:
+        request_pages()
+        while in_flight:
+            since, task = in_flight.popleft()
+            try:
+                await task
+            except Exception as e:
+                logger.error(f'error requesting candle history from {exchange}: {e}')
+            request_pages()
+
+            candles = await workloads['history'].run(get_stored_candles,
+                    exchange    = exchange,
+                    pair        = pair,
+                    timeframe   = timeframe,
+                    start       = since,
+                    end         = min(since + span, end))
+            if resample_to: candles = resample.resample(candles, resample_to)
+            if len(candles):
+                with metrics.timer('serialize'):
+                    page = b''.join(orjson.dumps(candle) + b'\n' for candle in candles.to_dicts())
+                yield page
+
+    finally:
+        # The client has gone away or the response is complete.
+        for _, task in in_flight: task.cancel()
+
+def check_resample(source: str, timeframe: str):
+    '''
+    Raise an error unless candles of the source timeframe can be resampled into the timeframe.
+    '''
+    try:
+        size = resample.bucket_size(timeframe)
+    except resample.InvalidTimeframe as e:
+        raise HTTPException(
+                detail      = str(e),
+                status_code = HTTPStatus.BAD_REQUEST)
+
+    dt = resample.bucket_size(source)
+    if size < dt or size % dt:
+        raise HTTPException(
+                detail      = f'Spotbit can not make {timeframe} candles from {source} candles.',
+                status_code = HTTPStatus.BAD_REQUEST)
+
+TIMEFRAME_QUERY = Query(None, 
+        regex       = resample.TIMEFRAME_PATTERN, 
+        description = 'Resample the candles into this timeframe e.g. 4h, 1d, 1w or 3d. Weeks start on Monday.')
+
 @app.get('/api/history/{currency}/{exchange}', response_model = list[Candle])
 async def get_candles_in_range(
         currency:   CurrencyName, 
         exchange:   ExchangeName, 
         start:      datetime, 
-        end:        datetime = datetime.now()):
+        request:    Request,
+        end:        datetime | None = None,
+        timeframe:  str | None = TIMEFRAME_QUERY):
     '''
     parameters:
         exchange(required): an exchange to use.
         currency(required): the symbol for the base currency to use e.g. USD, GBP, UST.
-        start, end(required): datetime formatted as ISO8601 "YYYY-MM-DDTHH:mm:SS" or unix timestamp.
+        start(required), end: datetime formatted as ISO8601 "YYYY-MM-DDTHH:mm:SS" or unix timestamp. end defaults to now.
+        timeframe: resample the candles into buckets of this timeframe. Ref. lib.resample.
+
+    Candles are served from the candle store. Only the parts of the period that are not already stored are requested from the exchange.
+    The response is built from the stored columns rather than validated Candle objects.
+
+    If the request accepts application/x-ndjson, the candles are streamed as newline-delimited JSON as each page arrives.
+    A streamed response is empty rather than an error when the exchange has no candles for the period.
+    The candles can also be requested as CSV, MessagePack or Arrow. Ref. lib.formats.
+
+    Resampled candles are the buckets that start in [start, end), rolled up from the stored candles.
     '''
+    workloads['history'].check()
 
     ccxt_exchange = supported_exchanges[exchange.value]
-    ccxt_exchange.load_markets()
-    assert ccxt_exchange.currencies
-    assert ccxt_exchange.markets
 
     pair = get_supported_pair_for(currency, ccxt_exchange)
     if not pair:
@@ -535,73 +1320,35 @@ async def get_candles_in_range(
 
     result = None
 
+    if end is None: end = datetime.now()
     start = start.astimezone(start.tzinfo)
     end = end.astimezone(end.tzinfo)
 
     (start, end) = (end, start) if end < start else (start, end)
     logger.debug(f'start: {start}, end: {end}')
 
-    limit = 100
-    candles = None
-    periods = []
-
-    dt = timedelta(hours = 1)
-    params = None
-    timeframe = '1h'
-
-    if ccxt_exchange.timeframes:
-        if '1h' in ccxt_exchange.timeframes:
-            timeframe   = '1h' 
-            dt          = timedelta(hours = 1)
-
-        elif '30m' in ccxt_exchange.timeframes:
-            timeframe = '30m'
-            dt          = timedelta(minutes = 30)
-
-    n_periods, remaining_frames_duration = divmod(end - start, dt * 100)
-    remaining_frames = remaining_frames_duration // dt
-    logger.debug(f'requesting #{n_periods + remaining_frames} periods')
-
-    if n_periods == 0: 
-        n_periods               = 1
-        limit, remaining_frames = remaining_frames, 0
-    for i in range(n_periods):
-        periods.append(start + i * (dt * 100))
-
-    logger.debug(f'requesting periods with {limit} limit: {periods}')
-
-    tasks = []
-    args = dict( exchange = ccxt_exchange, 
-                limit = limit,
-                timeframe = timeframe,
-                pair = pair)
-
-    for period in periods:
-        args['since'] = period
-        task = asyncio.to_thread(get_history,
-                **args)
-        tasks.append(task)
-
-    if remaining_frames > 0:
-        last_candle_time = periods[-1] + (dt * 100)
-        assert last_candle_time < end
-        logger.debug(f'remaining_frames: {remaining_frames}')
-
-        args['since'] = last_candle_time   
-        args['limit'] = remaining_frames
-        task = asyncio.to_thread(get_history,
-             **args) 
-        tasks.append(task)
-
-        new_last_candle_time = last_candle_time + (dt * remaining_frames ) 
-        logger.debug(f'new_last_candle_time: {new_last_candle_time}')
-
-    task_results = await asyncio.gather(*tasks)
-    candles = []
-    for result in task_results:   
-        if result: candles.extend(result)
+    resample_to = timeframe
+    timeframe, dt = get_history_timeframe(ccxt_exchange)
+    args = dict(exchange = ccxt_exchange,
+            pair        = pair,
+            timeframe   = timeframe,
+            start       = round(start.timestamp() * 1e3),
+            end         = round(end.timestamp() * 1e3))
+
+    if resample_to == timeframe: resample_to = None
+    if resample_to:
+        check_resample(timeframe, resample_to)
+        args['start']   = resample.ceil(args['start'], resample_to)
+        args['end']     = resample.ceil(args['end'], resample_to)
 
-    expected_number_of_candles = (n_periods * limit) + remaining_frames
+    media_type = get_media_type(request)
+    if media_type == formats.NDJSON:
+        return StreamingResponse(stream_history(**args, resample_to = resample_to), media_type = media_type)
+
+    await fill_history(**args)
+    candles = await workloads['history'].run(get_stored_candles, **args)
+
+    expected_number_of_candles = (end - start) // dt
     received_number_of_candles = len(candles)
     if received_number_of_candles < expected_number_of_candles:
         logger.info(f'{ccxt_exchange} does not have data for the entire period. Expected {expected_number_of_candles} candles. Got {received_number_of_candles} candles')
@@ -612,8 +1359,126 @@ async def get_candles_in_range(
                 status_code = HTTPStatus.INTERNAL_SERVER_ERROR)
 
     logger.debug(f'got: {len(candles)} candles')
-    logger.debug(f'candles: {candles[:10]} ... {candles[-10:]}')
-    result = candles
+    if resample_to: candles = resample.resample(candles, resample_to)
+
+    if media_type == formats.JSON:
+        result = formats.TrustedJSONResponse(candles.to_dicts())
+    else:
+        result = encoded_response(candles, media_type)
+
+    return result
+
+class HistoryResponse(BaseModel):
+    candles          : list[Candle]
+    coverage         : list[int]            # Number of exchanges that have a candle at each timestamp.
+    exchanges_used   : list[str]
+    failed_exchanges : list[str]
+
+# Default timeframe of the grid that the history of several exchanges is aligned on.
+AGGREGATE_TIMEFRAME = '1h'
+
+# Candles that are aggregated from several exchanges aren't streamed.
+HISTORY_MEDIA_TYPES = NOW_MEDIA_TYPES
+
+@app.get('/api/history/{currency}', response_model = HistoryResponse)
+async def get_aggregate_candles_in_range(
+        currency:       CurrencyName, 
+        start:          datetime, 
+        request:        Request,
+        end:            datetime | None = None,
+        aggregation:    Aggregation = Query(Aggregation.MEAN),
+        exchanges:      list[ExchangeName] | None = Query(None, description = 'Exchanges to use. Defaults to every exchange with a market for the currency.'),
+        timeframe:      str | None = TIMEFRAME_QUERY):
+    '''
+    parameters:
+        currency(required): the symbol for the base currency to use e.g. USD, GBP, UST.
+        start(required), end: datetime formatted as ISO8601 "YYYY-MM-DDTHH:mm:SS" or unix timestamp. end defaults to now.
+        aggregation: how the candles of the exchanges at each timestamp are combined.
+        exchanges: the exchanges to use.
+        timeframe: the timeframe of the aggregated candles. Defaults to AGGREGATE_TIMEFRAME.
+
+    The history of each exchange is filled concurrently, resampled into the timeframe, then aligned on a grid of the timeframe's timestamps.
+    Exchanges whose candles can't be resampled into the timeframe are listed in failed_exchanges.
+    Each timestamp that any exchange has a candle for is aggregated. coverage counts the exchanges that contributed to each candle.
+    As CSV, MessagePack or Arrow, coverage is a column after volume. Ref. lib.formats.
+    '''
+    workloads['history'].check()
+
+    result = None
+
+    ids = [exchange.value for exchange in exchanges] if exchanges else pair_index.exchanges_for(currency.value)
+
+    if end is None: end = datetime.now()
+    start = start.astimezone(start.tzinfo)
+    end = end.astimezone(end.tzinfo)
+
+    (start, end) = (end, start) if end < start else (start, end)
+    logger.debug(f'start: {start}, end: {end}')
+
+    timeframe = timeframe or AGGREGATE_TIMEFRAME
+    dt = resample.bucket_size(timeframe)
+    grid_start = resample.ceil(round(start.timestamp() * 1e3), timeframe)
+    grid_end = resample.ceil(round(end.timestamp() * 1e3), timeframe)
+    grid = np.arange(grid_start, grid_end, dt, dtype = np.int64)
+
+    async def get_exchange_candles(exchange: Exchange, pair: str, source: str) -> CandleColumns:
+        args = dict(exchange = exchange,
+                pair        = pair,
+                timeframe   = source,
+                start       = grid_start,
+                end         = grid_end)
+
+        await fill_history(**args)
+        result = await workloads['history'].run(get_stored_candles, **args)
+        if source != timeframe: result = resample.resample(result, timeframe)
+
+        return result
+
+    tasks = {}
+    failed_exchanges = []
+    for id in ids:
+        exchange = supported_exchanges.get(id)
+        resolution = pair_index.resolve(id, currency.value)
+        source = get_history_timeframe(exchange)[0] if exchange else None
+        if resolution and source and dt % resample.bucket_size(source) == 0:
+            tasks[exchange] = get_exchange_candles(exchange, resolution.symbol, source)
+        else:
+            logger.debug(f'{id} does not have candles for {currency.value} that can be resampled into {timeframe}')
+            failed_exchanges.append(exchange.name if exchange else id)
+
+    candles = {}
+    for exchange, columns in zip(tasks, await asyncio.gather(*tasks.values(), return_exceptions = True)):
+        if isinstance(columns, Exception):
+            logger.error(f'error requesting candle history from {exchange}: {columns}')
+            failed_exchanges.append(exchange.name)
+        elif not len(columns):
+            failed_exchanges.append(exchange.name)
+        else:
+            candles[exchange.name] = columns
+
+    values = align(list(candles.values()), grid)
+    coverage = (~np.isnan(values[..., 3])).sum(axis = 0)
+    covered = coverage > 0
+
+    if not covered.any():
+        raise HTTPException(
+                detail  = f'Spotbit did not receive any candle history for the period {start} - {end}',
+                status_code = HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    with metrics.timer('aggregate'):
+        aggregated = aggregate_grid(values[:, covered], aggregation)
+    columns = CandleColumns(grid[covered], *aggregated.T)
+
+    media_type = get_media_type(request, HISTORY_MEDIA_TYPES)
+    if media_type == formats.JSON:
+        result = formats.TrustedJSONResponse({
+            'candles':          columns.to_dicts(),
+            'coverage':         coverage[covered].tolist(),
+            'exchanges_used':   list(candles),
+            'failed_exchanges': failed_exchanges,
+            })
+    else:
+        result = encoded_response(columns, media_type, extra = {'coverage': coverage[covered]})
 
     return result
 
@@ -621,22 +1486,27 @@ async def get_candles_in_range(
 async def get_candles_at_dates(
         currency: CurrencyName, 
         dates:    list[datetime],
+        request:  Request,
         # FIXME(nochiel) Ideally, we should get data from all the configured exchanges.
         # Then pick the results that are complete.
         exchange: ExchangeName # = list(ExchangeName.__members__.values())[0],
-        ) -> list[Candle]:
+        ) -> list[Candle | None]:
     '''
     Dates should be provided in the body of the request as a json array of  dates formatted as ISO8601 "YYYY-MM-DDTHH:mm:SS".
+
+    The candles are returned in the order of the dates, with null for a date that the exchange has no candle for.
+    The dates are sorted and clustered so that dates that are close together are answered by one request to the exchange.
+    As CSV, MessagePack or Arrow, a date without a candle is a row of nulls at the date. Ref. lib.formats.
     '''
+    workloads['history'].check()
 
-    result: list[Candle] = []
+    result: list[dict | None] = []
     if exchange.value not in supported_exchanges:
         raise HTTPException(
                 detail      = ServerErrors.EXCHANGE_NOT_SUPPORTED,
                 status_code = HTTPStatus.INTERNAL_SERVER_ERROR) 
 
     ccxt_exchange = supported_exchanges[exchange.value]
-    ccxt_exchange.load_markets()
 
     pair = get_supported_pair_for(currency, ccxt_exchange)
             
@@ -648,34 +1518,59 @@ async def get_candles_at_dates(
 
     # FIXME(nochiel) Different exchanges return candle data at different resolutions.
     # I need to get candle data in the lowest possible resolution then filter out the dates needed.
-    limit = 100
-    timeframe = '1h'
-
-    if ccxt_exchange.timeframes:
-        if '1h' in ccxt_exchange.timeframes:
-            timeframe   = '1h' 
-
-        elif '30m' in ccxt_exchange.timeframes:
-            timeframe = '30m'
-
-    candles_found: tuple[list[Candle] | None] 
-    args = [dict(exchange = ccxt_exchange, 
-            limit = limit,
-            timeframe = timeframe,
-            pair = pair,
-
-            since = date)
-            for date in dates]
-    tasks = [asyncio.to_thread(get_history, **arg) 
-            for arg in args]
-    candles_found = await asyncio.gather(*tasks)
-    
-    result = [candles_at[0] for candles_at in candles_found if candles_at]
-    if not result:
+    limit = quirks.page_size(ccxt_exchange)
+    timeframe, dt = get_history_timeframe(ccxt_exchange)
+    dt = round(dt.total_seconds() * 1e3)
+
+    timestamps = [round(date.timestamp() * 1e3) for date in dates]
+    clusters = cluster_intervals(timestamps, dt, dt * limit)
+    logger.debug(f'{len(dates)} dates are in {len(clusters)} clusters of {pair} {timeframe} candles from {ccxt_exchange}')
+
+    async def get_cluster(start: int, end: int) -> CandleColumns:
+        await fill_history(
+                exchange    = ccxt_exchange,
+                pair        = pair,
+                timeframe   = timeframe,
+                start       = start,
+                end         = end,
+                limit       = limit)
+
+        return await workloads['history'].run(get_stored_candles,
+                exchange    = ccxt_exchange,
+                pair        = pair,
+                timeframe   = timeframe,
+                start       = start,
+                end         = end)
+
+    cluster_candles = await asyncio.gather(*[get_cluster(start, end) for start, end in clusters])
+    cluster_starts = [start for start, _ in clusters]
+
+    # The candle at a date is the first candle in [date, date + dt).
+    found = []
+    for since in timestamps:
+        candles = cluster_candles[bisect.bisect_right(cluster_starts, since) - 1]
+        i = int(np.searchsorted(candles.timestamp, since))
+
+        row = (since, np.nan, np.nan, np.nan, np.nan, np.nan)
+        if i < len(candles) and candles.timestamp[i] < since + dt:
+            row = tuple(column[i] for column in candles.columns())
+        found.append(row)
+
+    found = CandleColumns.from_rows(found)
+    present = ~np.isnan(found.close)
+    result = [candle if exists else None 
+            for candle, exists in zip(found.to_dicts(), present)]
+
+    if not any(result):
         raise HTTPException(
                 detail  = f'Spotbit did not receive any candle history for the requested dates\n{dates = }.',
                 status_code = HTTPStatus.INTERNAL_SERVER_ERROR)
 
+    media_type = get_media_type(request, HISTORY_MEDIA_TYPES)
+    if media_type == formats.JSON:
+        result = formats.TrustedJSONResponse(result)
+    else:
+        result = encoded_response(found, media_type)
 
     return result
 
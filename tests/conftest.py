@@ -0,0 +1,40 @@
+'''
+Tests run offline against replay exchanges. Ref. lib.replay.
+
+The server reads its settings when it is imported, so it is imported once per session with
+the settings of the tests.
+'''
+
+import json
+import os
+import pathlib
+import sys
+
+import pytest
+
+ROOT = pathlib.Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+
+# The largest page of candles that the capped exchange returns.
+PAGE_LIMIT = 50
+
+@pytest.fixture(scope = 'session')
+def server(tmp_path_factory):
+    os.environ.update({
+        'EXCHANGES':        json.dumps(['replay', 'capped']),
+        'REPLAY':           json.dumps({'replay': {}, 'capped': {'page_limit': PAGE_LIMIT}}),
+        'COLLECTOR':        'false',
+        'DATA_DIRECTORY':   str(tmp_path_factory.mktemp('data')),
+        })
+
+    # Static files and templates are served relative to the working directory.
+    os.chdir(ROOT)
+    import server
+    return server
+
+@pytest.fixture(scope = 'session')
+def client(server):
+    from fastapi.testclient import TestClient
+
+    with TestClient(server.app) as client:
+        yield client
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from lib import RawCandle
+from lib.aggregate import MAD_LIMIT, Aggregation, aggregate, aggregate_grid, pack
+from lib.replay import ReplayExchange
+
+nan = np.nan
+
+def grid() -> np.ndarray:
+    '''
+    Three exchanges at two timestamps. The third exchange has no candle at the second timestamp.
+    '''
+    return np.array([
+        [[1.0, 2.0, 0.5, 1.0, 1.0], [10.0, 10.0, 10.0, 10.0, 1.0]],
+        [[2.0, 3.0, 1.5, 2.0, 3.0], [20.0, 20.0, 20.0, 20.0, 3.0]],
+        [[6.0, 7.0, 5.5, 6.0, 0.0], [nan, nan, nan, nan, nan]],
+        ])
+
+def test_mean_and_median():
+    mean = aggregate_grid(grid(), Aggregation.MEAN)
+    assert mean[:, 3].tolist() == [3.0, 15.0]
+
+    median = aggregate_grid(grid(), Aggregation.MEDIAN)
+    assert median[:, 3].tolist() == [2.0, 15.0]
+
+def test_vwap():
+    vwap = aggregate_grid(grid(), Aggregation.VWAP)
+    assert vwap[:, 3].tolist() == pytest.approx([(1.0 * 1 + 2.0 * 3) / 4, (10.0 * 1 + 20.0 * 3) / 4])
+
+    # Without volume the prices are the mean.
+    values = grid()
+    values[..., 4] = 0
+    assert aggregate_grid(values, Aggregation.VWAP)[:, 3].tolist() == [3.0, 15.0]
+
+def test_vwap_of_tickers():
+    # Candles from tickers have one price and no volume.
+    tickers = [RawCandle(1704067200000, price, price, price, price, 0.0) for price in [100.0, 102.0]]
+    assert aggregate(tickers, Aggregation.VWAP).close == 101.0
+
+    # A ticker is skipped when other exchanges have volume.
+    candle = RawCandle(1704067200000, 110.0, 110.0, 110.0, 110.0, 2.0)
+    assert aggregate([*tickers, candle], Aggregation.VWAP).close == 110.0
+
+    # Each timestamp falls back to the mean on its own.
+    values = np.stack([pack([tickers[0], candle]), pack([tickers[1], tickers[1]])])
+    assert aggregate_grid(values, Aggregation.VWAP)[:, 3].tolist() == [101.0, 110.0]
+
+def test_trimmed():
+    values = np.array([[[price] * 4 + [1.0]] for price in [1.0, 2.0, 3.0, 4.0, 100.0]])
+    trimmed = aggregate_grid(values, Aggregation.TRIMMED)
+    assert trimmed[0, 3] == 3.0
+
+def test_mad_drops_outliers():
+    closes = [100.0, 101.0, 99.0, 100.5, 99.5, 100.0 + 100 * MAD_LIMIT]
+    values = np.array([[[close] * 4 + [1.0]] for close in closes])
+
+    mad = aggregate_grid(values, Aggregation.MAD)
+    assert mad[0, 3] == pytest.approx(np.mean(closes[:-1]))
+
+    # Identical prices have no deviation and are all kept.
+    values = np.ones((3, 1, 5))
+    assert aggregate_grid(values, Aggregation.MAD)[0].tolist() == [1.0] * 5
+
+def test_grid_matches_single_candles():
+    exchanges = [ReplayExchange({'id': id}) for id in ['a', 'b', 'c']]
+    start = 1704067200000
+    candles = [[RawCandle(*row) for row in exchange.fetch_ohlcv(symbol, '1h', start, 3)]
+            for exchange, symbol in zip(exchanges, ['BTC/USD', 'BTC/EUR', 'BTC/GBP'])]
+    values = np.stack([pack(rows) for rows in candles])
+
+    for aggregation in Aggregation:
+        result = aggregate_grid(values, aggregation)
+        for t in range(3):
+            candle = aggregate([rows[t] for rows in candles], aggregation)
+            assert result[t].tolist() == pytest.approx(list(candle[1:]))
@@ -0,0 +1,40 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('bdkpython')
+import beancounter
+
+CANDLE = {
+        'timestamp':    '2024-01-01T00:00:00+00:00',
+        'open':         40000.0,
+        'high':         42000.0,
+        'low':          39000.0,
+        'close':        41000.0,
+        'volume':       10.0,
+        }
+
+@pytest.fixture
+def spotbit(monkeypatch) -> beancounter.Spotbit:
+    # Spotbit has no candle for the second date.
+    response = SimpleNamespace(status_code = 200, json = lambda: [CANDLE, None])
+    monkeypatch.setattr(beancounter.requests, 'post', lambda url, json: response)
+
+    return beancounter.Spotbit('http://spotbit')
+
+def test_missing_candles_are_none(spotbit):
+    candles = spotbit.get_candles_at_dates('USD', [datetime(2024, 1, 1), datetime(2024, 1, 2)])
+
+    assert candles[0].close == 41000.0
+    assert candles[1] is None
+
+def test_transactions_without_a_candle_are_left_out(spotbit):
+    transactions = [SimpleNamespace(txid = txid, confirmation_time = SimpleNamespace(timestamp = timestamp))
+            for txid, timestamp in [('a', 1704067200), ('b', 1704153600)]]
+
+    details = asyncio.run(beancounter.make_transaction_details(transactions, 'USD', spotbit))
+
+    assert [detail.id() for detail in details] == ['a']
+    assert details[0].twap == 40500.0
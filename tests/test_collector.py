@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+from lib import RawCandle
+from lib.collector import PriceCollector, Sample
+
+def candle(close: float) -> RawCandle:
+    return RawCandle(1704067200000, close, close, close, close, 1.0)
+
+def make_collector(fetch = None, pairs = (), size: int = 3) -> PriceCollector:
+    async def no_candle(exchange: str, currency: str):
+        return None
+
+    return PriceCollector(
+            fetch       = fetch or no_candle,
+            pairs       = lambda: list(pairs),
+            interval    = 1,
+            size        = size)
+
+def test_ring_buffer():
+    collector = make_collector(size = 3)
+    for close in range(5):
+        collector.record('replay', 'USD', candle(close))
+
+    assert [sample.candle.close for sample in collector.buffers[('replay', 'USD')]] == [2, 3, 4]
+    assert collector.latest('replay', 'USD').candle.close == 4
+    assert collector.latest('replay', 'EUR') is None
+
+def test_fresh():
+    collector = make_collector()
+    collector.add('replay', 'USD', Sample(candle = candle(1), fetched_at = time.time() - 100))
+
+    assert collector.fresh('replay', 'USD', 90) is None
+    assert collector.fresh('replay', 'USD', 200).candle.close == 1
+
+def test_only_newer_samples_are_added():
+    collector = make_collector()
+    now = time.time()
+
+    assert collector.add('replay', 'USD', Sample(candle = candle(1), fetched_at = now))
+    assert not collector.add('replay', 'USD', Sample(candle = candle(2), fetched_at = now - 1))
+    assert collector.latest('replay', 'USD').candle.close == 1
+
+def test_collect():
+    async def fetch(exchange: str, currency: str) -> RawCandle | None:
+        match exchange:
+            case 'replay':  return candle(1)
+            case 'broken':  raise ConnectionError('refused')
+            case _:         return None
+
+    collected = []
+    collector = make_collector(fetch, [('replay', 'USD'), ('broken', 'USD'), ('empty', 'USD')])
+    collector.on_collect = lambda: collected.append(True)
+
+    # A failing exchange doesn't stop the others from being collected.
+    assert asyncio.run(collector.collect()) == 3
+    assert list(collector.buffers) == [('replay', 'USD')]
+    assert collected == [True]
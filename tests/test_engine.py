@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+import pytest
+
+from lib.engine import InstancePool, ThreadedEngine
+from lib.health import HealthRegistry
+from lib.ratelimit import RateLimitScheduler
+from lib.replay import ReplayExchange
+from lib.workloads import make_workloads
+
+HOUR = 60 * 60 * 1000
+
+def make_engine(exchanges: dict, *, rate_limits: dict[str, float] = {}, threads: dict[str, int] = {}) -> ThreadedEngine:
+    return ThreadedEngine(exchanges,
+            scheduler   = RateLimitScheduler(overrides = rate_limits),
+            health      = HealthRegistry(),
+            workloads   = make_workloads(threads, {}),
+            pool_size   = 4)
+
+def test_rate_limit_spaces_out_calls(monkeypatch):
+    exchanges = {
+            'slow': ReplayExchange({'id': 'slow', 'latency': 1}),
+            'fast': ReplayExchange({'id': 'fast'}),
+            }
+    engine = make_engine(exchanges, rate_limits = {'fast': 2, 'slow': 100}, threads = {'history': 2})
+
+    started = []
+    fetch_ohlcv = ReplayExchange.fetch_ohlcv
+    def record(self, *args, **kwargs):
+        if self.id == 'fast': started.append(time.monotonic())
+        return fetch_ohlcv(self, *args, **kwargs)
+    monkeypatch.setattr(ReplayExchange, 'fetch_ohlcv', record)
+
+    async def fetch(id: str, since: int):
+        return await engine.fetch_ohlcv(exchanges[id], symbol = 'BTC/USD', timeframe = '1h',
+                since = since, limit = 1, workload = 'history')
+
+    async def run():
+        # The slow exchange holds both history threads while the fast exchange's calls wait for one.
+        slow = [asyncio.create_task(fetch('slow', i * HOUR)) for i in range(2)]
+        await asyncio.sleep(0.05)
+        await asyncio.gather(*slow, *[fetch('fast', i * HOUR) for i in range(4)])
+
+        for workload in engine.workloads.values(): workload.shutdown()
+
+    asyncio.run(run())
+
+    assert len(started) == 4
+    gaps = [b - a for a, b in zip(started, started[1:])]
+    assert min(gaps) == pytest.approx(0.5, abs = 0.05)
+
+def test_pool_checkout():
+    exchange = ReplayExchange({'id': 'replay'})
+    exchange.load_markets()
+    pool = InstancePool(exchange, 2)
+
+    async def run():
+        async with pool.checkout() as a:
+            async with pool.checkout() as b:
+                assert a is not b
+                assert a.markets is exchange.markets
+                assert b.markets_by_id is exchange.markets_by_id
+
+        # Idle instances are reused instead of creating more.
+        async with pool.checkout() as c:
+            assert c in (a, b)
+        assert len(pool.instances) == 2
+
+        # A reload has set the markets but not yet the attributes that are derived from them.
+        markets_by_id = exchange.markets_by_id
+        exchange.markets = {**exchange.markets}
+        async with pool.checkout() as d:
+            assert d.markets is not exchange.markets
+            assert d.markets_by_id is markets_by_id
+
+        # The reload finishes.
+        exchange.markets_by_id = {**markets_by_id}
+        pool.set_markets()
+        async with pool.checkout() as e:
+            assert e.markets is exchange.markets
+            assert e.markets_by_id is exchange.markets_by_id
+
+    asyncio.run(run())
+    pool.close()
+
+def test_load_markets_updates_pool():
+    exchange = ReplayExchange({'id': 'replay'})
+    engine = make_engine({'replay': exchange})
+
+    async def run():
+        await engine.load_markets(exchange, timeout = 5)
+        async with engine.pools['replay'].checkout() as instance:
+            assert instance.markets is exchange.markets
+
+        await engine.load_markets(exchange, reload = True, timeout = 5)
+        async with engine.pools['replay'].checkout() as instance:
+            assert instance.markets is exchange.markets
+            assert instance.symbols is exchange.symbols
+
+        await engine.close()
+        for workload in engine.workloads.values(): workload.shutdown()
+
+    asyncio.run(run())
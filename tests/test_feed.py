@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+import orjson
+
+from lib import RawCandle
+from lib.aggregate import Aggregation
+from lib.broadcast import Broadcaster
+from lib.collector import Sample
+
+def test_every_subscriber_gets_each_message():
+    feed = Broadcaster(size = 10)
+    first, second = feed.subscribe('USD'), feed.subscribe('USD')
+    other = feed.subscribe('EUR')
+
+    feed.publish('USD', 1)
+    feed.publish('USD', 2)
+
+    async def run():
+        assert await first.get() == [1, 2]
+        assert await second.get() == [1, 2]
+
+    asyncio.run(run())
+    assert not other.queue
+    assert feed.stats() == {'subscribers': 3, 'topics': 2, 'published': 2, 'dropped': 0}
+
+def test_slow_subscriber_drops_its_oldest_messages():
+    feed = Broadcaster(size = 2)
+    slow = feed.subscribe('USD')
+
+    for message in range(5): feed.publish('USD', message)
+
+    assert list(slow.queue) == [3, 4]
+    assert feed.stats()['dropped'] == 3
+
+    feed.unsubscribe(slow)
+    assert feed.topics() == []
+
+def events(messages: list[bytes]) -> list[tuple[str, dict]]:
+    result = []
+    for message in messages:
+        event, data = message.decode().strip().split('\n')
+        result.append((event.removeprefix('event: '), orjson.loads(data.removeprefix('data: '))))
+
+    return result
+
+def test_prices_are_published_once_per_candle(server, client, monkeypatch):
+    monkeypatch.setattr(server, 'feed_published', {})
+    monkeypatch.setattr(server.collector, 'buffers', {})
+    subscription = server.feed.subscribe(('GBP', Aggregation.MEAN))
+
+    now = time.time()
+    for id, close in [('replay', 100.0), ('capped', 102.0)]:
+        server.collector.add(id, 'GBP', Sample(candle = RawCandle(int(now) * 1000, close, close, close, close, 1.0), fetched_at = now))
+
+    try:
+        server.publish_prices()
+        published = events(subscription.queue)
+        subscription.queue.clear()
+
+        assert sorted(data['exchange'] for event, data in published if event == 'exchange') == ['capped', 'replay']
+        aggregate = [data for event, data in published if event == 'aggregate']
+        assert aggregate[0]['candle']['close'] == 101.0
+
+        # Candles that have been sent aren't sent again, but the aggregate is.
+        server.publish_prices()
+        assert [event for event, data in events(subscription.queue)] == ['aggregate']
+    finally:
+        server.feed.unsubscribe(subscription)
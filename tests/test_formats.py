@@ -0,0 +1,46 @@
+import pytest
+
+from lib.columnar import CandleColumns
+from lib.formats import ARROW, ARROW_FILE, CSV, JSON, MSGPACK, NDJSON, encode, negotiate
+from lib.replay import ReplayExchange
+
+def test_default_is_json():
+    assert negotiate(None) == JSON
+    assert negotiate('') == JSON
+    assert negotiate('*/*') == JSON
+    assert negotiate('text/html') == JSON
+
+def test_preference():
+    assert negotiate('text/csv') == CSV
+    assert negotiate('application/msgpack, text/csv') == MSGPACK
+    assert negotiate('text/csv;q=0.5, application/msgpack;q=0.9') == MSGPACK
+    # Equal preferences are taken in the order they are given.
+    assert negotiate('text/csv;q=0.5, application/x-ndjson;q=0.5') == CSV
+    assert negotiate('Text/CSV') == CSV
+
+def test_refused_and_invalid_quality():
+    assert negotiate('text/csv;q=0') == JSON
+    assert negotiate('text/csv;q=abc, application/msgpack;q=0.1') == MSGPACK
+
+def test_aliases():
+    assert negotiate('application/x-msgpack') == MSGPACK
+    assert negotiate('application/vnd.msgpack') == MSGPACK
+
+def test_media_types():
+    assert negotiate('application/x-ndjson', [JSON, CSV]) == JSON
+    assert negotiate('application/x-ndjson') == NDJSON
+    assert negotiate('application/vnd.apache.arrow.stream') == ARROW
+
+def test_arrow_file():
+    assert negotiate('application/vnd.apache.arrow.file') == ARROW_FILE
+
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.ipc
+
+    exchange = ReplayExchange({'id': 'replay'})
+    candles = CandleColumns.from_rows(exchange.fetch_ohlcv('BTC/USD', '1h', 1704067200000, 24))
+
+    stream = pyarrow.ipc.open_stream(encode(candles, ARROW)).read_all()
+    file = pyarrow.ipc.open_file(encode(candles, ARROW_FILE)).read_all()
+    assert file.equals(stream)
+    assert file.column('close').to_pylist() == candles.close.tolist()
@@ -0,0 +1,75 @@
+import pytest
+
+from lib import health
+from lib.health import HealthRegistry
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    result = Clock()
+    monkeypatch.setattr(health.time, 'monotonic', result)
+    return result
+
+def fail(registry: HealthRegistry, id: str, times: int = 1):
+    for _ in range(times):
+        registry.failed(id, ConnectionError('refused'), 0.1)
+
+def test_circuit_opens_after_consecutive_failures(clock):
+    registry = HealthRegistry(failures = 3, cooldown = 10)
+
+    fail(registry, 'replay', 2)
+    registry.succeeded('replay', 0.1)
+    fail(registry, 'replay', 2)
+    assert registry.health('replay').state == 'closed'
+    assert registry.allow('replay')
+
+    fail(registry, 'replay')
+    assert registry.health('replay').state == 'open'
+    assert not registry.available('replay')
+    assert not registry.allow('replay')
+    assert registry.health('replay').last_error == 'ConnectionError: refused'
+
+def test_probe_closes_or_reopens_the_circuit(clock):
+    registry = HealthRegistry(failures = 1, cooldown = 10, max_cooldown = 30)
+    fail(registry, 'replay')
+
+    clock.now += 10
+    assert registry.available('replay')
+    assert registry.allow('replay')
+    assert registry.health('replay').state == 'half_open'
+    # Only one probe is let through.
+    assert not registry.allow('replay')
+
+    # The cooldown doubles while probes fail, up to max_cooldown.
+    fail(registry, 'replay')
+    assert registry.health('replay').cooldown == 20
+    clock.now += 20
+    assert registry.allow('replay')
+    fail(registry, 'replay')
+    assert registry.health('replay').cooldown == 30
+
+    clock.now += 30
+    assert registry.allow('replay')
+    registry.succeeded('replay', 0.1)
+    assert registry.health('replay').state == 'closed'
+    assert registry.available('replay')
+
+def test_snapshot(clock):
+    registry = HealthRegistry(failures = 1, cooldown = 10, alpha = 0.5)
+    registry.succeeded('replay', 1.0)
+    registry.succeeded('replay', 3.0)
+    fail(registry, 'broken')
+
+    snapshot = registry.snapshot()
+    assert snapshot['replay']['latency'] == 2.0
+    assert snapshot['replay']['success_rate'] == 1.0
+    assert snapshot['replay']['retry_in'] is None
+    assert snapshot['broken']['state'] == 'open'
+    assert snapshot['broken']['retry_in'] == 10
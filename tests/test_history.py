@@ -0,0 +1,95 @@
+from datetime import datetime, timezone
+import json
+
+from lib.store import received_until
+
+HOUR = 60 * 60 * 1000
+
+def test_received_until():
+    start, end = 0, 10 * HOUR
+
+    assert received_until(start, end, HOUR, [t * HOUR for t in range(10)]) == end
+    # A page that was cut short.
+    assert received_until(start, end, HOUR, [t * HOUR for t in range(4)]) == 4 * HOUR
+    # An exchange that ignores since and returns other candles.
+    assert received_until(start, end, HOUR, [t * HOUR for t in range(20, 30)]) == start
+    # No candles for the period.
+    assert received_until(start, end, HOUR, []) == end
+
+def timestamp(text: str) -> int:
+    return int(datetime.fromisoformat(text).replace(tzinfo = timezone.utc).timestamp() * 1000)
+
+def get_history(client, start: str, end: str) -> list[dict]:
+    response = client.get('/api/history/USD/capped', params = {'start': start + '+00:00', 'end': end + '+00:00'})
+    assert response.status_code == 200
+    return response.json()
+
+def test_short_pages_are_not_covered(server, client, monkeypatch):
+    start, end = '2024-01-01T00:00:00', '2024-01-05T00:00:00'
+
+    monkeypatch.setattr(server, 'FILL_ROUNDS', 1)
+    candles = get_history(client, start, end)
+
+    # Each page of 100 candles got PAGE_LIMIT, and the rest of the page is still missing.
+    assert len(candles) < 96
+    gaps = server.store.missing('capped', 'BTC/USD', '1h', timestamp(start), timestamp(end))
+    assert gaps
+
+    monkeypatch.setattr(server, 'FILL_ROUNDS', 4)
+    candles = get_history(client, start, end)
+    assert len(candles) == 96
+    assert not server.store.missing('capped', 'BTC/USD', '1h', timestamp(start), timestamp(end))
+
+def test_short_pages_are_requested_again(client):
+    candles = get_history(client, '2024-02-01T00:00:00', '2024-02-21T00:00:00')
+
+    timestamps = [datetime.fromisoformat(candle['timestamp']) for candle in candles]
+    assert len(timestamps) == 20 * 24
+    assert all((b - a).total_seconds() == 60 * 60 for a, b in zip(timestamps, timestamps[1:]))
+
+def test_dates_on_capped_exchange(client):
+    dates = ['2024-03-01T00:00:00+00:00', '2024-03-21T20:00:00+00:00']
+    response = client.post('/api/history/USD', params = {'exchange': 'capped'}, json = dates)
+    assert response.status_code == 200
+
+    candles = response.json()
+    assert [datetime.fromisoformat(candle['timestamp']) for candle in candles] == [datetime.fromisoformat(date) for date in dates]
+
+def stream(client, start: str, end: str, **params) -> list[dict]:
+    response = client.get('/api/history/USD/replay', 
+            params  = {'start': start + '+00:00', 'end': end + '+00:00', **params},
+            headers = {'Accept': 'application/x-ndjson'})
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'application/x-ndjson'
+
+    return [json.loads(line) for line in response.text.splitlines()]
+
+def test_streamed_history(server, client, monkeypatch):
+    start, end = '2024-04-01T00:00:00', '2024-04-21T00:00:00'
+
+    # Only a few pages are requested ahead of the page that is being sent.
+    running, most = 0, 0
+    fill_history = server.fill_history
+    async def fill(**kwargs):
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        try:
+            return await fill_history(**kwargs)
+        finally:
+            running -= 1
+    monkeypatch.setattr(server, 'fill_history', fill)
+
+    candles = stream(client, start, end)
+    assert len(candles) == 20 * 24
+    assert 1 < most <= server.STREAM_PAGES_IN_FLIGHT
+
+    timestamps = [datetime.fromisoformat(candle['timestamp']) for candle in candles]
+    assert timestamps == sorted(timestamps)
+
+    response = client.get('/api/history/USD/replay', params = {'start': start + '+00:00', 'end': end + '+00:00'})
+    assert response.json() == candles
+
+def test_streamed_history_is_resampled(client):
+    candles = stream(client, '2024-04-01T00:00:00', '2024-04-21T00:00:00', timeframe = '4h')
+    assert len(candles) == 20 * 6
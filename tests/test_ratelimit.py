@@ -0,0 +1,54 @@
+import asyncio
+import time
+
+import pytest
+
+from lib.ratelimit import RateLimitScheduler, TokenBucket
+from lib.replay import ReplayExchange
+
+def elapsed(coroutine) -> float:
+    async def run():
+        began = time.monotonic()
+        await coroutine
+        return time.monotonic() - began
+
+    return asyncio.run(run())
+
+def test_requests_are_spread_out():
+    bucket = TokenBucket(rate = 20)
+
+    async def acquire(n: int):
+        await asyncio.gather(*[bucket.acquire() for _ in range(n)])
+
+    # The first token is available at once, the rest at 20 per second.
+    assert elapsed(acquire(5)) == pytest.approx(4 / 20, abs = 0.05)
+
+def test_burst():
+    bucket = TokenBucket(rate = 1, capacity = 3)
+
+    async def acquire():
+        for _ in range(3): await bucket.acquire()
+
+    assert elapsed(acquire()) < 0.05
+
+def test_pause():
+    bucket = TokenBucket(rate = 1000)
+
+    async def acquire():
+        bucket.pause(0.2)
+        await bucket.acquire()
+
+    assert elapsed(acquire()) == pytest.approx(0.2, abs = 0.05)
+
+def test_scheduler_backs_off():
+    exchange = ReplayExchange({'id': 'replay'})
+    scheduler = RateLimitScheduler(overrides = {'replay': 4}, max_backoff = 1)
+
+    assert scheduler.bucket(exchange).rate == 4
+    assert scheduler.rate_limited(exchange) == 0.25
+    assert scheduler.rate_limited(exchange) == 0.5
+    assert scheduler.rate_limited(exchange) == 1
+    assert scheduler.rate_limited(exchange) == 1
+
+    scheduler.succeeded(exchange)
+    assert scheduler.bucket(exchange).backoff == 0
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from lib import resample
+from lib.columnar import CandleColumns
+from lib.replay import ReplayExchange
+
+MINUTE = 60 * 1000
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+def test_bucket_size():
+    assert resample.bucket_size('5m') == 5 * MINUTE
+    assert resample.bucket_size('4h') == 4 * HOUR
+    assert resample.bucket_size('1w') == 7 * DAY
+
+    for timeframe in ['1M', '1y', '0h', 'h', '1.5h']:
+        with pytest.raises(resample.InvalidTimeframe):
+            resample.bucket_size(timeframe)
+
+def test_weeks_start_on_monday():
+    # 2024-01-03 was a Wednesday and 2024-01-01 a Monday.
+    wednesday = 1704240000000
+    monday = wednesday - 2 * DAY
+
+    assert resample.floor(wednesday, '1w') == monday
+    assert resample.ceil(wednesday, '1w') == monday + 7 * DAY
+    assert resample.ceil(monday, '1w') == monday
+    assert resample.floor(wednesday + 5 * HOUR, '1d') == wednesday
+
+def test_resample_replay_candles():
+    exchange = ReplayExchange({'id': 'replay'})
+    start = 1704067200000   # 2024-01-01
+    candles = CandleColumns.from_rows(exchange.fetch_ohlcv('BTC/USD', '1m', start, 60))
+
+    result = resample.resample(candles, '15m')
+
+    assert result.timestamp.tolist() == [start + i * 15 * MINUTE for i in range(4)]
+    for i in range(4):
+        bucket = candles[i * 15:(i + 1) * 15]
+        assert result.open[i] == bucket.open[0]
+        assert result.high[i] == bucket.high.max()
+        assert result.low[i] == bucket.low.min()
+        assert result.close[i] == bucket.close[-1]
+        assert result.volume[i] == pytest.approx(bucket.volume.sum())
+
+def test_resample_partial_buckets():
+    candles = CandleColumns.from_rows([
+        [10 * MINUTE, 1.0, 2.0, 0.5, 1.5, 1.0],
+        [20 * MINUTE, 1.5, 3.0, 1.0, 2.5, np.nan],
+        [70 * MINUTE, 2.5, 2.5, 2.5, 2.5, 2.0],
+        ])
+
+    result = resample.resample(candles, '1h')
+
+    assert result.timestamp.tolist() == [0, HOUR]
+    assert result.high.tolist() == [3.0, 2.5]
+    assert result.close.tolist() == [2.5, 2.5]
+    # A missing volume counts as none.
+    assert result.volume.tolist() == [1.0, 2.0]
+
+    assert len(resample.resample(candles[:0], '1h')) == 0
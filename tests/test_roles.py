@@ -0,0 +1,94 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+from conftest import ROOT
+
+from lib import RawCandle, catalog
+from lib.collector import Sample
+from lib.markets import PairIndex
+from lib.replay import ReplayExchange
+from lib.shared import LatestStore
+
+CURRENCIES = ['USD', 'EUR']
+
+# Runs in a serve-only process, in which ccxt can't be imported.
+SERVE = '''
+import json
+import os
+import sys
+import time
+
+sys.modules['ccxt'] = None
+
+from fastapi.testclient import TestClient
+import server
+
+def wait(condition):
+    expires = time.monotonic() + 10
+    while not condition() and time.monotonic() < expires: time.sleep(0.1)
+
+result = {}
+with TestClient(server.app) as client:
+    wait(lambda: server.fresh_samples('USD'))
+    result['before'] = client.get('/api/now/USD').json()
+
+    # The collect process adds an exchange.
+    path = server.catalog_path
+    entries = json.loads(path.read_text())
+    entries['extra'] = {**entries['replay'], 'name': 'extra'}
+    path.with_suffix('.tmp').write_text(json.dumps(entries))
+    os.replace(path.with_suffix('.tmp'), path)
+
+    modified = server.catalog_modified
+    wait(lambda: server.catalog_modified != modified)
+
+    response = client.get('/api/now/USD')
+    result['after'] = {'status': response.status_code, **response.json()}
+    result['feed'] = sorted(server.fresh_samples('USD'))
+    result['exchanges'] = sorted(server.supported_exchanges)
+    result['ccxt'] = 'ccxt' in sys.modules and sys.modules['ccxt'] is not None
+
+print(json.dumps(result))
+'''
+
+def collect(directory):
+    '''
+    Save the catalog and a latest candle as the collect process does.
+    '''
+    exchange = ReplayExchange({'id': 'replay', 'name': 'replay'})
+    exchange.load_markets()
+
+    index = PairIndex(CURRENCIES)
+    index.build(exchange)
+    catalog.save(directory / 'exchanges.json', {'replay': exchange}, index)
+
+    candle = RawCandle(int(time.time()) * 1000, 1.0, 2.0, 0.5, 1.5, 10.0)
+    LatestStore(directory / 'latest.sqlite3').write({('replay', 'USD'): Sample(candle = candle, fetched_at = time.time())})
+
+def test_serve_without_ccxt(tmp_path):
+    collect(tmp_path)
+
+    env = {**os.environ,
+            'ROLE':             'serve',
+            'DATA_DIRECTORY':   str(tmp_path),
+            'CURRENCIES':       json.dumps(CURRENCIES),
+            'EXCHANGES':        json.dumps(['replay']),
+            'REPLAY':           '{}',
+            'COLLECTOR':        'false',
+            }
+    process = subprocess.run([sys.executable, '-c', SERVE],
+            cwd = ROOT, env = env, capture_output = True, text = True, timeout = 60)
+    assert process.returncode == 0, process.stderr
+
+    result = json.loads(process.stdout.splitlines()[-1])
+    assert not result['ccxt']
+    assert result['before']['exchanges_used'] == ['replay']
+
+    # An exchange that is added to the catalog isn't served until a restart.
+    assert result['after']['status'] == 200
+    assert result['after']['exchanges_used'] == ['replay']
+    assert result['feed'] == ['replay']
+    assert result['exchanges'] == ['replay']
@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+import pytest
+
+from lib import RawCandle
+from lib.collector import Sample
+
+def test_now_lists_every_exchange(server, client):
+    response = client.get('/api/now/USD')
+    assert response.status_code == 200
+
+    result = response.json()
+    assert sorted(result['exchanges_used']) == ['capped', 'replay']
+    assert sorted(result['ages']) == ['capped', 'replay']
+
+    # The feed aggregates the same exchanges.
+    assert sorted(server.fresh_samples('USD')) == ['capped', 'replay']
+
+def test_now_for_one_exchange(client):
+    response = client.get('/api/now/EUR/replay')
+    assert response.status_code == 200
+    assert int(response.headers['Age']) >= 0
+
+def test_exchanges(client):
+    response = client.get('/api/exchanges')
+    assert response.status_code == 200
+    assert sorted(exchange['name'] for exchange in response.json()) == ['capped', 'replay']
+
+def test_formats(client):
+    response = client.get('/api/now/USD/replay', headers = {'Accept': 'text/csv'})
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/csv')
+    assert response.text.startswith('timestamp,open,high,low,close,volume')
+
+def test_arrow_file(client):
+    pytest.importorskip('pyarrow')
+
+    response = client.get('/api/now/USD/replay', headers = {'Accept': 'application/vnd.apache.arrow.file'})
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'application/vnd.apache.arrow.file'
+    assert response.content.startswith(b'ARROW1')
+
+def test_metrics_explain_why_they_are_missing(server, client, monkeypatch):
+    response = client.get('/metrics')
+    assert response.status_code == 404
+    assert 'turned off' in response.json()['detail']
+
+    # Turned on without prometheus_client.
+    monkeypatch.setattr(server.settings, 'metrics', True)
+    response = client.get('/metrics')
+    assert response.status_code == 501
+    assert 'prometheus_client' in response.json()['detail']
+
+def test_now_is_answered_from_the_collector(server, client, monkeypatch):
+    async def get_candle(exchange, currency):
+        raise AssertionError('a collected candle was requested again')
+    monkeypatch.setattr(server, 'get_candle', get_candle)
+
+    candle = RawCandle(1704067200000, 1.0, 2.0, 0.5, 1.5, 10.0)
+    server.collector.add('replay', 'JPY', Sample(candle = candle, fetched_at = time.time() - 5))
+
+    response = client.get('/api/now/JPY/replay')
+    assert response.status_code == 200
+    assert response.json()['close'] == 1.5
+    assert response.headers['Age'] == '5'
+
+@pytest.fixture
+def hung_exchange(server, monkeypatch):
+    '''
+    The capped exchange doesn't answer.
+    '''
+    get_latest_sample = server.get_latest_sample
+    async def get_sample(exchange, currency):
+        if exchange.id == 'capped': await asyncio.sleep(60)
+        return await get_latest_sample(exchange, currency)
+    monkeypatch.setattr(server, 'get_latest_sample', get_sample)
+
+@pytest.mark.parametrize('params', [{'deadline': 0.5}, {'quorum': 1}])
+def test_now_doesnt_wait_for_a_hung_exchange(client, hung_exchange, params):
+    began = time.monotonic()
+    response = client.get('/api/now/USD', params = params)
+    assert time.monotonic() - began < 5
+
+    assert response.status_code == 200
+    result = response.json()
+    assert result['exchanges_used'] == ['replay']
+    assert result['timed_out_exchanges'] == ['capped']
+    assert result['failed_exchanges'] == []
@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+from lib import RawCandle
+from lib.collector import Sample
+from lib.shared import Leadership, LatestStore
+
+def sample(close: float, fetched_at: float) -> Sample:
+    return Sample(candle = RawCandle(int(fetched_at) * 1000, close, close, close, close, 1.0), fetched_at = fetched_at)
+
+def test_one_leader(tmp_path):
+    path = tmp_path / 'leader.lock'
+    leader, follower = Leadership(path), Leadership(path)
+
+    assert leader.acquire()
+    assert not follower.acquire()
+    assert not follower.is_leader
+
+    # A follower takes over once the leader has gone.
+    leader.release()
+    assert follower.acquire()
+    assert not leader.acquire()
+    follower.release()
+
+def test_latest_store_keeps_the_latest_sample(tmp_path):
+    leader   = LatestStore(tmp_path / 'latest.sqlite3')
+    follower = LatestStore(tmp_path / 'latest.sqlite3')
+
+    leader.write({('replay', 'USD'): sample(1.0, 100), ('replay', 'EUR'): sample(2.0, 100)})
+    # A sample that was fetched earlier doesn't replace the saved one.
+    leader.write({('replay', 'USD'): sample(3.0, 50)})
+    leader.write({('replay', 'EUR'): sample(4.0, 200)})
+
+    samples = follower.read()
+    assert samples[('replay', 'USD')].candle.close == 1.0
+    assert samples[('replay', 'EUR')].candle.close == 4.0
+    assert list(follower.read(since = 150)) == [('replay', 'EUR')]
+
+def test_sync_latest(server, client, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'latest_store', LatestStore(tmp_path / 'latest.sqlite3'))
+
+    # The collector's buffers are only changed on the event loop.
+    add = server.collector.add
+    def add_on_loop(*args):
+        asyncio.get_running_loop()
+        return add(*args)
+    monkeypatch.setattr(server.collector, 'add', add_on_loop)
+
+    now = time.time()
+    add('replay', 'USD', sample(1.0, now))
+    server.latest_store.write({('capped', 'GBP'): sample(2.0, now)})
+
+    # Share for a round, as each worker does.
+    task = client.portal.start_task_soon(server.sync_workers)
+    expires = time.monotonic() + 5
+    while server.collector.latest('capped', 'GBP') is None and time.monotonic() < expires: time.sleep(0.1)
+    task.cancel()
+
+    # This worker's sample is saved for the others and the other worker's sample is added.
+    assert server.latest_store.read()[('replay', 'USD')].candle.close == 1.0
+    assert server.collector.latest('capped', 'GBP').candle.close == 2.0
+
+    # Samples are only added once.
+    shared = {}
+    assert not client.portal.call(server.sync_latest, shared)
+    assert shared[('replay', 'USD')] == shared[('capped', 'GBP')] == now
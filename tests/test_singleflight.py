@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from lib.replay import ReplayExchange
+from lib.singleflight import SingleFlight
+from test_engine import make_engine
+
+def test_identical_calls_share_one_call():
+    flights = SingleFlight()
+    calls = []
+
+    async def call(key: str) -> str:
+        calls.append(key)
+        await asyncio.sleep(0.05)
+        return key.upper()
+
+    async def run():
+        results = await asyncio.gather(*[flights.do(key, lambda key = key: call(key)) for key in ['a', 'a', 'a', 'b']])
+        assert results == ['A', 'A', 'A', 'B']
+
+    asyncio.run(run())
+
+    assert calls == ['a', 'b']
+    assert flights.stats() == {'calls': 4, 'coalesced': 2, 'in_flight': 0}
+
+def test_errors_are_shared():
+    flights = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.05)
+        raise ConnectionError('refused')
+
+    async def run():
+        results = await asyncio.gather(flights.do('a', fail), flights.do('a', fail), return_exceptions = True)
+        assert [type(result) for result in results] == [ConnectionError, ConnectionError]
+
+        # A failed call isn't remembered.
+        with pytest.raises(ConnectionError):
+            await flights.do('a', fail)
+
+    asyncio.run(run())
+    assert flights.coalesced == 1
+
+def test_cancelled_caller_doesnt_cancel_the_call():
+    flights = SingleFlight()
+
+    async def call():
+        await asyncio.sleep(0.1)
+        return 'done'
+
+    async def run():
+        first = asyncio.create_task(flights.do('a', call))
+        second = asyncio.create_task(flights.do('a', call))
+        await asyncio.sleep(0.01)
+
+        first.cancel()
+        assert await second == 'done'
+        assert first.cancelled()
+
+    asyncio.run(run())
+
+def test_engine_coalesces_identical_requests(monkeypatch):
+    exchange = ReplayExchange({'id': 'replay', 'latency': 0.1})
+    engine = make_engine({'replay': exchange})
+
+    requests = []
+    fetch_ohlcv = ReplayExchange.fetch_ohlcv
+    def record(self, *args, **kwargs):
+        requests.append(args)
+        return fetch_ohlcv(self, *args, **kwargs)
+    monkeypatch.setattr(ReplayExchange, 'fetch_ohlcv', record)
+
+    async def run():
+        await engine.load_markets(exchange, timeout = 5)
+        candles = await asyncio.gather(*[engine.fetch_ohlcv(exchange, symbol = 'BTC/USD', timeframe = '1h', limit = 1)
+            for _ in range(10)])
+        assert all(c == candles[0] for c in candles)
+
+        await engine.close()
+        for workload in engine.workloads.values(): workload.shutdown()
+
+    asyncio.run(run())
+
+    assert len(requests) == 1
+    assert engine.flights.stats()['coalesced'] == 9
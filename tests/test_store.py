@@ -0,0 +1,46 @@
+from lib.columnar import RECORD
+from lib.store import CandleStore, ColumnarStore, cluster_intervals, merge_intervals, subtract_intervals
+
+HOUR = 60 * 60 * 1000
+
+def test_columnar_store_ignores_partial_record(tmp_path):
+    store = ColumnarStore(tmp_path)
+    store.insert('replay', 'BTC/USD', '1h', [[t * HOUR, 1.0, 2.0, 0.5, 1.5, 10.0] for t in range(10)])
+
+    # A page that is still being appended.
+    with open(store._path(('replay', 'BTC/USD', '1h'), '.ohlcv'), 'ab') as f:
+        f.write(bytes(RECORD.itemsize // 2))
+
+    candles = store.select('replay', 'BTC/USD', '1h', 0, 10 * HOUR)
+    assert len(candles.to_dicts()) == 10
+
+def test_merge_intervals():
+    assert merge_intervals([]) == []
+    assert merge_intervals([(5, 10), (0, 3)]) == [(0, 3), (5, 10)]
+    # Overlapping and adjacent intervals are merged.
+    assert merge_intervals([(0, 5), (3, 8), (8, 10), (12, 13)]) == [(0, 10), (12, 13)]
+    assert merge_intervals([(0, 10), (2, 4)]) == [(0, 10)]
+
+def test_subtract_intervals():
+    assert subtract_intervals(0, 10, []) == [(0, 10)]
+    assert subtract_intervals(0, 10, [(0, 10)]) == []
+    assert subtract_intervals(0, 10, [(2, 4), (6, 8)]) == [(0, 2), (4, 6), (8, 10)]
+    assert subtract_intervals(0, 10, [(-5, 3), (9, 20)]) == [(3, 9)]
+    # Intervals outside the range don't matter.
+    assert subtract_intervals(0, 10, [(-5, -1), (10, 20)]) == [(0, 10)]
+
+def test_cluster_intervals():
+    assert cluster_intervals([], HOUR, 10 * HOUR) == []
+    # Timestamps that fit in one span share an interval.
+    assert cluster_intervals([3 * HOUR, 0, HOUR], HOUR, 10 * HOUR) == [(0, 4 * HOUR)]
+    assert cluster_intervals([0, 9 * HOUR, 10 * HOUR], HOUR, 10 * HOUR) == [(0, 10 * HOUR), (10 * HOUR, 11 * HOUR)]
+    assert cluster_intervals([0, 100 * HOUR], HOUR, 10 * HOUR) == [(0, HOUR), (100 * HOUR, 101 * HOUR)]
+
+def test_stores_record_coverage(tmp_path):
+    for store in [CandleStore(tmp_path / 'candles.sqlite3'), ColumnarStore(tmp_path / 'candles')]:
+        store.insert('replay', 'BTC/USD', '1h', [[t * HOUR, 1.0, 2.0, 0.5, 1.5, 10.0] for t in range(5)])
+        store.cover('replay', 'BTC/USD', '1h', 0, 5 * HOUR)
+        store.cover('replay', 'BTC/USD', '1h', 8 * HOUR, 10 * HOUR)
+
+        assert store.missing('replay', 'BTC/USD', '1h', 0, 10 * HOUR) == [(5 * HOUR, 8 * HOUR)]
+        assert len(store.select('replay', 'BTC/USD', '1h', HOUR, 3 * HOUR)) == 2
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from lib import RawCandle
+from lib.collector import Sample
+from lib.workloads import Saturated, Workload
+
+def test_check():
+    workload = Workload('latest', threads = 1, queue = 2)
+
+    workload.waiting = 2
+    workload.check()
+
+    workload.waiting = 3
+    with pytest.raises(Saturated):
+        workload.check()
+    assert workload.stats() == {'threads': 1, 'queue': 2, 'waiting': 3, 'rejected': 1}
+
+def test_run_with_timeout():
+    workload = Workload('history', threads = 1, queue = 0)
+    release = threading.Event()
+
+    async def run():
+        # The only thread is busy for longer than the timeout.
+        busy = asyncio.create_task(workload.run(release.wait, 1))
+        await asyncio.sleep(0.05)
+        queued = asyncio.create_task(workload.run_with_timeout(0.2, time.sleep, 0.05))
+        await asyncio.sleep(0.05)
+        assert workload.waiting == 1
+
+        # The time spent waiting for the thread isn't counted.
+        await asyncio.sleep(0.3)
+        release.set()
+        await asyncio.gather(busy, queued)
+        assert workload.waiting == 0
+
+        with pytest.raises(asyncio.TimeoutError):
+            await workload.run_with_timeout(0.05, time.sleep, 0.2)
+
+    asyncio.run(run())
+    workload.shutdown()
+
+def test_saturated_route(server, client, monkeypatch):
+    monkeypatch.setattr(server.collector, 'buffers', {})
+    monkeypatch.setattr(server.workloads['latest'], 'waiting', 1000)
+
+    response = client.get('/api/now/GBP/capped')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+    # A candle that was collected doesn't need a thread so it's still answered.
+    now = time.time()
+    server.collector.add('capped', 'GBP', Sample(candle = RawCandle(int(now) * 1000, 1.0, 1.0, 1.0, 1.0, 1.0), fetched_at = now))
+    response = client.get('/api/now/GBP/capped')
+    assert response.status_code == 200
+    assert response.json()['close'] == 1.0